@@ -0,0 +1,145 @@
+# !python3
+"""
+Module that defines command timeouts learned from the latencies seen on a
+channel, so a dead or hung device is noticed in a few multiples of its
+normal response time instead of after a fixed worst-case timeout.
+"""
+
+from collections import deque
+
+from channel_stats import OUTCOME_OK, OUTCOME_PARTIAL, OUTCOME_TIMEOUT, command_prefix
+
+__author__ = 'Scott Pinkham, Byte Arts LLC'
+__version__ = '2019.513.0'
+
+# the timeout of a command type is recalculated after this many new latencies
+RECALCULATE_EVERY = 8
+
+
+class _CommandLatencies(object):
+    """
+    Recent latencies of one command type, and its current timeout.
+    """
+    __slots__ = ('latencies', 'new_samples', 'timeout')
+
+    def __init__(self, window):
+        self.latencies = deque(maxlen=window)
+        self.new_samples = 0
+        self.timeout = None
+    #end def
+#end class
+
+
+class AdaptiveTimeout(object):
+    """
+    Tracks the response latency of each command type (command prefix, e.g.
+    PRTRD) on one channel, and gives a timeout of a high percentile of the
+    recent latencies times a safety margin, kept between a floor and a
+    ceiling. Until a command type has warmup latencies, the channel's
+    cmd_timeout is used.
+
+    When a command times out, its timeout is doubled (up to the ceiling)
+    until new latencies come in, so a device that has become slower is
+    still heard from.
+
+    A channel feeds it through its ChannelStats hooks; see
+    DeviceChannel.adaptive_timeout.
+
+    Args:
+        percentile (float): latency percentile to base the timeout on.
+        margin (float): the percentile latency is multiplied by this.
+        floor (float): min timeout (in secs).
+        ceiling (float): max timeout (in secs), None for the channel's cmd_timeout.
+        warmup (int): latencies needed before a command type's timeout is used.
+        window (int): number of recent latencies kept per command type.
+    """
+    def __init__(self, percentile=99.0, margin=2.0, floor=0.01, ceiling=None, warmup=20, window=128):
+        self._percentile = percentile
+        self._margin = margin
+        self._floor = floor
+        self._ceiling = ceiling
+        self._warmup = max(1, warmup)
+        self._window = max(self._warmup, window)
+        self._commands = {}
+        self._commands_by_cmd = {}
+    #end def
+
+
+    def _calculate(self, entry):
+        latencies = sorted(entry.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self._percentile / 100.0))
+        entry.timeout = max(self._floor, latencies[index] * self._margin)
+        entry.new_samples = 0
+    #end def
+
+
+    def _entry(self, prefix):
+        entry = self._commands.get(prefix)
+        if entry is None:
+            entry = self._commands.setdefault(prefix, _CommandLatencies(self._window))
+        return entry
+    #end def
+
+
+    def record(self, prefix, latency, bytes_out, bytes_in, outcome):
+        """
+        Records the result of a command; a ChannelStats hook.
+        """
+        entry = self._entry(prefix)
+        if outcome is OUTCOME_OK:
+            entry.latencies.append(latency)
+            entry.new_samples += 1
+            if len(entry.latencies) >= self._warmup and (entry.timeout is None or
+                    entry.new_samples >= RECALCULATE_EVERY):
+                self._calculate(entry)
+        elif outcome is OUTCOME_TIMEOUT or outcome is OUTCOME_PARTIAL:
+            if entry.timeout is not None:
+                entry.timeout *= 2
+                if self._ceiling is not None:
+                    entry.timeout = min(entry.timeout, self._ceiling)
+                entry.new_samples = 0
+            #end if
+        #end if
+    #end def
+
+
+    def reset(self):
+        """
+        Forgets all the latencies, e.g. after the device has been replaced.
+        """
+        self._commands.clear()
+        self._commands_by_cmd.clear()
+    #end def
+
+
+    def timeout_for(self, cmd, default):
+        """
+        Gets the timeout for a command.
+
+        Args:
+            cmd (bytes): command, without its terminator.
+            default (float): timeout (in secs) to use while warming up, and
+                the ceiling if none was set.
+
+        Returns: (float) timeout in secs.
+        """
+        entry = self._commands_by_cmd.get(cmd)
+        if entry is None:
+            entry = self._entry(command_prefix(cmd))
+            self._commands_by_cmd[cmd] = entry
+        #end if
+
+        if entry.timeout is None:
+            return default
+        return min(entry.timeout, self._ceiling if self._ceiling is not None else default)
+    #end def
+
+
+    @property
+    def timeouts(self):
+        """
+        Returns dict of command prefix -> current timeout (in secs), None
+        while warming up.
+        """
+        return {prefix: entry.timeout for prefix, entry in self._commands.items()}
+#end class
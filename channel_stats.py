@@ -0,0 +1,268 @@
+# !python3
+"""
+Module that defines per-command statistics for a DeviceChannel: latency
+histograms, bytes in/out, timeouts and partial responses, grouped by
+command prefix (the command without its trailing number/value, e.g.
+b'PRTRD' for b'PRTRD3').
+"""
+
+__author__ = 'Scott Pinkham, Byte Arts LLC'
+__version__ = '2019.513.0'
+
+# latency histogram buckets: bucket i counts latencies under 2**i usecs,
+# the last bucket counts everything longer
+BUCKET_COUNT = 25
+_LAST_BUCKET = BUCKET_COUNT - 1
+
+OUTCOME_OK = 'ok'
+OUTCOME_TIMEOUT = 'timeout'
+OUTCOME_PARTIAL = 'partial'
+OUTCOME_WRITE = 'write'
+
+_DIGITS = b'0123456789'
+
+
+def bucket_upper_bound(index):
+    """
+    Returns the upper bound (in secs) of a latency histogram bucket, or
+    None for the last (unbounded) bucket.
+    """
+    if index >= BUCKET_COUNT - 1:
+        return None
+    return (1 << index) / 1000000.0
+#end def
+
+
+def command_prefix(cmd):
+    """
+    Returns the prefix that a command's stats are grouped under.
+
+    Args:
+        cmd (bytes): command, e.g. b'PRTWR2255'
+
+    Returns: (str) e.g. 'PRTWR'
+    """
+    return cmd.rstrip(_DIGITS).decode('ascii', 'replace')
+#end def
+
+
+class CommandStats(object):
+    """
+    Statistics for the commands sharing one prefix.
+    """
+    __slots__ = ('name', 'count', 'ok', 'timeouts', 'partials', 'write_errors',
+        'bytes_out', 'bytes_in', 'latency_total', 'histogram')
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.ok = 0
+        self.timeouts = 0
+        self.partials = 0
+        self.write_errors = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.latency_total = 0.0
+        self.histogram = [0] * BUCKET_COUNT
+    #end def
+
+
+    def percentile(self, percent):
+        """
+        Estimates a latency percentile from the histogram.
+
+        Args:
+            percent (float): e.g. 99
+
+        Returns: (float) upper bound (in secs) of the bucket holding the
+            percentile, None if no latencies have been recorded (or it is
+            in the unbounded bucket).
+        """
+        total = sum(self.histogram)
+        if total == 0:
+            return None
+
+        rank = total * percent / 100.0
+        running = 0
+        for index, bucket_count in enumerate(self.histogram):
+            running += bucket_count
+            if running >= rank:
+                return bucket_upper_bound(index)
+        #end for
+
+        return None
+    #end def
+
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'ok': self.ok,
+            'timeouts': self.timeouts,
+            'partials': self.partials,
+            'write_errors': self.write_errors,
+            'bytes_out': self.bytes_out,
+            'bytes_in': self.bytes_in,
+            'latency_total': self.latency_total,
+            'latency_mean': self.latency_total / self.ok if self.ok else 0.0,
+            'histogram': list(self.histogram),
+        }
+    #end def
+#end class
+
+
+class ChannelStats(object):
+    """
+    Collects CommandStats per command prefix, and passes each record to
+    any hooks that have been added.
+
+    Recording isn't locked; it is done by whichever thread is using the
+    channel, and channels are used by one thread at a time.
+    """
+    def __init__(self):
+        self._commands = {}
+        self._commands_by_key = {}
+        self._hooks = []
+    #end def
+
+
+    def add_hook(self, hook):
+        """
+        Adds a function that is called after each command is recorded, as
+        hook(prefix, latency, bytes_out, bytes_in, outcome). Hooks run on the
+        channel's thread, so they should be quick.
+        """
+        # replaced rather than changed, so it can be done while another thread records
+        self._hooks = self._hooks + [hook]
+    #end def
+
+
+    def get(self, prefix):
+        """
+        Returns the CommandStats for a prefix (str), or None if no commands
+        with that prefix have been recorded.
+        """
+        return self._commands.get(prefix)
+    #end def
+
+
+    def prometheus_text(self, metric_prefix='portbrain_channel', labels=None):
+        """
+        Formats the stats in the Prometheus text exposition format.
+
+        Args:
+            metric_prefix (str): prefix for the metric names.
+            labels (dict): extra labels added to every sample, e.g. {'port': 'COM3'}
+
+        Returns: (str)
+        """
+        extra = ''.join(',{}="{}"'.format(key, value) for key, value in sorted((labels or {}).items()))
+        lines = []
+
+        counters = [
+            ('commands_total', 'Commands sent', 'count'),
+            ('timeouts_total', 'Commands with no complete response', 'timeouts'),
+            ('partial_responses_total', 'Timed out commands with part of a response', 'partials'),
+            ('write_errors_total', 'Commands that could not be written', 'write_errors'),
+            ('bytes_out_total', 'Bytes written', 'bytes_out'),
+            ('bytes_in_total', 'Response bytes read', 'bytes_in'),
+        ]
+        for name, help_text, attribute in counters:
+            metric = '{}_{}'.format(metric_prefix, name)
+            lines.append('# HELP {} {}'.format(metric, help_text))
+            lines.append('# TYPE {} counter'.format(metric))
+            for prefix, stats in sorted(self._commands.items()):
+                lines.append('{}{{command="{}"{}}} {}'.format(metric, prefix, extra, getattr(stats, attribute)))
+        #end for
+
+        metric = '{}_latency_seconds'.format(metric_prefix)
+        lines.append('# HELP {} Command response latency'.format(metric))
+        lines.append('# TYPE {} histogram'.format(metric))
+        for prefix, stats in sorted(self._commands.items()):
+            cumulative = 0
+            for index, bucket_count in enumerate(stats.histogram):
+                cumulative += bucket_count
+                bound = bucket_upper_bound(index)
+                le = '+Inf' if bound is None else repr(bound)
+                lines.append('{}_bucket{{command="{}"{},le="{}"}} {}'.format(metric, prefix, extra, le, cumulative))
+            #end for
+            lines.append('{}_sum{{command="{}"{}}} {}'.format(metric, prefix, extra, repr(stats.latency_total)))
+            lines.append('{}_count{{command="{}"{}}} {}'.format(metric, prefix, extra, cumulative))
+        #end for
+
+        return '\n'.join(lines) + '\n'
+    #end def
+
+
+    def record(self, cmd, latency, bytes_out, bytes_in, outcome):
+        """
+        Records one command.
+
+        Args:
+            cmd (bytes): command sent, without its terminator.
+            latency (float): time (in secs) from sending it (or, when
+                pipelined, from the previous response if that came later)
+                to its response, or to giving up.
+            bytes_out (int): bytes written.
+            bytes_in (int): response bytes read.
+            outcome (str): one of the OUTCOME_ values. Only successful
+                commands are counted in the latency histogram.
+        """
+        key = cmd.rstrip(_DIGITS)
+        stats = self._commands_by_key.get(key)
+        if stats is None:
+            name = key.decode('ascii', 'replace')
+            stats = self._commands.setdefault(name, CommandStats(name))
+            self._commands_by_key[bytes(key)] = stats
+        #end if
+
+        stats.count += 1
+        stats.bytes_out += bytes_out
+        stats.bytes_in += bytes_in
+        if outcome is OUTCOME_OK:
+            stats.ok += 1
+            stats.latency_total += latency
+            bucket = int(latency * 1000000.0).bit_length()
+            stats.histogram[bucket if bucket < _LAST_BUCKET else _LAST_BUCKET] += 1
+        elif outcome is OUTCOME_TIMEOUT:
+            stats.timeouts += 1
+        elif outcome is OUTCOME_PARTIAL:
+            stats.timeouts += 1
+            stats.partials += 1
+        else:
+            stats.write_errors += 1
+
+        if self._hooks:
+            for hook in self._hooks:
+                hook(stats.name, latency, bytes_out, bytes_in, outcome)
+    #end def
+
+
+    def remove_hook(self, hook):
+        hooks = list(self._hooks)
+        hooks.remove(hook)
+        self._hooks = hooks
+    #end def
+
+
+    def reset(self):
+        """
+        Clears all the stats.
+        """
+        self._commands.clear()
+        self._commands_by_key.clear()
+    #end def
+
+
+    def snapshot(self):
+        """
+        Returns: (dict) prefix -> dict of that prefix's stats (see CommandStats.to_dict())
+        """
+        return {prefix: stats.to_dict() for prefix, stats in self._commands.items()}
+    #end def
+
+
+    @property
+    def prefixes(self):
+        return sorted(self._commands)
+#end class
@@ -3,7 +3,14 @@
 Module that defines class for doing communication with a 
 device over a channel
 """
+from time import perf_counter
+
+from adaptive_timeout import AdaptiveTimeout
+import channel_stats
+from channel_stats import ChannelStats
+from framer import ResponseFramer
 from timeout import Timeout
+from wait_policy import ReadTimeoutWaitPolicy
 
 
 __author__ = 'Scott Pinkham, Byte Arts LLC'
@@ -23,11 +30,47 @@ class DeviceChannel(object):
         self._read_terminator = b'\n'
         self._cmd_terminator = b'\n'
         self._cmd_timeout = 0.3
+        self._bulk_read = True
+        self._pipeline_depth = 0
+        self._wait_policy = self._create_wait_policy()
+        self._framer = ResponseFramer(self._read_terminator)
         self._last_error = ''
+        self._discarded_bytes = 0
+        self._stats = ChannelStats()
+        self._adaptive_timeout = None
         self.flush()
     #end def __init__()
 
 
+    def _create_wait_policy(self):
+        """
+        Creates the policy used to wait for response data. Child classes
+        can override this to supply a policy suited to the channel.
+
+        Returns: (WaitPolicy)
+        """
+        return ReadTimeoutWaitPolicy()
+    #end def
+
+
+    def bytes_available(self):
+        """
+        Returns the number of bytes waiting to be read. This implementation
+        doesn't know, so returns 0 -- child class should override it.
+        """
+        return 0
+    #end def
+
+
+    def byte_time(self):
+        """
+        Returns the time (in secs) it takes to send one byte over the
+        channel, or 0.0 if it isn't known -- child class should override it.
+        """
+        return 0.0
+    #end def
+
+
     def close(self):
         """
         Closes the channel
@@ -36,8 +79,17 @@ class DeviceChannel(object):
     #end def 
 
 
+    def fileno(self):
+        """
+        Returns the OS file descriptor of the channel, or None if it
+        doesn't have one.
+        """
+        return None
+    #end def
+
+
     def flush(self):
-        self._read_buffer = bytearray(0)
+        self._framer.clear()
         self._write_buffer = bytearray(0)
     #end def 
 
@@ -82,6 +134,7 @@ class DeviceChannel(object):
         # update the local copies of settings
         if 'read_terminator' in settings:
             self._read_terminator = settings['read_terminator']
+            self._framer.terminator = self._read_terminator
 
         if 'cmd_terminator' in settings:
             self._cmd_terminator = settings['cmd_terminator']
@@ -89,6 +142,15 @@ class DeviceChannel(object):
         if 'cmd_timeout' in settings:
             self._cmd_timeout = settings['cmd_timeout']
 
+        if 'bulk_read' in settings:
+            self._bulk_read = settings['bulk_read']
+
+        if 'pipeline_depth' in settings:
+            self._pipeline_depth = settings['pipeline_depth']
+
+        if 'adaptive_timeout' in settings:
+            self.adaptive_timeout = settings['adaptive_timeout']
+
         return True
     #end def open()
 
@@ -105,6 +167,42 @@ class DeviceChannel(object):
     #end def read()
 
 
+    def read_available(self, timeout=0.0):
+        """
+        Reads all data that is currently available from the channel. If no
+        data is pending, waits up to timeout secs for some to arrive. This
+        implementation just calls read() -- child class should override it
+        with a bulk read.
+
+        Args:
+            timeout (float): max time to wait (in secs) if no data is pending.
+
+        Returns (tuple): (success, buffer) where success (boolean), buffer (bytes)
+        """
+        return self.read()
+    #end def read_available()
+
+
+    def read_into(self, framer, timeout=0.0):
+        """
+        Reads all available data from the channel into a framer. This
+        implementation appends the data returned by read_available() --
+        child class can override it to read straight into the framer's
+        buffer.
+
+        Args:
+            framer (ResponseFramer): framer to receive the data.
+            timeout (float): max time to wait (in secs) if no data is pending.
+
+        Returns (tuple): (success, count) where success (boolean), count (int)
+        """
+        success, data = self.read_available(timeout)
+        if success:
+            framer.feed(data)
+        return (success, len(data))
+    #end def read_into()
+
+
     def remove_response_from_buffer(self, buffer, terminator=None):
         """
         Parses buffer to get the command response (if any)
@@ -125,6 +223,79 @@ class DeviceChannel(object):
     #end def remove_response_from_buffer()
 
 
+    def _discard_stale_input(self):
+        """
+        Drops input received since the last command finished (late responses
+        to commands that timed out, or unsolicited data), so it can't be
+        taken as the response to the next command. Nothing is counted per
+        command, so a response that never turns up can't throw later ones
+        out of step.
+        """
+        if self._bulk_read:
+            self.read_into(self._framer, 0.0)
+        else:
+            # read() may return a byte at a time, so read what is waiting
+            while self.bytes_available() > 0:
+                success, data = self.read()
+                if not success or not data:
+                    break
+                self._framer.feed(data)
+            #end while
+        #end if
+
+        stale = len(self._framer)
+        if stale > 0:
+            self._discarded_bytes += stale
+            self._framer.clear()
+        #end if
+    #end def
+
+
+    def _read_response(self, cmd_timeout):
+        """
+        Reads from the channel until a complete response has been received,
+        or the timeout expires. Bytes received after the response are kept
+        for the next one.
+
+        Args:
+            cmd_timeout (Timeout): command timeout
+
+        Returns: (bytes) response without its terminator, or None on timeout.
+        """
+        while (True):
+            # check if complete response has been received
+            response = self._framer.next_frame()
+            if response is not None:
+                return response
+
+            # check for timeout, or the channel having closed (e.g. the
+            # device was unplugged)
+            if cmd_timeout.is_expired() or not self.is_open():
+                return None
+
+            # read bytes; in bulk mode, sleep until data arrives (or the
+            # deadline passes) then read everything pending at once
+            if self._bulk_read:
+                read_timeout = self._wait_policy.wait(self, cmd_timeout.remaining())
+                self.read_into(self._framer, read_timeout)
+            else:
+                read_result = self.read()
+                if read_result[0]:
+                    self._framer.feed(read_result[1])
+        #end while
+    #end def
+
+
+    def _timeout_for(self, cmd):
+        """
+        Returns the response timeout (in secs) for a command.
+        """
+        if self._adaptive_timeout is None:
+            return self._cmd_timeout
+        return self._adaptive_timeout.timeout_for(cmd, self._cmd_timeout)
+    #end def
+
+
     def send_command(self, cmd):
         """
         Sends a command to the device over the channel.
@@ -136,35 +307,104 @@ class DeviceChannel(object):
             response (bytes).
         """
         self._last_error = ''
-        self._read_buffer = bytearray(0)
+        self._discard_stale_input()
 
         # send the command
-        if not self.write(cmd + self._cmd_terminator):
+        data = cmd + self._cmd_terminator
+        start = perf_counter()
+        if not self.write(data):
             self._last_error = 'write'
+            self._stats.record(cmd, perf_counter() - start, 0, 0, channel_stats.OUTCOME_WRITE)
             return (False, [])
 
         # wait for the response, or timeout
-        cmd_timeout = Timeout(self._cmd_timeout)
-        while (True):
-            # read bytes
-            read_result = self.read()
-            if read_result[0]:
-                self._read_buffer += read_result[1]
+        cmd_timeout = Timeout(self._timeout_for(cmd))
+        response = self._read_response(cmd_timeout)
+
+        if response is None:
+            self._last_error = 'timeout' if self.is_open() else 'disconnected'
+            partial = self._framer.pending()
+            self._stats.record(cmd, perf_counter() - start, len(data), len(partial),
+                channel_stats.OUTCOME_PARTIAL if partial else channel_stats.OUTCOME_TIMEOUT)
+            return (False, partial)
+        #end if
 
-            # check if complete response has been received
-            if self.is_response_in_buffer(self._read_buffer):
+        self._stats.record(cmd, perf_counter() - start, len(data),
+            len(response) + len(self._read_terminator), channel_stats.OUTCOME_OK)
+        return (True, response)
+    #end def sendcommand()
+
+
+    def send_commands(self, cmds):
+        """
+        Sends several commands to the device over the channel, writing them
+        ahead of their responses instead of waiting for each one in turn.
+        The device answers commands in order, so the responses are matched
+        to the commands by position. At most pipeline_depth commands (0 =
+        no limit) are in flight at a time.
+
+        Args:
+            cmds (list): list of commands (bytes) to send
+
+        Returns: (list): list of (success, response) tuples, in the same
+            order as cmds.
+        """
+        self._last_error = ''
+        results = []
+        count = len(cmds)
+        depth = self._pipeline_depth if self._pipeline_depth > 0 else count
+        sent = 0
+        self._discard_stale_input()
+
+        cmd_timeout = Timeout(self._timeout_for(cmds[0]) if count else self._cmd_timeout)
+        sent_times = []
+        last_response_time = 0.0
+        while len(results) < count:
+            # top up the commands in flight
+            if sent < count and sent - len(results) < depth:
+                batch_end = min(count, len(results) + depth)
+                data = b''.join([cmd + self._cmd_terminator for cmd in cmds[sent:batch_end]])
+                start = perf_counter()
+                if not self.write(data):
+                    self._last_error = 'write'
+                    for cmd in cmds[sent:batch_end]:
+                        self._stats.record(cmd, 0.0, 0, 0, channel_stats.OUTCOME_WRITE)
+                    break
+                #end if
+                sent_times.extend([start] * (batch_end - sent))
+                sent = batch_end
+            #end if
+
+            # each response is due within its timeout of the previous one, so
+            # its latency is counted from then (or from when it was sent)
+            cmd = cmds[len(results)]
+            bytes_out = len(cmd) + len(self._cmd_terminator)
+            response = self._read_response(cmd_timeout)
+            response_time = perf_counter()
+            latency = response_time - max(sent_times[len(results)], last_response_time)
+            last_response_time = response_time
+            if response is None:
+                self._last_error = 'timeout' if self.is_open() else 'disconnected'
+                partial = self._framer.pending()
+                self._stats.record(cmd, latency, bytes_out, len(partial),
+                    channel_stats.OUTCOME_PARTIAL if partial else channel_stats.OUTCOME_TIMEOUT)
+                results.append((False, partial))
                 break
+            #end if
 
-            # check for timeout
-            if cmd_timeout.is_expired():
-                self._last_error = 'timeout'
-                return (False, self._read_buffer)
+            self._stats.record(cmd, latency, bytes_out, len(response) + len(self._read_terminator),
+                channel_stats.OUTCOME_OK)
+            results.append((True, response))
+            if len(results) < count:
+                cmd_timeout.reset(self._timeout_for(cmds[len(results)]))
         #end while
 
-        # parse any command response from the buffer and return it
-        parse_result = self.remove_response_from_buffer(self._read_buffer, self._read_terminator)
-        return (True, parse_result[0])
-    #end def sendcommand()
+        # anything not answered has failed
+        while len(results) < count:
+            results.append((False, bytes(0)))
+
+        return results
+    #end def send_commands()
 
 
     def write(self, data):
@@ -179,7 +419,67 @@ class DeviceChannel(object):
     #end def write()
 
 
+    @property
+    def adaptive_timeout(self):
+        """
+        AdaptiveTimeout that sets the response timeouts, None if cmd_timeout
+        is used for every command. Can be set to True to use a default
+        AdaptiveTimeout, or False/None to turn it off.
+        """
+        return self._adaptive_timeout
+
+
+    @adaptive_timeout.setter
+    def adaptive_timeout(self, value):
+        if self._adaptive_timeout is not None:
+            self._stats.remove_hook(self._adaptive_timeout.record)
+
+        if value is True:
+            value = AdaptiveTimeout()
+        self._adaptive_timeout = value or None
+
+        if self._adaptive_timeout is not None:
+            self._stats.add_hook(self._adaptive_timeout.record)
+    #end def
+
+
+    @property
+    def cmd_timeout(self):
+        return self._cmd_timeout
+
+
+    @cmd_timeout.setter
+    def cmd_timeout(self, value):
+        self._cmd_timeout = value
+
+
+    @property
+    def discarded_bytes(self):
+        """
+        Number of stale bytes dropped before sending commands.
+        """
+        return self._discarded_bytes
+
+
     @property 
     def last_error(self):
         return self._last_error
+
+
+    @property
+    def stats(self):
+        """
+        Per-command statistics (ChannelStats) of the commands sent.
+        """
+        return self._stats
+
+
+    @property
+    def wait_policy(self):
+        return self._wait_policy
+
+
+    @wait_policy.setter
+    def wait_policy(self, policy):
+        self._wait_policy = policy
 #end class TDeviceChannel
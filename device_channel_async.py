@@ -0,0 +1,424 @@
+# !python3
+"""
+Module that defines asyncio counterparts of the DeviceChannel classes.
+
+Instead of blocking in read calls, the channels register the device's file
+descriptor with the event loop and feed received bytes into a framer as
+they arrive. Command timeouts are loop deadlines (loop.call_at), so one
+event loop can drive many devices without a thread per device.
+"""
+
+import asyncio
+import os
+import select
+
+from framer import ResponseFramer
+import serial_utils
+
+__author__ = 'Scott Pinkham, Byte Arts LLC'
+__version__ = '2019.513.0'
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+#end def
+
+
+class AsyncDeviceChannel(object):
+    """
+    Abstract class that defines an asyncio channel used to communicate with
+    a device. Child class should implement _open_device(), _close_device()
+    and write(), and pass received bytes to _data_received().
+    """
+
+    def __init__(self):
+        self._is_open = False
+        self._loop = None
+        self._open_settings = {}
+        self._read_terminator = b'\n'
+        self._cmd_terminator = b'\n'
+        self._cmd_timeout = 0.3
+        self._pipeline_depth = 0
+        self._framer = ResponseFramer(self._read_terminator)
+        self._waiter = None
+        self._lock = None
+        self._last_error = ''
+        self._discarded_bytes = 0
+        self.flush()
+    #end def __init__()
+
+
+    def _close_device(self):
+        """
+        Closes the underlying device. Child class should implement this.
+        """
+        pass
+    #end def
+
+
+    def _data_received(self, data=None):
+        """
+        Called by the child class when data has been received. The data
+        is added to the framer, unless it was read straight into it.
+        """
+        if data:
+            self._framer.feed(data)
+
+        if self._waiter is not None:
+            _wake(self._waiter)
+    #end def
+
+
+    def _connection_lost(self):
+        """
+        Called by the child class when the device has gone away.
+        """
+        self.close()
+        self._last_error = 'disconnected'
+    #end def
+
+
+    def _discard_stale_input(self):
+        """
+        Drops input received since the last command finished (late responses
+        to commands that timed out, or unsolicited data), so it can't be
+        taken as the response to the next command. See
+        DeviceChannel._discard_stale_input().
+        """
+        self._read_pending()
+
+        stale = len(self._framer)
+        if stale > 0:
+            self._discarded_bytes += stale
+            self._framer.clear()
+        #end if
+    #end def
+
+
+    async def _open_device(self, settings) -> bool:
+        """
+        Opens the underlying device. Child class should implement this.
+        """
+        return True
+    #end def
+
+
+    def _read_pending(self):
+        """
+        Adds bytes that have arrived but not yet been handed over by the
+        event loop to the framer, without waiting. Child class should
+        implement this if it can.
+        """
+        pass
+    #end def
+
+
+    async def _read_response(self, deadline):
+        """
+        Waits until a complete response has been received, or the deadline
+        (loop time) passes.
+
+        Returns: (bytes) response without its terminator, or None on timeout.
+        """
+        while (True):
+            response = self._framer.next_frame()
+            if response is not None:
+                return response
+
+            if not self._is_open or self._loop.time() >= deadline:
+                return None
+
+            # sleep until data arrives or the deadline passes
+            self._waiter = self._loop.create_future()
+            timer = self._loop.call_at(deadline, _wake, self._waiter)
+            try:
+                await self._waiter
+            finally:
+                timer.cancel()
+                self._waiter = None
+        #end while
+    #end def
+
+
+    def close(self):
+        """
+        Closes the channel
+        """
+        if self._is_open:
+            self._is_open = False
+            self._close_device()
+
+        if self._waiter is not None:
+            _wake(self._waiter)
+    #end def
+
+
+    def flush(self):
+        self._framer.clear()
+    #end def
+
+
+    def is_open(self):
+        """
+        Returns True if the channel is open
+        """
+        return self._is_open
+    #end def
+
+
+    async def open(self, settings) -> bool:
+        """
+        Opens a channel using the specified settings. Uses the same settings
+        as DeviceChannel.open().
+
+        Returns: bool
+        """
+        self._open_settings = dict(settings)
+
+        if 'read_terminator' in settings:
+            self._read_terminator = settings['read_terminator']
+            self._framer.terminator = self._read_terminator
+
+        if 'cmd_terminator' in settings:
+            self._cmd_terminator = settings['cmd_terminator']
+
+        if 'cmd_timeout' in settings:
+            self._cmd_timeout = settings['cmd_timeout']
+
+        if 'pipeline_depth' in settings:
+            self._pipeline_depth = settings['pipeline_depth']
+
+        self._loop = asyncio.get_event_loop()
+        self._lock = asyncio.Lock()
+        self.flush()
+
+        self._is_open = await self._open_device(settings)
+        return self._is_open
+    #end def open()
+
+
+    async def send_command(self, cmd):
+        """
+        Sends a command to the device over the channel and waits for the
+        response.
+
+        Args:
+            cmd (bytes): data to write
+
+        Returns: (tuple): (success, response) where success (bool),
+            response (bytes).
+        """
+        return (await self.send_commands([cmd]))[0]
+    #end def
+
+
+    async def send_commands(self, cmds):
+        """
+        Sends several commands to the device, writing them ahead of their
+        responses. See DeviceChannel.send_commands().
+
+        Args:
+            cmds (list): list of commands (bytes) to send
+
+        Returns: (list): list of (success, response) tuples, in the same
+            order as cmds.
+        """
+        if not self._is_open:
+            self._last_error = 'closed'
+            return [(False, bytes(0))] * len(cmds)
+
+        # one command (or batch) at a time, so responses stay in order
+        async with self._lock:
+            self._last_error = ''
+            results = []
+            count = len(cmds)
+            depth = self._pipeline_depth if self._pipeline_depth > 0 else count
+            sent = 0
+
+            self._discard_stale_input()
+
+            deadline = self._loop.time() + self._cmd_timeout
+            while len(results) < count:
+                # top up the commands in flight
+                if sent < count and sent - len(results) < depth:
+                    batch_end = min(count, len(results) + depth)
+                    data = b''.join([cmd + self._cmd_terminator for cmd in cmds[sent:batch_end]])
+                    if not await self.write(data):
+                        self._last_error = 'write'
+                        break
+                    sent = batch_end
+                #end if
+
+                # each response is due within cmd_timeout of the previous one
+                response = await self._read_response(deadline)
+                if response is None:
+                    # keep 'disconnected' if the connection was lost while waiting
+                    if not self._last_error:
+                        self._last_error = 'timeout'
+                    results.append((False, self._framer.pending()))
+                    break
+                #end if
+
+                results.append((True, response))
+                deadline = self._loop.time() + self._cmd_timeout
+            #end while
+        #end with
+
+        # anything not answered has failed
+        while len(results) < count:
+            results.append((False, bytes(0)))
+
+        return results
+    #end def send_commands()
+
+
+    async def write(self, data) -> bool:
+        """
+        Writes data to channel. This implementation just
+        checks if the channel is open or not -- child class
+        should implement the actual write.
+
+        Returns (bool): True if channel is open
+        """
+        return self._is_open
+    #end def
+
+
+    @property
+    def discarded_bytes(self):
+        return self._discarded_bytes
+
+
+    @property
+    def last_error(self):
+        return self._last_error
+#end class
+
+
+class AsyncSerialChannel(AsyncDeviceChannel):
+    """
+    asyncio channel over a serial port. The port is opened and configured
+    with pyserial, then its file descriptor is driven by the event loop's
+    reader and writer callbacks.
+    """
+    READ_SIZE = 1024
+
+    def __init__(self):
+        self._serial_port = None
+        self._serial_port_name = ''
+        self._serial_port_settings = 'baud=9600,databits=8,parity=N,stopbits=1'
+        self._fd = None
+        self._write_waiter = None
+        super(AsyncSerialChannel, self).__init__()
+    #end def
+
+
+    def _close_device(self):
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            self._loop.remove_writer(self._fd)
+            self._fd = None
+
+        if self._write_waiter is not None:
+            _wake(self._write_waiter)
+
+        if self._serial_port:
+            self._serial_port.close()
+            self._serial_port = None
+    #end def
+
+
+    def _on_readable(self):
+        view = self._framer.writable(AsyncSerialChannel.READ_SIZE)
+        try:
+            count = os.readv(self._fd, [view])
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            count = 0
+        finally:
+            view.release()
+
+        if count <= 0:
+            # readable but no data, so the device has gone
+            self._connection_lost()
+            return
+
+        self._framer.commit(count)
+        self._data_received()
+    #end def
+
+
+    def _read_pending(self):
+        # only read when the fd is readable: with VMIN=0, an empty read
+        # isn't an error, but _on_readable() takes it as the device gone
+        while self._fd is not None and select.select([self._fd], [], [], 0)[0]:
+            before = len(self._framer)
+            self._on_readable()
+            if len(self._framer) - before < AsyncSerialChannel.READ_SIZE:
+                break
+        #end while
+    #end def
+
+
+    async def _open_device(self, settings) -> bool:
+        if 'portsettings' in settings:
+            self._serial_port_settings = settings['portsettings']
+
+        if 'portname' in settings:
+            self._serial_port_name = settings['portname']
+
+        self._serial_port = serial_utils.open_serial_port(self._serial_port_name, self._serial_port_settings)
+        if not self._serial_port:
+            return False
+
+        serial_utils.flush_port(self._serial_port)
+        self._fd = self._serial_port.fileno()
+        os.set_blocking(self._fd, False)
+        self._loop.add_reader(self._fd, self._on_readable)
+        return True
+    #end def
+
+
+    async def write(self, data) -> bool:
+        """
+        Writes to the serial port, waiting for the port to become writable
+        if its output buffer is full.
+
+        Args:
+            data (bytes)
+        """
+        view = memoryview(data)
+        while len(view) > 0:
+            if not self._is_open:
+                return False
+
+            try:
+                count = os.write(self._fd, view)
+            except (BlockingIOError, InterruptedError):
+                count = 0
+            except OSError:
+                return False
+
+            view = view[count:]
+            if len(view) > 0:
+                self._write_waiter = self._loop.create_future()
+                self._loop.add_writer(self._fd, _wake, self._write_waiter)
+                try:
+                    await self._write_waiter
+                finally:
+                    self._write_waiter = None
+                    if self._fd is not None:
+                        self._loop.remove_writer(self._fd)
+            #end if
+        #end while
+
+        return True
+    #end def
+
+
+    @property
+    def name(self):
+        return self._open_settings['portname']
+#end class
@@ -0,0 +1,662 @@
+# !python3
+"""
+This module records the traffic of a DeviceChannel to a file, and replays
+a recording as a DeviceChannel, so problems seen on a production rig can
+be reproduced (and parsing and framing benchmarked against real traffic)
+without hardware.
+
+A recording is an 8 byte file header followed by frames, each one a
+RECORD header (timestamp, kind, length) and the frame's bytes: a command
+(FRAME_TX) or a response (FRAME_RX), without terminators, or the partial
+response of a command that failed (FRAME_RX_FAILED). Timestamps are wall
+clock secs, taken with perf_counter() so they are as fine as it is.
+Recordings are only ever appended to.
+
+Usage:
+    channel = RecordingChannel(channel, 'rig.pbrec')
+    ...
+    replay = ReplayChannel()
+    replay.open({'path': 'rig.pbrec', 'speed': 10.0})
+"""
+
+from collections import deque, namedtuple
+import mmap
+import struct
+import threading
+from time import perf_counter, sleep, time
+
+from device_channel import DeviceChannel
+
+__author__ = 'Scott Pinkham, Byte Arts LLC'
+__version__ = '2019.513.0'
+
+FILE_HEADER = struct.Struct('<6sH')
+FILE_MAGIC = b'PBREC\0'
+FILE_VERSION = 1
+
+# frame header: timestamp (secs), kind, length (bytes)
+RECORD = struct.Struct('<dBH')
+MAX_FRAME_LENGTH = 0xFFFF
+
+# frame kinds
+FRAME_TX = 0
+FRAME_RX = 1
+FRAME_RX_FAILED = 2
+
+# a frame read back from a recording
+Frame = namedtuple('Frame', ['timestamp', 'kind', 'data'])
+
+
+def _check_header(data, path):
+    """
+    Raises ValueError if data doesn't start with a recording's file header.
+    """
+    if len(data) < FILE_HEADER.size:
+        raise ValueError('{} is not a recording'.format(path))
+    magic, version = FILE_HEADER.unpack_from(data)
+    if magic != FILE_MAGIC:
+        raise ValueError('{} is not a recording'.format(path))
+    if version != FILE_VERSION:
+        raise ValueError('{} is a version {} recording, not {}'.format(path, version, FILE_VERSION))
+#end def
+
+
+def _frames(data):
+    """
+    Yields the (timestamp, kind, offset, length) of each frame in a
+    recording's data, after the file header. A frame cut short at the end
+    (e.g. by a crash while it was being written) is left out.
+    """
+    offset = FILE_HEADER.size
+    end = len(data)
+    while offset + RECORD.size <= end:
+        timestamp, kind, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + length > end:
+            break
+        yield (timestamp, kind, offset, length)
+        offset += length
+    #end while
+#end def
+
+
+def read_recording(path):
+    """
+    Reads the frames of a recording.
+
+    Args:
+        path (str): recording file
+
+    Returns:
+        (list) -- list of Frame tuples, in the order they were recorded.
+
+    Raises: ValueError if the file isn't a recording, OSError if it can't be read.
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    _check_header(data, path)
+    return [Frame(timestamp, kind, data[offset:offset + length])
+        for timestamp, kind, offset, length in _frames(data)]
+#end def
+
+
+class RecordingChannel(DeviceChannel):
+    """
+    Channel that passes its commands on to another channel, and records
+    each command and response to a file. Frames are collected in memory
+    and appended to the file in batches, once flush_size bytes have built
+    up or flush_interval secs have passed, and when the channel is closed.
+
+    Recording is done at the command level, so any channel can be
+    recorded, including ThreadedChannel and DaemonChannel. The commands of
+    one send_commands() call are recorded as sent when the call starts,
+    and each response as received when the wrapped channel records its
+    stats, or when the call returns if it doesn't (e.g. DaemonChannel).
+
+    Args:
+        channel (DeviceChannel): channel to record, open or not.
+        path (str): recording file; frames are appended if it already exists.
+        flush_size (int): bytes of frames held in memory before they are written.
+        flush_interval (float): max time (in secs) frames are held in memory.
+
+    Raises: ValueError if path exists but isn't a recording, OSError if it
+        can't be opened.
+    """
+    def __init__(self, channel, path, flush_size=65536, flush_interval=1.0):
+        self._channel = channel
+        self._path = path
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._frames = 0
+        self._bytes_written = 0
+
+        # wall clock time of perf_counter() == 0
+        self._time_offset = time() - perf_counter()
+
+        self._file = open(path, 'ab', buffering=0)
+        if self._file.tell() == 0:
+            self._file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION))
+        else:
+            with open(path, 'rb') as file:
+                header = file.read(FILE_HEADER.size)
+            try:
+                _check_header(header, path)
+            except ValueError:
+                self._file.close()
+                raise
+        #end if
+
+        self._last_write = perf_counter()
+        super(RecordingChannel, self).__init__()
+    #end def
+
+
+    def _record(self, frames):
+        """
+        Adds (timestamp, kind, data) frames to the buffer, writing the buffer
+        out if it is due.
+        """
+        with self._lock:
+            if self._file is None:
+                return
+
+            for timestamp, kind, data in frames:
+                length = min(len(data), MAX_FRAME_LENGTH)
+                self._buffer += RECORD.pack(timestamp + self._time_offset, kind, length)
+                self._buffer += data[:length]
+            #end for
+            self._frames += len(frames)
+
+            if len(self._buffer) >= self._flush_size or \
+                    perf_counter() - self._last_write >= self._flush_interval:
+                self._write_buffer_out()
+        #end with
+    #end def
+
+
+    def _write_buffer_out(self):
+        """
+        Appends the buffered frames to the file. Called with the lock held.
+        """
+        if self._buffer and self._file is not None:
+            self._file.write(self._buffer)
+            self._bytes_written += len(self._buffer)
+            self._buffer = bytearray()
+        #end if
+        self._last_write = perf_counter()
+    #end def
+
+
+    def bytes_available(self):
+        return self._channel.bytes_available()
+    #end def
+
+
+    def byte_time(self):
+        return self._channel.byte_time()
+    #end def
+
+
+    def close(self):
+        """
+        Closes the wrapped channel, and writes out and closes the recording.
+        """
+        self._channel.close()
+
+        with self._lock:
+            if self._file is not None:
+                self._write_buffer_out()
+                self._file.close()
+                self._file = None
+        #end with
+
+        super(RecordingChannel, self).close()
+    #end def
+
+
+    def flush(self):
+        super(RecordingChannel, self).flush()
+        if getattr(self, '_channel', None) is not None:
+            self._channel.flush()
+    #end def
+
+
+    def flush_recording(self):
+        """
+        Writes the buffered frames to the file now.
+        """
+        with self._lock:
+            self._write_buffer_out()
+    #end def
+
+
+    def is_open(self):
+        return self._channel.is_open()
+    #end def
+
+
+    def open(self, settings):
+        """
+        Opens the wrapped channel.
+
+        Returns: bool
+        """
+        super(RecordingChannel, self).open(settings)
+        return self._channel.open(settings)
+    #end def
+
+
+    def read(self):
+        return (False, bytes(0))
+    #end def
+
+
+    def send_command(self, cmd):
+        """
+        Sends a command with the wrapped channel and records it and its response.
+
+        Returns: (tuple): (success, response)
+        """
+        start = perf_counter()
+        success, response = self._channel.send_command(cmd)
+        self._record([(start, FRAME_TX, cmd),
+            (perf_counter(), FRAME_RX if success else FRAME_RX_FAILED, response)])
+        return (success, response)
+    #end def
+
+
+    def send_commands(self, cmds):
+        """
+        Sends several commands with the wrapped channel and records them and
+        their responses.
+
+        Returns: (list): list of (success, response) tuples, in the same
+            order as cmds.
+        """
+        if not cmds:
+            return []
+
+        # the wrapped channel records the stats of each response as it completes
+        response_times = []
+        def record_time(prefix, latency, bytes_out, bytes_in, outcome):
+            response_times.append(perf_counter())
+
+        stats = self._channel.stats
+        stats.add_hook(record_time)
+        start = perf_counter()
+        try:
+            results = self._channel.send_commands(cmds)
+        finally:
+            stats.remove_hook(record_time)
+        end = perf_counter()
+        response_times.extend([end] * (len(results) - len(response_times)))
+
+        frames = [(start, FRAME_TX, cmd) for cmd in cmds]
+        frames.extend([(response_time, FRAME_RX if success else FRAME_RX_FAILED, response)
+            for response_time, (success, response) in zip(response_times, results)])
+        self._record(frames)
+        return results
+    #end def
+
+
+    def write(self, data):
+        return self._channel.write(data)
+    #end def
+
+
+    @property
+    def channel(self):
+        return self._channel
+
+
+    @property
+    def cmd_timeout(self):
+        return self._channel.cmd_timeout
+
+
+    @cmd_timeout.setter
+    def cmd_timeout(self, value):
+        self._channel.cmd_timeout = value
+
+
+    @property
+    def discarded_bytes(self):
+        return self._channel.discarded_bytes
+
+
+    @property
+    def last_error(self):
+        return self._channel.last_error
+
+
+    @property
+    def name(self):
+        return getattr(self._channel, 'name', '')
+
+
+    @property
+    def path(self):
+        return self._path
+
+
+    @property
+    def recording_stats(self):
+        """
+        Returns dict with the number of frames recorded, bytes written to
+        the file, and bytes waiting to be written.
+        """
+        with self._lock:
+            return {'frames': self._frames, 'bytes written': self._bytes_written,
+                'buffered': len(self._buffer)}
+
+
+    @property
+    def stats(self):
+        return self._channel.stats
+#end class
+
+
+class _Exchange(object):
+    """
+    A recorded command and its response.
+    """
+    __slots__ = ('cmd_time', 'cmd', 'response_time', 'response', 'success')
+
+    def __init__(self, cmd_time, cmd):
+        self.cmd_time = cmd_time
+        self.cmd = cmd
+        self.response_time = None
+        self.response = None
+        self.success = False
+    #end def
+#end class
+
+
+class ReplayChannel(DeviceChannel):
+    """
+    Channel that plays back a recording. The recording is memory-mapped,
+    and each command written gets the response recorded for the next
+    command in the recording, once the time that response originally took
+    has passed (divided by the speed setting). Response bytes are copied
+    straight from the mapped file into the response framer.
+
+    Commands are answered in recorded order whatever they are; commands
+    that don't match the recording are counted (see replay_stats). Commands
+    that failed when recorded get their partial response, or nothing, so
+    they time out again. Once the recording runs out, commands aren't
+    answered.
+    """
+
+    def __init__(self):
+        self._path = ''
+        self._speed = 1.0
+        self._file = None
+        self._mmap = None
+        self._view = None
+        self._exchanges = []
+        self._position = 0
+        self._mismatches = 0
+        self._responses = deque()
+        self._rx_buffer = bytearray()
+        self._ready_until = 0.0
+        super(ReplayChannel, self).__init__()
+    #end def
+
+
+    def _load(self, path):
+        """
+        Maps a recording and pairs its commands with their responses; the
+        device answers commands in order, so each response belongs to the
+        oldest command not yet answered.
+
+        Raises: ValueError if the file isn't a recording, OSError if it can't be read.
+        """
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        _check_header(self._view, path)
+
+        exchanges = []
+        unanswered = deque()
+        for timestamp, kind, offset, length in _frames(self._view):
+            if kind == FRAME_TX:
+                exchange = _Exchange(timestamp, (offset, length))
+                exchanges.append(exchange)
+                unanswered.append(exchange)
+            elif unanswered:
+                exchange = unanswered.popleft()
+                exchange.response_time = timestamp
+                exchange.response = (offset, length)
+                exchange.success = kind == FRAME_RX
+            #end if
+        #end for
+
+        self._exchanges = exchanges
+    #end def
+
+
+    def _unload(self):
+        self._exchanges = []
+        self._responses.clear()
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+    #end def
+
+
+    def _wait_for_response(self, timeout):
+        """
+        Sleeps until the next response is ready, or the timeout expires.
+
+        Returns: (float) the time now.
+        """
+        now = perf_counter()
+        if timeout > 0 and (not self._responses or self._responses[0][0] > now):
+            wake_time = now + timeout
+            if self._responses:
+                wake_time = min(wake_time, self._responses[0][0])
+            sleep(max(0.0, wake_time - now))
+            now = perf_counter()
+        #end if
+        return now
+    #end def
+
+
+    def bytes_available(self):
+        now = perf_counter()
+        return sum(len(data) for ready_time, data in self._responses if ready_time <= now)
+    #end def
+
+
+    def close(self):
+        self._unload()
+        super(ReplayChannel, self).close()
+    #end def
+
+
+    def flush(self):
+        super(ReplayChannel, self).flush()
+        self._responses.clear()
+        self._rx_buffer = bytearray()
+    #end def
+
+
+    def open(self, settings):
+        """
+        Opens a recording for playback.
+
+        Args:
+            settings = {path: <recording file>,
+                speed: <playback speed, e.g. 10.0 for ten times faster (0 = no delays)>}
+            plus the DeviceChannel settings; the terminators must be the
+            ones of the recorded device.
+
+        Returns: bool -- False if the file can't be read or isn't a recording.
+        """
+        super(ReplayChannel, self).open(settings)
+        self.close()
+
+        self._path = settings.get('path', self._path)
+        self._speed = settings.get('speed', self._speed)
+
+        try:
+            self._load(self._path)
+        except (OSError, ValueError) as err:
+            self._last_error = str(err)
+            self._unload()
+            return False
+        #end try..except
+
+        self._position = 0
+        self._mismatches = 0
+        self._ready_until = 0.0
+        self._channel_handle = DeviceChannel.VALID_HANDLE
+        self.flush()
+        return True
+    #end def
+
+
+    def read(self, count=1):
+        """
+        Reads up to count bytes of the responses that are ready.
+
+        Returns: (tuple) - (success, data), where success (bool), data (bytes)
+        """
+        success, data = self.read_available()
+        if len(data) > count:
+            # put the rest back for the next read
+            self._responses.appendleft((0.0, memoryview(data)[count:]))
+            data = data[:count]
+        return (len(data) > 0, data)
+    #end def
+
+
+    def read_available(self, timeout=0.0):
+        """
+        Reads all the response bytes that are ready, waiting up to timeout
+        secs for the next response if none are.
+
+        Returns: (tuple) - (success, data), where success (bool), data (bytes)
+        """
+        if not self.is_open():
+            return (False, bytes(0))
+
+        now = self._wait_for_response(timeout)
+        chunks = []
+        while self._responses and self._responses[0][0] <= now:
+            chunks.append(self._responses.popleft()[1])
+
+        data = b''.join(chunks)
+        return (len(data) > 0, data)
+    #end def
+
+
+    def read_into(self, framer, timeout=0.0):
+        """
+        Copies the response bytes that are ready from the recording into the
+        framer, waiting up to timeout secs for the next response if none are.
+
+        Returns: (tuple) - (success, count), where success (bool), count (int)
+        """
+        if not self.is_open():
+            return (False, 0)
+
+        now = self._wait_for_response(timeout)
+        count = 0
+        while self._responses and self._responses[0][0] <= now:
+            data = self._responses.popleft()[1]
+            framer.feed(data)
+            count += len(data)
+        #end while
+
+        return (count > 0, count)
+    #end def
+
+
+    def rewind(self):
+        """
+        Starts the playback over from the first command.
+        """
+        self._position = 0
+        self._ready_until = 0.0
+        self.flush()
+    #end def
+
+
+    def write(self, data):
+        """
+        Takes commands, and queues the recorded response of each complete one.
+
+        Args:
+            data (bytes)
+        """
+        if not self.is_open():
+            return False
+
+        now = perf_counter()
+        self._rx_buffer += data
+        while True:
+            cmd, found, remainder = self._rx_buffer.partition(self._cmd_terminator)
+            if not found:
+                break
+            self._rx_buffer = remainder
+
+            if self._position >= len(self._exchanges):
+                # the recording has run out
+                continue
+            exchange = self._exchanges[self._position]
+            self._position += 1
+
+            offset, length = exchange.cmd
+            if self._view[offset:offset + length] != cmd:
+                self._mismatches += 1
+            if exchange.response is None:
+                continue
+
+            # responses come in order, each after its recorded delay
+            delay = exchange.response_time - exchange.cmd_time
+            ready_time = now + delay / self._speed if self._speed > 0 else now
+            ready_time = max(ready_time, self._ready_until)
+            self._ready_until = ready_time
+
+            offset, length = exchange.response
+            if length > 0:
+                self._responses.append((ready_time, self._view[offset:offset + length]))
+            if exchange.success:
+                self._responses.append((ready_time, self._read_terminator))
+        #end while
+
+        return True
+    #end def
+
+
+    @property
+    def finished(self):
+        """
+        True once every recorded command has been played back.
+        """
+        return self._position >= len(self._exchanges)
+
+
+    @property
+    def name(self):
+        return self._path
+
+
+    @property
+    def replay_stats(self):
+        """
+        Returns dict with the number of recorded commands, commands played
+        back, and commands that didn't match the recording.
+        """
+        return {'commands': len(self._exchanges), 'played': self._position,
+            'mismatches': self._mismatches}
+#end class
@@ -3,7 +3,11 @@
 This module implements the DeviceChannel class over a serial connection.
 """
 
+import math
+import os
+
 from device_channel import DeviceChannel
+from wait_policy import ReadTimeoutWaitPolicy, SelectWaitPolicy
 import serial_utils
 
 __author__ = 'Scott Pinkham, Byte Arts LLC'
@@ -14,14 +18,27 @@ class SerialChannel(DeviceChannel):
     """
     Class for handling serial port i/o.
     """
+    # read timeouts are rounded up to this resolution (in secs) so that the port
+    # isn't reconfigured on every read while waiting for a response
+    READ_TIMEOUT_RESOLUTION = 0.01
 
     def __init__(self):
         self._serial_port = None
         self._serial_port_name = ''
         self._serial_port_settings = 'baud=9600 data size=8 parity=n stop bits=1'
+        self._read_timeout = None
         super(SerialChannel, self).__init__()
     #end def
 
+    def _create_wait_policy(self):
+        # on posix the port's fd can be waited on directly, which avoids
+        # reconfiguring the port's read timeout
+        if os.name == 'posix':
+            return SelectWaitPolicy()
+        return ReadTimeoutWaitPolicy()
+    #end def
+
+
     def _on_connected(self):
         pass
     #end def
@@ -32,15 +49,47 @@ class SerialChannel(DeviceChannel):
     #end def
 
 
+    def bytes_available(self):
+        if not self.is_open():
+            return 0
+
+        try:
+            return self._serial_port.in_waiting
+        except:
+            return 0
+    #end def
+
+
+    def byte_time(self):
+        try:
+            return serial_utils.byte_time(self._serial_port_settings)
+        except ValueError:
+            return 0.0
+    #end def
+
+
     def close(self):
         if self._serial_port:
             self._serial_port.close()
             self._serial_port = None
+            self._read_timeout = None
 
         super(SerialChannel, self).close() # invalidates the handle
     #end def
 
 
+    def fileno(self):
+        if not self._serial_port:
+            return None
+
+        try:
+            return self._serial_port.fileno()
+        except:
+            # not supported on this platform
+            return None
+    #end def
+
+
     def flush(self):
         super(SerialChannel, self).flush()
         serial_utils.flush_port(self._serial_port)
@@ -69,6 +118,7 @@ class SerialChannel(DeviceChannel):
 
         if self._serial_port:
             self._channel_handle = DeviceChannel.VALID_HANDLE
+            self._read_timeout = self._serial_port.timeout
             self.flush()
         else:
             self._channel_handle = DeviceChannel.INVALID_HANDLE
@@ -96,6 +146,85 @@ class SerialChannel(DeviceChannel):
     #end def
 
 
+    def read_available(self, timeout=0.0):
+        """
+        Reads all bytes waiting in the serial port's input buffer with a single
+        read. If nothing is waiting, blocks up to timeout secs for the first
+        byte to arrive and then drains whatever followed it.
+
+        Args:
+            timeout (float): max time to wait (in secs) if no data is pending.
+
+        Returns: (tuple) - (success, data), where success (bool), data (bytes)
+        """
+        if not self.is_open():
+            return (False, bytes(0))
+
+        try:
+            waiting = self._serial_port.in_waiting
+            if waiting > 0:
+                data = self._serial_port.read(waiting)
+                return (len(data) > 0, data)
+
+            if timeout <= 0:
+                return (False, bytes(0))
+
+            # nothing pending, so block (in the OS) for the first byte
+            self._set_read_timeout(timeout)
+            data = self._serial_port.read(1)
+            if data:
+                waiting = self._serial_port.in_waiting
+                if waiting > 0:
+                    data += self._serial_port.read(waiting)
+            #end if
+
+            return (len(data) > 0, data)
+        except:
+            return (False, bytes(0))
+        #end try..except
+    #end def
+
+
+    def read_into(self, framer, timeout=0.0):
+        """
+        Reads the bytes waiting in the serial port's input buffer straight
+        into the framer's buffer, when the port has a file descriptor.
+        Otherwise falls back to read_available().
+
+        Returns: (tuple) - (success, count), where success (bool), count (int)
+        """
+        fd = self.fileno()
+        waiting = self.bytes_available()
+        if fd is None or waiting <= 0:
+            return super(SerialChannel, self).read_into(framer, timeout)
+
+        view = framer.writable(waiting)
+        try:
+            count = os.readv(fd, [view])
+        except OSError:
+            count = 0
+        finally:
+            view.release()
+
+        framer.commit(count)
+        return (count > 0, count)
+    #end def
+
+
+    def _set_read_timeout(self, timeout):
+        """
+        Sets the serial port's read timeout, only touching the port if the
+        (rounded) value has changed.
+        """
+        resolution = SerialChannel.READ_TIMEOUT_RESOLUTION
+        timeout = math.ceil(timeout / resolution) * resolution
+
+        if timeout != self._read_timeout:
+            self._serial_port.timeout = timeout
+            self._read_timeout = timeout
+    #end def
+
+
     def write(self, data):
         """
         Write to serial port.
@@ -0,0 +1,244 @@
+# !python3
+"""
+This module implements the DeviceChannel class over a simulated PortBrain,
+for benchmarking and load testing without hardware.
+"""
+
+from collections import deque
+import random
+from time import perf_counter, sleep
+
+from device_channel import DeviceChannel
+from portbrain import PortBrainController
+from portbrain_firmware import PortBrainFirmware
+
+__author__ = 'Scott Pinkham, Byte Arts LLC'
+__version__ = '2019.513.0'
+
+
+class SimulatedChannel(DeviceChannel):
+    """
+    Channel to an in-process simulated PortBrain. Commands are run by a
+    PortBrainFirmware model as soon as they are written, and their responses
+    become readable when the simulated board would have sent them: after
+    the command has crossed the wire, the board has finished the commands
+    before it, and the response latency (plus jitter) and the response's
+    own wire time have passed.
+
+    No threads are used; time only passes for the caller, so hundreds of
+    simulated boards can run in one process.
+    """
+
+    def __init__(self):
+        self._firmware = None
+        self._portname = 'sim'
+        self._baud = 115200
+        self._latency = 0.001
+        self._jitter = 0.0
+        self._drop_rate = 0.0
+        self._timeout_rate = 0.0
+        self._random = random.Random()
+        self._responses = deque()
+        self._rx_buffer = bytearray()
+        self._tx_until = 0.0
+        self._busy_until = 0.0
+        super(SimulatedChannel, self).__init__()
+    #end def
+
+
+    def _wire_time(self, count):
+        """
+        Returns the time (in secs) to send count bytes, at 10 bits per byte.
+        """
+        if self._baud <= 0:
+            return 0.0
+        return count * 10.0 / self._baud
+    #end def
+
+
+    def byte_time(self):
+        return self._wire_time(1)
+    #end def
+
+
+    def bytes_available(self):
+        now = perf_counter()
+        return sum(len(data) for ready_time, data in self._responses if ready_time <= now)
+    #end def
+
+
+    def close(self):
+        self._responses.clear()
+        super(SimulatedChannel, self).close()
+    #end def
+
+
+    def flush(self):
+        super(SimulatedChannel, self).flush()
+        self._responses.clear()
+        self._rx_buffer = bytearray()
+    #end def
+
+
+    def open(self, settings):
+        """
+        Opens a channel to a simulated PortBrain.
+
+        Args:
+            settings = {portname: <name reported by the channel>,
+                firmware: <PortBrainFirmware, a new one if not given>,
+                baud: <throughput, in bits/sec (0 = unlimited)>,
+                latency: <response latency (in secs)>,
+                jitter: <max random extra latency (in secs)>,
+                drop_rate: <probability that a response byte is lost>,
+                timeout_rate: <probability that a command isn't answered>,
+                seed: <random seed>}
+            plus the DeviceChannel settings.
+
+        Returns: bool
+        """
+        super(SimulatedChannel, self).open(settings)
+
+        self._portname = settings.get('portname', self._portname)
+        self._firmware = settings.get('firmware') or self._firmware or PortBrainFirmware()
+        self._baud = settings.get('baud', self._baud)
+        self._latency = settings.get('latency', self._latency)
+        self._jitter = settings.get('jitter', self._jitter)
+        self._drop_rate = settings.get('drop_rate', self._drop_rate)
+        self._timeout_rate = settings.get('timeout_rate', self._timeout_rate)
+        if 'seed' in settings:
+            self._random.seed(settings['seed'])
+
+        self._tx_until = 0.0
+        self._busy_until = 0.0
+        self._channel_handle = DeviceChannel.VALID_HANDLE
+        self.flush()
+        return True
+    #end def
+
+
+    def read(self, count=1):
+        """
+        Reads up to count bytes that have arrived.
+
+        Returns: (tuple) - (success, data), where success (bool), data (bytes)
+        """
+        success, data = self.read_available()
+        if len(data) > count:
+            # put the rest back for the next read
+            self._responses.appendleft((0.0, data[count:]))
+            data = data[:count]
+        return (len(data) > 0, data)
+    #end def
+
+
+    def read_available(self, timeout=0.0):
+        """
+        Reads all the response bytes that have arrived, waiting up to
+        timeout secs for the next response if none have.
+
+        Returns: (tuple) - (success, data), where success (bool), data (bytes)
+        """
+        if not self.is_open():
+            return (False, bytes(0))
+
+        now = perf_counter()
+        if timeout > 0 and (not self._responses or self._responses[0][0] > now):
+            # sleep until the next response arrives, or the timeout
+            wake_time = now + timeout
+            if self._responses:
+                wake_time = min(wake_time, self._responses[0][0])
+            sleep(max(0.0, wake_time - now))
+            now = perf_counter()
+        #end if
+
+        chunks = []
+        while self._responses and self._responses[0][0] <= now:
+            chunks.append(self._responses.popleft()[1])
+
+        data = b''.join(chunks)
+        return (len(data) > 0, data)
+    #end def
+
+
+    def write(self, data):
+        """
+        Sends data to the simulated PortBrain, running any complete commands.
+
+        Args:
+            data (bytes)
+        """
+        if not self.is_open():
+            return False
+
+        # the command bytes queue up behind earlier writes on the wire
+        arrival = max(perf_counter(), self._tx_until)
+        self._rx_buffer += data
+
+        while True:
+            cmd, found, remainder = self._rx_buffer.partition(self._cmd_terminator)
+            if not found:
+                break
+            self._rx_buffer = remainder
+
+            # command reaches the board, which works through commands in turn
+            arrival += self._wire_time(len(cmd) + len(self._cmd_terminator))
+            self._tx_until = arrival
+            response = self._firmware.execute(bytes(cmd)) + self._read_terminator
+            start = max(arrival, self._busy_until) + self._latency
+            if self._jitter > 0:
+                start += self._random.uniform(0.0, self._jitter)
+            self._busy_until = start + self._wire_time(len(response))
+
+            if self._timeout_rate > 0 and self._random.random() < self._timeout_rate:
+                continue
+
+            if self._drop_rate > 0:
+                response = bytes(byte for byte in response if self._random.random() >= self._drop_rate)
+
+            self._responses.append((self._busy_until, response))
+        #end while
+
+        return True
+    #end def
+
+
+    @property
+    def firmware(self):
+        return self._firmware
+
+
+    @property
+    def name(self):
+        return self._portname
+#end class
+
+
+def simulated_portbrains(count, settings=None):
+    """
+    Creates connected controllers for a number of simulated PortBrains.
+
+    Args:
+        count (int): number of boards.
+        settings (dict): SimulatedChannel settings shared by all boards; each
+            board gets its own firmware model and the name 'sim<index>'.
+
+    Returns:
+        (list) -- list of PortBrainController objects.
+    """
+    portbrains = []
+    for index in range(count):
+        board_settings = {'read_terminator': b'\r', 'cmd_terminator': b'\r', 'cmd_timeout': 0.5}
+        board_settings.update(settings or {})
+        board_settings['portname'] = 'sim{}'.format(index)
+        board_settings['firmware'] = PortBrainFirmware()
+
+        channel = SimulatedChannel()
+        channel.open(board_settings)
+        portbrain = PortBrainController(channel)
+        portbrain.check_for_device()
+        portbrains.append(portbrain)
+    #end for
+
+    return portbrains
+#end def
@@ -0,0 +1,375 @@
+# !python3
+"""
+This module implements the DeviceChannel class over a serial port on
+Linux, using the tty directly (os.open, termios and epoll) instead of
+pyserial, for the lowest per-command overhead.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import select
+import struct
+import termios
+
+from device_channel import DeviceChannel
+from wait_policy import EpollWaitPolicy
+import serial_utils
+
+__author__ = 'Scott Pinkham, Byte Arts LLC'
+__version__ = '2019.513.0'
+
+logger = logging.getLogger(__name__)
+
+_DATA_BITS = {5: termios.CS5, 6: termios.CS6, 7: termios.CS7, 8: termios.CS8}
+
+
+class TermiosChannel(DeviceChannel):
+    """
+    Serial port channel for Linux. The tty is opened non-blocking and set
+    to raw mode with VMIN=0/VTIME=0, so reads and writes never block in
+    the kernel; waiting for data is done with epoll (see EpollWaitPolicy)
+    and received bytes are read straight into the response framer.
+
+    Takes the same settings as SerialChannel.
+    """
+    # bytes of framer space offered to each read; responses are shorter
+    READ_CHUNK = 128
+
+    def __init__(self):
+        self._fd = None
+        self._portname = ''
+        self._port_settings = 'baud=115200,databits=8,parity=N,stopbits=1'
+        self._write_epoll = None
+        super(TermiosChannel, self).__init__()
+    #end def
+
+
+    def _configure(self, fd, port_settings):
+        """
+        Sets the tty to raw mode with the given settings.
+
+        Raises: ValueError if the settings aren't supported, termios.error
+            if they can't be applied.
+        """
+        speed = getattr(termios, 'B{}'.format(port_settings['baud']), None)
+        if speed is None:
+            raise ValueError('unsupported baud rate {}'.format(port_settings['baud']))
+        if port_settings['databits'] not in _DATA_BITS:
+            raise ValueError('unsupported data bits {}'.format(port_settings['databits']))
+
+        iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(fd)
+
+        iflag &= ~(termios.IGNBRK | termios.BRKINT | termios.PARMRK | termios.ISTRIP | termios.INLCR |
+            termios.IGNCR | termios.ICRNL | termios.IXON | termios.IXOFF | termios.IXANY | termios.INPCK)
+        oflag &= ~termios.OPOST
+        lflag &= ~(termios.ECHO | termios.ECHONL | termios.ICANON | termios.ISIG | termios.IEXTEN)
+
+        cflag &= ~(termios.CSIZE | termios.PARENB | termios.PARODD | termios.CSTOPB | termios.CRTSCTS)
+        cflag |= termios.CLOCAL | termios.CREAD | _DATA_BITS[port_settings['databits']]
+        parity = port_settings['parity'].upper()
+        if parity == 'E':
+            cflag |= termios.PARENB
+        elif parity == 'O':
+            cflag |= termios.PARENB | termios.PARODD
+        if port_settings['stopbits'] == 2:
+            cflag |= termios.CSTOPB
+
+        # never block in read(): return whatever has arrived, even nothing
+        cc = list(cc)
+        cc[termios.VMIN] = 0
+        cc[termios.VTIME] = 0
+
+        termios.tcsetattr(fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, speed, speed, cc])
+    #end def
+
+
+    def _create_wait_policy(self):
+        return EpollWaitPolicy()
+    #end def
+
+
+    def _check_hangup(self):
+        """
+        Closes the channel if the last wait for input (e.g. by
+        DeviceChannel._read_response()) ended because the device hung up.
+        Called when a read found nothing, as a hung up tty can read as
+        empty rather than fail.
+        """
+        if self._fd is not None and getattr(self._wait_policy, 'hangup', False):
+            self._hang_up('device hung up')
+    #end def
+
+
+    def _hang_up(self, reason):
+        """
+        Closes the channel after the device has gone (EPOLLHUP/EPOLLERR, or
+        EIO), so commands fail at once instead of waiting out their timeout
+        on an fd that is always readable.
+        """
+        logger.warning('TermiosChannel %s: %s, closing', self._portname, reason)
+        self.close()
+    #end def
+
+
+    def _wait_for_input(self, timeout):
+        """
+        Waits up to timeout secs for input.
+
+        Returns: bool -- False if the device hung up (the channel is then closed).
+        """
+        self._wait_policy.wait(self, timeout)
+        if getattr(self._wait_policy, 'hangup', False):
+            self._hang_up('device hung up')
+            return False
+        return True
+    #end def
+
+
+    def _wait_writable(self, timeout):
+        """
+        Waits until the tty's output buffer has room, or the timeout expires.
+
+        Returns: bool -- True if writable.
+        """
+        if self._write_epoll is None:
+            self._write_epoll = select.epoll()
+            self._write_epoll.register(self._fd, select.EPOLLOUT)
+        return len(self._write_epoll.poll(timeout)) > 0
+    #end def
+
+
+    def bytes_available(self):
+        if self._fd is None:
+            return 0
+
+        try:
+            data = fcntl.ioctl(self._fd, termios.FIONREAD, b'\0\0\0\0')
+            return struct.unpack('i', data)[0]
+        except OSError:
+            return 0
+    #end def
+
+
+    def byte_time(self):
+        try:
+            return serial_utils.byte_time(self._port_settings)
+        except ValueError:
+            return 0.0
+    #end def
+
+
+    def close(self):
+        if self._write_epoll is not None:
+            self._write_epoll.close()
+            self._write_epoll = None
+
+        if isinstance(self._wait_policy, EpollWaitPolicy):
+            self._wait_policy.release()
+
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
+        #end if
+
+        super(TermiosChannel, self).close()
+    #end def
+
+
+    def fileno(self):
+        return self._fd
+    #end def
+
+
+    def flush(self):
+        super(TermiosChannel, self).flush()
+        if self._fd is not None:
+            try:
+                termios.tcflush(self._fd, termios.TCIOFLUSH)
+            except termios.error:
+                pass
+        #end if
+    #end def
+
+
+    def open(self, settings):
+        """
+        Opens a serial port.
+
+        Args:
+            settings = {portname: <tty path>, portsettings: 'baud=<v>,databits=<v>,parity=<v>,stopbits=<v>'}
+
+        Returns: bool
+        """
+        super(TermiosChannel, self).open(settings)
+        self.close()
+
+        if 'portsettings' in settings:
+            self._port_settings = settings['portsettings']
+
+        if 'portname' in settings:
+            self._portname = settings['portname']
+
+        try:
+            port_settings = serial_utils.parse_port_settings(self._port_settings)
+            self._fd = os.open(self._portname, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+            self._configure(self._fd, port_settings)
+        except (OSError, ValueError, termios.error) as err:
+            # suppress the 'no such file' error, like open_serial_port()
+            if not (isinstance(err, OSError) and err.errno == errno.ENOENT):
+                logger.warning('TermiosChannel.open() failed: %s' % err)
+            self.close()
+            return False
+        #end try..except
+
+        self._channel_handle = DeviceChannel.VALID_HANDLE
+        self.flush()
+        return True
+    #end def
+
+
+    def read(self, count=1):
+        """
+        Reads up to count bytes that have arrived, without waiting.
+
+        Returns: (tuple) - (success, data), where success (bool), data (bytes)
+        """
+        if self._fd is None:
+            return (False, bytes(0))
+
+        try:
+            data = os.read(self._fd, count)
+        except (BlockingIOError, InterruptedError):
+            data = bytes(0)
+        except OSError as err:
+            self._hang_up(err)
+            return (False, bytes(0))
+
+        return (len(data) > 0, data)
+    #end def
+
+
+    def read_available(self, timeout=0.0):
+        """
+        Reads all bytes that have arrived, waiting up to timeout secs for
+        some to arrive if none have.
+
+        Returns: (tuple) - (success, data), where success (bool), data (bytes)
+        """
+        if self._fd is None:
+            return (False, bytes(0))
+
+        chunks = []
+        waited = False
+        while True:
+            try:
+                data = os.read(self._fd, 4096)
+            except (BlockingIOError, InterruptedError):
+                data = bytes(0)
+            except OSError as err:
+                self._hang_up(err)
+                break
+
+            if data:
+                chunks.append(data)
+                continue
+            if chunks or waited or timeout <= 0:
+                break
+
+            if not self._wait_for_input(timeout):
+                break
+            waited = True
+        #end while
+
+        if not chunks:
+            self._check_hangup()
+
+        data = b''.join(chunks)
+        return (len(data) > 0, data)
+    #end def
+
+
+    def read_into(self, framer, timeout=0.0):
+        """
+        Reads all bytes that have arrived straight into the framer's buffer,
+        waiting up to timeout secs for some to arrive if none have.
+
+        Returns: (tuple) - (success, count), where success (bool), count (int)
+        """
+        if self._fd is None:
+            return (False, 0)
+
+        total = 0
+        waited = False
+        while True:
+            view = framer.writable(TermiosChannel.READ_CHUNK)
+            try:
+                count = os.readv(self._fd, [view])
+            except (BlockingIOError, InterruptedError):
+                count = 0
+            except OSError as err:
+                view.release()
+                self._hang_up(err)
+                break
+            finally:
+                view.release()
+
+            framer.commit(count)
+            total += count
+            if count == TermiosChannel.READ_CHUNK:
+                # there may be more
+                continue
+            if total > 0 or waited or timeout <= 0:
+                break
+
+            if not self._wait_for_input(timeout):
+                break
+            waited = True
+        #end while
+
+        if total == 0:
+            self._check_hangup()
+
+        return (total > 0, total)
+    #end def
+
+
+    def write(self, data):
+        """
+        Writes data to the serial port, waiting (up to cmd_timeout) for room
+        in the output buffer if it is full.
+
+        Args:
+            data (bytes)
+        """
+        if self._fd is None:
+            return False
+
+        view = memoryview(data)
+        try:
+            while len(view) > 0:
+                try:
+                    count = os.write(self._fd, view)
+                except (BlockingIOError, InterruptedError):
+                    count = 0
+
+                view = view[count:]
+                if len(view) > 0 and count == 0 and not self._wait_writable(self._cmd_timeout):
+                    return False
+            #end while
+        except OSError as err:
+            self._hang_up(err)
+            return False
+
+        return True
+    #end def
+
+
+    @property
+    def name(self):
+        return self._portname
+#end class
@@ -0,0 +1,385 @@
+# !python3
+"""
+This module implements a thread-safe DeviceChannel that shares another
+channel between threads. One I/O worker thread owns the wrapped channel;
+callers queue their commands and get futures back, and the worker sends
+whatever has queued up as one pipelined batch.
+
+Usage:
+    portbrain = PortBrainController(ThreadedChannel(channel))
+"""
+
+from concurrent.futures import Future
+import queue
+import threading
+
+from device_channel import DeviceChannel
+
+__author__ = 'Scott Pinkham, Byte Arts LLC'
+__version__ = '2019.513.0'
+
+
+class _Request(object):
+    """
+    A queued request: commands to send, or a function to call, on the
+    worker thread.
+    """
+    __slots__ = ('cmds', 'single', 'function', 'future')
+
+    def __init__(self, cmds=None, single=False, function=None):
+        self.cmds = cmds
+        self.single = single
+        self.function = function
+        self.future = Future()
+    #end def
+#end class
+
+
+class ThreadedChannel(DeviceChannel):
+    """
+    Channel that can be used by several threads at once. Commands from all
+    threads are queued for an I/O worker thread, which owns the wrapped
+    channel. The worker takes every command waiting in the queue (up to
+    max_batch) and sends them with the wrapped channel's send_commands(),
+    so commands from different threads are pipelined onto the wire instead
+    of waiting for each other's round trips.
+
+    The commands of one send_commands() call stay together and in order.
+    As with send_commands(), a timeout fails the rest of the batch it
+    happened in, which can include other threads' commands.
+
+    Only the worker thread touches the wrapped channel and updates the
+    counters, so no locks are needed around either.
+
+    Args:
+        channel (DeviceChannel): channel to share, open or not.
+        max_batch (int): max commands sent in one batch.
+    """
+    _STOP = object()
+
+    def __init__(self, channel, max_batch=64):
+        self._channel = channel
+        self._max_batch = max_batch
+        self._queue = queue.Queue()
+        self._queue_lock = threading.Lock()
+        self._closed = False
+        self._commands_sent = 0
+        self._batches_sent = 0
+        self._largest_batch = 0
+        super(ThreadedChannel, self).__init__()
+
+        self._thread = threading.Thread(target=self._run, daemon=True,
+            name='channel-' + str(getattr(channel, 'name', '') or id(channel)))
+        self._thread.start()
+    #end def
+
+
+    def _call(self, function, *args):
+        """
+        Runs a function on the worker thread and waits for its result.
+        """
+        request = _Request(function=lambda: function(*args))
+        self._queue_request(request)
+        return request.future.result()
+    #end def
+
+
+    def _queue_request(self, request):
+        """
+        Queues a request for the worker, or fails it if the channel has been
+        closed. The check is made under the lock that close() takes, so
+        nothing can be queued after the worker's last look at the queue.
+        """
+        with self._queue_lock:
+            if not self._closed:
+                self._queue.put(request)
+                return
+        #end with
+        request.future.set_result(self._failed_result(request))
+    #end def
+
+
+    def _run(self):
+        """
+        Worker loop: sends queued commands in batches, and runs queued calls.
+        """
+        running = True
+        while running:
+            request = self._queue.get()
+
+            # gather the commands that have queued up behind the first one
+            batch = []
+            count = 0
+            while request is not None:
+                if request is ThreadedChannel._STOP:
+                    running = False
+                    break
+                if request.function is not None:
+                    self._send_batch(batch)
+                    batch, count = [], 0
+                    self._run_function(request)
+                else:
+                    batch.append(request)
+                    count += len(request.cmds)
+                #end if
+
+                request = None
+                if count < self._max_batch:
+                    try:
+                        request = self._queue.get_nowait()
+                    except queue.Empty:
+                        pass
+                #end if
+            #end while
+
+            self._send_batch(batch)
+        #end while
+
+        # nothing can be queued after _STOP, but fail anything left, to be safe
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is not ThreadedChannel._STOP and request.future.set_running_or_notify_cancel():
+                request.future.set_result(self._failed_result(request))
+        #end while
+    #end def
+
+
+    @staticmethod
+    def _failed_result(request):
+        if request.function is not None:
+            return False
+        if request.single:
+            return (False, bytes(0))
+        return [(False, bytes(0))] * len(request.cmds)
+    #end def
+
+
+    def _run_function(self, request):
+        if not request.future.set_running_or_notify_cancel():
+            return
+        try:
+            request.future.set_result(request.function())
+        except BaseException as e:
+            request.future.set_exception(e)
+    #end def
+
+
+    def _send_batch(self, batch):
+        """
+        Sends the commands of several requests as one pipelined batch, and
+        hands each request its share of the results.
+        """
+        batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        cmds = []
+        for request in batch:
+            cmds.extend(request.cmds)
+
+        try:
+            if len(cmds) == 1:
+                results = [self._channel.send_command(cmds[0])]
+            else:
+                results = self._channel.send_commands(cmds)
+        except BaseException as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        #end try..except
+
+        self._commands_sent += len(cmds)
+        self._batches_sent += 1
+        if len(cmds) > self._largest_batch:
+            self._largest_batch = len(cmds)
+
+        index = 0
+        for request in batch:
+            count = len(request.cmds)
+            if request.single:
+                request.future.set_result(results[index])
+            else:
+                request.future.set_result(results[index:index + count])
+            index += count
+        #end for
+    #end def
+
+
+    def bytes_available(self):
+        return self._channel.bytes_available()
+    #end def
+
+
+    def byte_time(self):
+        return self._channel.byte_time()
+    #end def
+
+
+    def close(self):
+        """
+        Closes the wrapped channel and stops the worker, once the commands
+        already queued have been sent.
+        """
+        if self._thread is None:
+            return
+        if self._thread is threading.current_thread():
+            raise RuntimeError('close() called from the channel worker')
+
+        # requests queued before this one are still sent; later ones fail
+        close_request = _Request(function=self._channel.close)
+        with self._queue_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(close_request)
+            self._queue.put(ThreadedChannel._STOP)
+        #end with
+
+        close_request.future.result()
+        self._thread.join()
+        self._thread = None
+        super(ThreadedChannel, self).close()
+    #end def
+
+
+    def flush(self):
+        super(ThreadedChannel, self).flush()
+        if getattr(self, '_thread', None) is not None:
+            self._call(self._channel.flush)
+    #end def
+
+
+    def is_open(self):
+        return self._thread is not None and self._channel.is_open()
+    #end def
+
+
+    def open(self, settings):
+        """
+        Opens the wrapped channel (on the worker thread).
+
+        Returns: bool
+        """
+        super(ThreadedChannel, self).open(settings)
+        return self._call(self._channel.open, settings)
+    #end def
+
+
+    def read(self):
+        return (False, bytes(0))
+    #end def
+
+
+    def send_command(self, cmd):
+        """
+        Queues a command and waits for its response.
+
+        Returns: (tuple): (success, response)
+        """
+        return self.submit(cmd).result()
+    #end def
+
+
+    def send_commands(self, cmds):
+        """
+        Queues several commands, to be sent together, and waits for their
+        responses.
+
+        Returns: (list): list of (success, response) tuples, in the same
+            order as cmds.
+        """
+        if not cmds:
+            return []
+        return self.submit_many(cmds).result()
+    #end def
+
+
+    def submit(self, cmd):
+        """
+        Queues a command.
+
+        Args:
+            cmd (bytes): command to send
+
+        Returns: (Future) resolving to a (success, response) tuple.
+        """
+        request = _Request([cmd], single=True)
+        self._queue_request(request)
+        return request.future
+    #end def
+
+
+    def submit_many(self, cmds):
+        """
+        Queues several commands, to be sent together and in order.
+
+        Args:
+            cmds (list): commands (bytes) to send
+
+        Returns: (Future) resolving to a list of (success, response) tuples.
+        """
+        request = _Request(list(cmds))
+        self._queue_request(request)
+        return request.future
+    #end def
+
+
+    def write(self, data):
+        return self._call(self._channel.write, data)
+    #end def
+
+
+    @property
+    def channel(self):
+        return self._channel
+
+
+    @property
+    def cmd_timeout(self):
+        return self._channel.cmd_timeout
+
+
+    @cmd_timeout.setter
+    def cmd_timeout(self, value):
+        self._call(setattr, self._channel, 'cmd_timeout', value)
+
+
+    @property
+    def discarded_bytes(self):
+        return self._channel.discarded_bytes
+
+
+    @property
+    def last_error(self):
+        """
+        Error of the last batch sent, which may include other threads' commands.
+        """
+        return self._channel.last_error
+
+
+    @property
+    def name(self):
+        return getattr(self._channel, 'name', '')
+
+
+    @property
+    def queue_stats(self):
+        """
+        Returns dict with the number of commands and batches sent, the
+        largest batch, and the number of requests waiting in the queue.
+        """
+        return {
+            'commands': self._commands_sent,
+            'batches': self._batches_sent,
+            'largest batch': self._largest_batch,
+            'queued': self._queue.qsize(),
+        }
+
+
+    @property
+    def stats(self):
+        return self._channel.stats
+#end class
@@ -0,0 +1,156 @@
+# !python3
+"""
+Module that defines an on-disk cache of where PortBrains were found, so
+discovery can check those ports first instead of probing every port.
+"""
+
+import json
+import logging
+import os
+import time
+
+__author__ = 'Scott Pinkham, Byte Arts LLC'
+__version__ = '2019.513.0'
+
+logger = logging.getLogger(__name__)
+
+# entries older than this (in secs) are ignored
+DEFAULT_TTL = 7 * 24 * 3600
+
+
+def default_cache_path():
+    """
+    Returns the default location of the cache file.
+    """
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'portbrain', 'discovery.json')
+#end def
+
+
+class DiscoveryCache(object):
+    """
+    Cache of ports where a PortBrain was found, keyed by port name. Each
+    entry records the firmware version, when the unit was last seen, and
+    the USB serial number of the port if it has one, so a unit can still
+    be found after it has moved to another port.
+
+    Args:
+        path (str): cache file, defaults to default_cache_path().
+        ttl (float): max age (in secs) of an entry.
+    """
+    def __init__(self, path=None, ttl=DEFAULT_TTL):
+        self._path = path or default_cache_path()
+        self._ttl = float(ttl)
+        self._entries = {}
+        self.load()
+    #end def
+
+
+    def entries(self):
+        """
+        Gets the entries that haven't expired.
+
+        Returns: (list) of dicts with keys 'portname', 'version',
+            'serial_number' and 'timestamp'.
+        """
+        oldest = time.time() - self._ttl
+        return [dict(entry) for entry in self._entries.values() if entry['timestamp'] >= oldest]
+    #end def
+
+
+    def invalidate(self, portname=None):
+        """
+        Removes an entry from the cache.
+
+        Args:
+            portname (str): port to remove, or None to remove all entries.
+        """
+        if portname is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(portname, None)
+    #end def
+
+
+    def load(self):
+        """
+        Loads the cache file. A missing or unreadable file gives an empty cache.
+        """
+        self._entries = {}
+        try:
+            with open(self._path, 'r') as f:
+                data = json.load(f)
+
+            for entry in data.get('portbrains', []):
+                self._entries[entry['portname']] = {
+                    'portname': entry['portname'],
+                    'version': entry['version'],
+                    'serial_number': entry.get('serial_number'),
+                    'timestamp': float(entry['timestamp']),
+                }
+            #end for
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as err:
+            logger.warning('Ignoring discovery cache {}: {}'.format(self._path, err))
+            self._entries = {}
+        #end try..except
+    #end def
+
+
+    def save(self):
+        """
+        Writes the cache file. The file is replaced in one step so readers
+        never see a partial file.
+
+        Returns: (bool) True if successful.
+        """
+        data = {'portbrains': sorted(self._entries.values(), key=lambda entry: entry['portname'])}
+        temp_path = self._path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(temp_path, 'w') as f:
+                json.dump(data, f, indent=2)
+            os.replace(temp_path, self._path)
+            return True
+        except OSError as err:
+            logger.warning('Unable to write discovery cache {}: {}'.format(self._path, err))
+            return False
+        #end try..except
+    #end def
+
+
+    def update(self, portname, version, serial_number=None):
+        """
+        Records that a PortBrain was found on a port.
+
+        Args:
+            portname (str): port the unit was found on.
+            version (str): firmware version reported by the unit.
+            serial_number (str): USB serial number of the port, if any.
+        """
+        # a unit that moved leaves a stale entry behind on its old port
+        if serial_number:
+            for entry in list(self._entries.values()):
+                if entry['serial_number'] == serial_number and entry['portname'] != portname:
+                    del self._entries[entry['portname']]
+        #end if
+
+        self._entries[portname] = {
+            'portname': portname,
+            'version': version,
+            'serial_number': serial_number,
+            'timestamp': time.time(),
+        }
+    #end def
+
+
+    @property
+    def path(self):
+        return self._path
+
+
+    @property
+    def ttl(self):
+        return self._ttl
+#end class
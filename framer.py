@@ -0,0 +1,185 @@
+# !python3
+"""
+Module that defines an incremental framing buffer for splitting the
+data received from a device into terminated frames.
+"""
+
+__author__ = 'Scott Pinkham, Byte Arts LLC'
+__version__ = '2019.513.0'
+
+
+class ResponseFramer(object):
+    """
+    Buffers received bytes and splits them into frames that end with a
+    terminator.
+
+    Data is kept in a preallocated bytearray that is reused between frames,
+    and can be read straight into it (see writable() and commit()). The
+    terminator search resumes where the last one stopped, so splitting is
+    linear in the amount of data received. Bytes after a frame stay in the
+    buffer for the next frame.
+
+    Args:
+        terminator (bytes): frame terminator.
+        capacity (int): initial buffer size (in bytes).
+    """
+    def __init__(self, terminator=b'\n', capacity=256):
+        self._terminator = terminator
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self.clear()
+    #end def
+
+
+    def __len__(self):
+        return self._end - self._start
+    #end def
+
+
+    def _reserve(self, size):
+        """
+        Makes sure there is room for size more bytes at the end of the data,
+        moving the data to the front of the buffer or moving it to a bigger
+        buffer as needed.
+        """
+        if self._end + size <= len(self._buffer):
+            return
+
+        count = self._end - self._start
+        capacity = len(self._buffer)
+        if count + size > capacity:
+            # grow into a new buffer, so views handed out earlier stay valid
+            while count + size > capacity:
+                capacity *= 2
+            buffer = bytearray(capacity)
+            buffer[:count] = self._view[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        else:
+            self._buffer[:count] = self._buffer[self._start:self._end]
+        #end if
+
+        self._scan -= self._start
+        self._start = 0
+        self._end = count
+    #end def
+
+
+    def clear(self):
+        """
+        Discards all buffered data.
+        """
+        self._start = 0
+        self._end = 0
+        self._scan = 0
+    #end def
+
+
+    def commit(self, count):
+        """
+        Adds count bytes, written into the view returned by writable(), to
+        the buffered data.
+        """
+        self._end += count
+    #end def
+
+
+    def feed(self, data):
+        """
+        Appends data to the buffer.
+
+        Args:
+            data (bytes): data received from the device.
+        """
+        count = len(data)
+        if count <= 0:
+            return
+
+        self._reserve(count)
+        self._view[self._end:self._end + count] = data
+        self._end += count
+    #end def
+
+
+    def has_frame(self):
+        """
+        Returns True if a complete frame is in the buffer.
+        """
+        return self._find_terminator() >= 0
+    #end def
+
+
+    def _find_terminator(self):
+        """
+        Searches for a terminator in the data that hasn't been scanned yet.
+
+        Returns: (int) index of the terminator, or -1 if not found.
+        """
+        index = self._buffer.find(self._terminator, self._scan, self._end)
+        if index < 0:
+            # a terminator could start in the last few bytes
+            self._scan = max(self._start, self._end - len(self._terminator) + 1)
+        else:
+            self._scan = index
+        return index
+    #end def
+
+
+    def next_frame(self):
+        """
+        Removes the next complete frame from the buffer.
+
+        Returns: (bytes) frame without its terminator, or None if no
+            complete frame has been received.
+        """
+        index = self._find_terminator()
+        if index < 0:
+            return None
+
+        frame = bytes(self._view[self._start:index])
+        self._start = index + len(self._terminator)
+        self._scan = self._start
+
+        if self._start >= self._end:
+            # buffer is empty, so start over at the front
+            self.clear()
+
+        return frame
+    #end def
+
+
+    def pending(self):
+        """
+        Returns (bytes): copy of the buffered data that isn't part of a
+            complete frame yet.
+        """
+        return bytes(self._view[self._start:self._end])
+    #end def
+
+
+    def writable(self, size):
+        """
+        Gets a view of free buffer space that data can be read into (e.g.
+        with readinto()). Call commit() with the number of bytes written.
+        The view must be released before the buffer is used again.
+
+        Args:
+            size (int): number of bytes to make room for.
+
+        Returns: (memoryview)
+        """
+        self._reserve(size)
+        return self._view[self._end:self._end + size]
+    #end def
+
+
+    @property
+    def terminator(self):
+        return self._terminator
+
+
+    @terminator.setter
+    def terminator(self, value):
+        self._terminator = value
+        self._scan = self._start
+#end class
@@ -0,0 +1,389 @@
+# !python3
+"""
+Module for sharing one device link between several clients, with
+priority classes and per-client budgets of link time, so that background
+traffic (e.g. ADC logging) can't hold up control commands.
+
+Usage:
+    scheduler = LinkScheduler(channel)
+    control = PortBrainController(scheduler.client('control', PRIORITY_CONTROL))
+    logger = PortBrainController(scheduler.client('logger', PRIORITY_BACKGROUND, budget=0.25))
+"""
+
+from collections import deque
+from concurrent.futures import Future
+import threading
+from time import perf_counter
+
+from device_channel import DeviceChannel
+
+__author__ = 'Scott Pinkham, Byte Arts LLC'
+__version__ = '2019.513.0'
+
+# priority classes, lower values are served first
+PRIORITY_CONTROL = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+# used when the channel can't tell its byte time: 10 bits at 115200 baud
+DEFAULT_BYTE_TIME = 10.0 / 115200
+
+# expected response length (in bytes, with terminator) used to charge a
+# command before its response is known; the charge is corrected afterwards
+RESPONSE_BYTES_ESTIMATE = 5
+
+
+class _Request(object):
+    """
+    Commands queued by a client, sent in one or more chunks.
+    """
+    __slots__ = ('cmds', 'single', 'offset', 'results', 'future', 'queued_time')
+
+    def __init__(self, cmds, single):
+        self.cmds = cmds
+        self.single = single
+        self.offset = 0
+        self.results = []
+        self.future = Future()
+        self.queued_time = perf_counter()
+    #end def
+#end class
+
+
+class _Client(object):
+    """
+    Scheduling state of a client: its queue, priority and token bucket.
+    Tokens are secs of link time; a client can send while it has tokens
+    left, and runs into debt by at most one chunk.
+    """
+    def __init__(self, name, priority, budget, burst):
+        self.name = name
+        self.priority = priority
+        self.budget = budget
+        self.burst = burst
+        self.tokens = burst
+        self.updated = perf_counter()
+        self.requests = deque()
+        self.last_error = ''
+        self.commands = 0
+        self.link_time = 0.0
+        self.throttled = 0
+        self.max_wait = 0.0
+    #end def
+
+
+    def refill(self, now):
+        if self.budget is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.budget)
+        self.updated = now
+    #end def
+#end class
+
+
+class LinkScheduler(object):
+    """
+    Owns a device channel and sends the commands of several clients over
+    it, from one worker thread. Each time the link is free, the worker
+    picks the highest priority client that has commands waiting and is
+    within its budget (clients of the same priority take turns), and sends
+    up to max_batch of its commands as one pipelined batch. A queued
+    command therefore waits for at most one batch of lower priority
+    commands.
+
+    The link time of each command is estimated from the command and
+    response lengths and the channel's byte time (from its port settings).
+
+    Args:
+        channel (DeviceChannel): open channel to schedule.
+        max_batch (int): max commands sent in one turn.
+    """
+    def __init__(self, channel, max_batch=8):
+        self._channel = channel
+        self._max_batch = max_batch
+        self._byte_time = channel.byte_time() or DEFAULT_BYTE_TIME
+        self._clients = []
+        self._condition = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='link-scheduler', daemon=True)
+        self._thread.start()
+    #end def
+
+
+    def _cost(self, cmds, response_bytes):
+        """
+        Returns the estimated link time (in secs) of commands and their responses.
+        """
+        out_bytes = sum(len(cmd) + 1 for cmd in cmds)
+        return (out_bytes + response_bytes) * self._byte_time
+    #end def
+
+
+    def _next_client(self):
+        """
+        Picks the client to serve next. Called with the lock held.
+
+        Returns: (tuple) (client, wait) where client is None if no client
+            can be served now, and wait is the time (in secs) until one of
+            the throttled clients can be, None if there are none.
+        """
+        now = perf_counter()
+        wait = None
+        for client in self._clients:
+            if not client.requests:
+                continue
+
+            client.refill(now)
+            if client.budget is None or client.tokens > 0:
+                # move it to the back, so clients of the same priority take turns
+                self._clients.remove(client)
+                self._clients.append(client)
+                self._clients.sort(key=lambda c: c.priority)
+                return (client, None)
+            #end if
+
+            if client.budget > 0:
+                client_wait = -client.tokens / client.budget + 1e-6
+                wait = client_wait if wait is None else min(wait, client_wait)
+        #end for
+
+        return (None, wait)
+    #end def
+
+
+    def _run(self):
+        """
+        Worker loop, runs on the scheduler thread.
+        """
+        while True:
+            with self._condition:
+                client = None
+                while self._running:
+                    client, wait = self._next_client()
+                    if client is not None:
+                        break
+                    self._condition.wait(wait)
+                #end while
+                if client is None:
+                    break
+
+                request = client.requests[0]
+                chunk = request.cmds[request.offset:request.offset + self._max_batch]
+                estimate = self._cost(chunk, RESPONSE_BYTES_ESTIMATE * len(chunk))
+                client.tokens -= estimate
+                if client.budget is not None and client.tokens <= 0:
+                    client.throttled += 1
+                if request.offset == 0:
+                    client.max_wait = max(client.max_wait, perf_counter() - request.queued_time)
+            #end with
+
+            try:
+                if len(chunk) == 1:
+                    results = [self._channel.send_command(chunk[0])]
+                else:
+                    results = self._channel.send_commands(chunk)
+                error = None
+            except Exception as e:
+                results = [(False, bytes(0))] * len(chunk)
+                error = e
+            #end try..except
+            last_error = self._channel.last_error
+
+            with self._condition:
+                # charge what the responses actually took
+                cost = self._cost(chunk, sum(len(response) + 1 for _, response in results))
+                client.tokens += estimate - cost
+                client.link_time += cost
+                client.commands += len(chunk)
+                if last_error:
+                    client.last_error = last_error
+
+                request.results.extend(results)
+                request.offset += len(chunk)
+                done = request.offset >= len(request.cmds) or error is not None
+                if done:
+                    client.requests.popleft()
+            #end with
+
+            if done:
+                if error is not None:
+                    request.future.set_exception(error)
+                elif request.single:
+                    request.future.set_result(request.results[0])
+                else:
+                    request.future.set_result(request.results)
+            #end if
+        #end while
+
+        # fail whatever is still queued
+        for client in self._clients:
+            while client.requests:
+                request = client.requests.popleft()
+                failed = [(False, bytes(0))] * len(request.cmds)
+                request.future.set_result(failed[0] if request.single else failed)
+        #end for
+    #end def
+
+
+    def _submit(self, client, cmds, single):
+        request = _Request(list(cmds), single)
+        with self._condition:
+            if not self._running:
+                failed = [(False, bytes(0))] * len(request.cmds)
+                request.future.set_result(failed[0] if single else failed)
+                return request.future
+            #end if
+
+            client.last_error = ''
+            client.requests.append(request)
+            self._condition.notify()
+        #end with
+        return request.future
+    #end def
+
+
+    def client(self, name, priority=PRIORITY_NORMAL, budget=None, burst=0.05):
+        """
+        Adds a client.
+
+        Args:
+            name (str): client name, for the stats.
+            priority (int): one of the PRIORITY_ values.
+            budget (float): share of the link's time the client may use,
+                e.g. 0.25 for a quarter; None for no limit.
+            burst (float): link time (in secs) the client can use at once
+                after being idle.
+
+        Returns:
+            ScheduledChannel: channel for the client, e.g. for a PortBrainController.
+        """
+        state = _Client(name, priority, budget, burst)
+        with self._condition:
+            self._clients.append(state)
+            self._clients.sort(key=lambda c: c.priority)
+        #end with
+        return ScheduledChannel(self, state)
+    #end def
+
+
+    def close(self):
+        """
+        Stops the scheduler and closes the channel.
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        #end with
+
+        self._thread.join()
+        self._channel.close()
+    #end def
+
+
+    def remove_client(self, channel):
+        with self._condition:
+            if channel._client in self._clients:
+                self._clients.remove(channel._client)
+        #end with
+    #end def
+
+
+    @property
+    def byte_time(self):
+        return self._byte_time
+
+
+    @property
+    def channel(self):
+        return self._channel
+
+
+    @property
+    def is_running(self):
+        return self._running
+
+
+    @property
+    def stats(self):
+        """
+        Returns dict of client name -> dict with the commands sent, link time
+        used (in secs), times it ran out of budget, longest time a request
+        waited before being started (in secs), and requests queued.
+        """
+        with self._condition:
+            return {client.name: {'commands': client.commands, 'link time': client.link_time,
+                'throttled': client.throttled, 'max wait': client.max_wait,
+                'queued': len(client.requests)} for client in self._clients}
+#end class
+
+
+class ScheduledChannel(DeviceChannel):
+    """
+    A client's channel through a LinkScheduler. Closing it only removes
+    the client; the scheduler owns the link.
+    """
+    def __init__(self, scheduler, client):
+        self._scheduler = scheduler
+        self._client = client
+        super(ScheduledChannel, self).__init__()
+        self._channel_handle = DeviceChannel.VALID_HANDLE
+    #end def
+
+
+    def byte_time(self):
+        return self._scheduler.byte_time
+    #end def
+
+
+    def close(self):
+        self._scheduler.remove_client(self)
+        super(ScheduledChannel, self).close()
+    #end def
+
+
+    def is_open(self):
+        return super(ScheduledChannel, self).is_open() and self._scheduler.is_running \
+            and self._scheduler.channel.is_open()
+    #end def
+
+
+    def read(self):
+        return (False, bytes(0))
+    #end def
+
+
+    def send_command(self, cmd):
+        return self._scheduler._submit(self._client, [cmd], True).result()
+    #end def
+
+
+    def send_commands(self, cmds):
+        if not cmds:
+            return []
+        return self._scheduler._submit(self._client, cmds, False).result()
+    #end def
+
+
+    def write(self, data):
+        return False
+    #end def
+
+
+    @property
+    def cmd_timeout(self):
+        return self._scheduler.channel.cmd_timeout
+
+
+    @property
+    def last_error(self):
+        return self._client.last_error
+
+
+    @property
+    def name(self):
+        return self._scheduler.channel.name
+
+
+    @property
+    def stats(self):
+        return self._scheduler.channel.stats
+#end class
@@ -1,104 +1,336 @@
 # PortBrain module
 
+import concurrent.futures
 import logging
 
 import serial_utils
 from device_channel_serial import SerialChannel
+from device_channel_threaded import ThreadedChannel
+import portbrain_protocol as protocol
+from portbrain_protocol import (ANALOG_INPUT_COUNT, PORT_COUNT, CMD_READ_ANALOG, CMD_READ_DIRECTION, CMD_READ_PORT,
+    CMD_VERSION, CMD_WRITE_DIRECTION, CMD_WRITE_PORT, parse_value, parse_version)
+from portbrain_watch import PortWatcher
+from read_cache import ReadCache
+
+logger = logging.getLogger(__name__)
 
 DEFAULT_PORT_SETTINGS = 'baud=115200,databits=8,parity=N,stopbits=1'
 
+# number of ports probed at the same time during discovery
+DISCOVERY_WORKERS = 16
+
+# max time (in secs) discovery spends searching, so a port that wedges its
+# probe (e.g. a hung driver) can't hold it up for good
+DISCOVERY_DEADLINE = 10.0
+
+# channel class used for the boards found by discovery, e.g. TermiosChannel
+# (device_channel_termios) for the lowest overhead on Linux
+SERIAL_CHANNEL_CLASS = SerialChannel
+
+# learn each board's response times and time out commands after a few
+# multiples of them, instead of after the fixed cmd_timeout (see AdaptiveTimeout)
+ADAPTIVE_TIMEOUTS = False
+
+# on Linux, only probe USB serial ports, skipping consoles and on-board UARTs
+# (faster where there are many tty devices, but units on an on-board UART
+# aren't found), and optionally only those with these USB (vid, pid) IDs,
+# which implies USB only
+DISCOVERY_USB_ONLY = False
+DISCOVERY_USB_IDS = None
+
+# portbrain_protocol builders for the port and input commands, by command name
+_READ_BUILDERS = {
+    CMD_READ_PORT: protocol.read_port_command,
+    CMD_READ_DIRECTION: protocol.read_direction_command,
+    CMD_READ_ANALOG: protocol.read_analog_command,
+}
+_WRITE_BUILDERS = {
+    CMD_WRITE_PORT: protocol.write_port_command,
+    CMD_WRITE_DIRECTION: protocol.write_direction_command,
+}
+
+
+def build_command(name, number, value=None) -> bytes:
+    """
+    Builds a command for a port or input, using the portbrain_protocol
+    builders.
+
+    Arguments:
+        name (bytes) -- command name, one of the CMD_xxx port or input values
+        number (int) -- port or input number
+        value (int) -- value to write, None for reads
+
+    Returns:
+        (bytes) -- command string
 
-def enumerate_portbrains(max_count):
+    Raises: ValueError if the name, number or value isn't valid.
+    """
+    builders = _READ_BUILDERS if value is None else _WRITE_BUILDERS
+    if name not in builders:
+        raise ValueError('{!r} is not a port or input command{}'.format(
+            name, '' if value is None else ' that takes a value'))
+    if value is None:
+        return builders[name](number)
+    return builders[name](number, value)
+#end def
+
+
+def enumerate_portbrains(max_count, max_workers=DISCOVERY_WORKERS, deadline=DISCOVERY_DEADLINE, cache=None,
+        portnames=None):
     """
     Searches serial ports for port brains(s)
 
+    If a discovery cache is given, the ports where units were found before
+    are checked first and all ports are only searched if that doesn't find
+    max_count units. The cache is then updated with the units found.
+
     Arguments:
         max_count (int) -- max number of units to search for.
+        max_workers (int) -- max number of ports to probe at the same time.
+        deadline (float) -- max time (in secs) to spend searching (default DISCOVERY_DEADLINE),
+            None for no limit.
+        cache (DiscoveryCache) -- discovery cache, None to always search all ports.
+        portnames (list) -- ports to search, None to search all available ports.
 
     Returns:
-        (list) -- list of portbrain objects.
+        (list) -- list of portbrain objects, already connected.
     """
 
-    portnames = _search_serial_ports_for_portbrain(max_count)
-
     portbrains = []
+    if cache is not None:
+        portbrains = _check_cached_portbrains(cache, max_count, max_workers)
 
-    # now assign each unit
-    for index in range(len(portnames)):
-        settings = {'portname': portnames[index], 'portsettings': DEFAULT_PORT_SETTINGS,
-            'read_terminator': b'\r',
-            'cmd_terminator': b'\r',
-            'cmd_timeout': 0.5
-        }
-        portbrain = PortBrainController(SerialChannel())
-
-        if portbrain._channel.open(settings):
-            if portbrain.check_for_device():
-                portbrains.append(portbrain)
-        #end if
+    if len(portbrains) < max_count:
+        found = [portbrain.device_info['channel name'] for portbrain in portbrains]
+        portbrains += _search_serial_ports_for_portbrain(max_count - len(portbrains), max_workers, deadline,
+            portnames=portnames, exclude=found)
+    #end if
+
+    if cache is not None:
+        serial_numbers = serial_utils.usb_serial_numbers()
+        for portbrain in portbrains:
+            portname = portbrain.device_info['channel name']
+            cache.update(portname, portbrain.device_info['version'], serial_numbers.get(portname))
+        cache.save()
     #end if
 
     return portbrains
 #end def
 
 
-def _search_serial_ports_for_portbrain(max_count):
+def _check_cached_portbrains(cache, max_count, max_workers=DISCOVERY_WORKERS):
     """
-    Searches all available serial ports on the system for a PortBrain controller.
+    Checks the ports in the discovery cache for the units found there before.
+    Entries for ports where the unit wasn't found, or has a different firmware
+    version, are removed from the cache.
 
     Args:
+        cache (DiscoveryCache) - discovery cache.
         max_count (int) - max number of units to find.
+        max_workers (int) - max number of ports to probe at the same time.
 
-    Returns: list of port names where a portbrain was found.
+    Returns: list of connected PortBrainControllers.
     """
+    entries = cache.entries()
+    if not entries:
+        return []
+
+    # follow units that have moved to another port, by USB serial number
+    serial_numbers = serial_utils.usb_serial_numbers()
+    ports_by_serial_number = {number: portname for portname, number in serial_numbers.items()}
+    expected = {}
+    for entry in entries:
+        portname = ports_by_serial_number.get(entry['serial_number'], entry['portname'])
+        expected[portname] = entry
+    #end for
+
+    # the cache only holds a few ports, so check all of them
+    portbrains = _search_serial_ports_for_portbrain(len(expected), max_workers, portnames=list(expected))
 
     result = []
-    portnames = serial_utils.available_serial_ports()
-
-    for portname in portnames:
-        settings =  {'portname': portname, 'portsettings': DEFAULT_PORT_SETTINGS,
-            'read_terminator': b'\r',
-            'cmd_terminator': b'\r',
-            'cmd_timeout': 0.3
-        }
-        channel = SerialChannel()
-
-        logger.debug('Checking %s for PortBrain..' % portname)
-
-        if channel.open(settings):
-            try:
-                portbrain = PortBrainController(channel)
-                if portbrain.check_for_device():
-                    logger.debug('PortBrain V{} found on {}'.format(portbrain.device_info['version'], portbrain.device_info['channel name']))
-                    result.append(portname)
-
-                    if len(result) >= max_count:
-                        break
-                #end if
-            finally:
-                channel.close()
+    for portbrain in portbrains:
+        portname = portbrain.device_info['channel name']
+        entry = expected.pop(portname)
+        if portbrain.device_info['version'] != entry['version']:
+            logger.debug('PortBrain on {} changed from V{} to V{}'.format(portname, entry['version'], portbrain.device_info['version']))
+            portbrain.close()
+            cache.invalidate(entry['portname'])
+        elif len(result) < max_count:
+            result.append(portbrain)
+        else:
+            portbrain.close()
         #end if
     #end for
 
+    for portname, entry in expected.items():
+        logger.debug('Cached PortBrain not found on {}'.format(portname))
+        cache.invalidate(entry['portname'])
+    #end for
+
+    return result
+#end def
+
+
+def _close_unclaimed_portbrain(future):
+    """
+    Done callback for probes that finished after the search stopped, closes
+    any portbrain they found.
+    """
+    if future.cancelled() or future.exception() is not None:
+        return
+
+    portbrain = future.result()
+    if portbrain:
+        portbrain.close()
+#end def
+
+
+def _probe_serial_port(portname):
+    """
+    Checks a serial port for a PortBrain controller.
+
+    Args:
+        portname (str) - name of serial port.
+
+    Returns: connected PortBrainController if a portbrain was found, otherwise None.
+    """
+    settings =  {'portname': portname, 'portsettings': DEFAULT_PORT_SETTINGS,
+        'read_terminator': b'\r',
+        'cmd_terminator': b'\r',
+        'cmd_timeout': 0.3,
+        'adaptive_timeout': ADAPTIVE_TIMEOUTS
+    }
+    channel = SERIAL_CHANNEL_CLASS()
+
+    logger.debug('Checking %s for PortBrain..' % portname)
+
+    if channel.open(settings):
+        portbrain = PortBrainController(channel)
+        found = False
+        try:
+            found = portbrain.check_for_device()
+        finally:
+            if not found:
+                channel.close()
+        #end try..finally
+
+        if found:
+            logger.debug('PortBrain V{} found on {}'.format(portbrain.device_info['version'], portbrain.device_info['channel name']))
+
+            # keep the connection, with the normal command timeout
+            channel.cmd_timeout = 0.5
+            return portbrain
+        #end if
+    #end if
+
+    return None
+#end def
+
+
+def _search_serial_ports_for_portbrain(max_count, max_workers=DISCOVERY_WORKERS, deadline=DISCOVERY_DEADLINE,
+        portnames=None, exclude=()):
+    """
+    Searches all available serial ports on the system for a PortBrain controller.
+    Up to max_workers ports are probed at the same time, and the search stops
+    as soon as max_count units have been found or the deadline passes.
+
+    Args:
+        max_count (int) - max number of units to find.
+        max_workers (int) - max number of ports to probe at the same time.
+        deadline (float) - max time (in secs) to spend searching (default DISCOVERY_DEADLINE),
+            None for no limit.
+        portnames (list) - ports to search, None to search all available ports.
+        exclude (list) - ports to skip.
+
+    Returns: list of connected PortBrainControllers, one for each portbrain found.
+    """
+
+    result = []
+    if portnames is None:
+        # the probe opens each port anyway, so don't open them here too
+        portnames = serial_utils.available_serial_ports(verify=False, usb_only=DISCOVERY_USB_ONLY,
+            usb_ids=DISCOVERY_USB_IDS)
+    portnames = [portname for portname in portnames if portname not in exclude]
+    if max_count <= 0 or not portnames:
+        return result
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(portnames))))
+    futures = {executor.submit(_probe_serial_port, portname): portname for portname in portnames}
+    claimed = set()
+
+    try:
+        for future in concurrent.futures.as_completed(futures, timeout=deadline):
+            portbrain = future.result()
+            if portbrain and len(result) < max_count:
+                claimed.add(future)
+                result.append(portbrain)
+
+                if len(result) >= max_count:
+                    break
+            #end if
+        #end for
+    except concurrent.futures.TimeoutError:
+        logger.debug('PortBrain search deadline passed, {} found'.format(len(result)))
+    finally:
+        # don't start probes that are still queued, and close any unit
+        # found after the search stopped
+        for future in futures:
+            if future not in claimed and not future.cancel():
+                future.add_done_callback(_close_unclaimed_portbrain)
+        executor.shutdown(wait=False)
+    #end try..finally
+
+    # keep the system's port order
+    result.sort(key=lambda portbrain: portnames.index(portbrain.device_info['channel name']))
     return result
 #end def
 
 
 class PortBrainController(object):
-    def __init__(self, channel = None):
+    """
+    Controls a PortBrain over a device channel. Port and input numbers, and
+    the values written, are checked before anything is sent; bad ones raise
+    ValueError.
+    """
+    def __init__(self, channel = None, shadow_registers = True):
         """
         Args:
             channel: device channel object
+            shadow_registers (bool): if True, the last port directions written or
+                read, and the last output values written, are cached, and writes
+                that don't change them are skipped. Output values aren't taken
+                from reads, as a port reads back its input pins too.
         """
         self._version = ''
         self._channel = channel
+        self._shadow_registers = shadow_registers
+        self._read_cache = None
+        self._watcher = None
         self._initialize_data()
     #end def
 
 
+    def _cached_read(self, cmd) -> (bool, int):
+        """
+        Reads a value, through the read cache if it is enabled.
+
+        Arguments:
+            cmd {bytes} -- read command
+
+        Returns:
+            tuple -- (<success (bool)>, <value (int)>)
+        """
+        if self._read_cache is None:
+            return parse_value(*self._send_command(cmd))
+
+        return self._read_cache.read(cmd, lambda: parse_value(*self._send_command(cmd)))
+    #end def
+
+
     def _initialize_data(self):
         # init data to defaults
-        pass
+        self._elided_writes = 0
+        self.invalidate_shadow_registers()
     #end def
 
 
@@ -130,31 +362,131 @@ class PortBrainController(object):
             #end if
         #end if
 
+        # the state of the device is unknown after an error
+        self.invalidate_shadow_registers()
         return (False, bytes(0))
     #end def
 
 
-    def check_for_device(self) -> bool:
-        result = False
-        success, response = self._send_command(b'VER')
-
-        if success:
-            # check that response is the form of <major>.<minor>
-            try:
-                self._version = response.decode()
-                result = self._version.count('.') == 1
-            except:
-                pass
+    def _send_commands(self, cmds) -> list:
+        """
+        Sends several commands in one batch.
+
+        Arguments:
+            cmds {list} -- list of command strings (bytes)
+
+        Returns:
+            list -- list of (<success (bool)>, <response (bytes)>) tuples, in the same order as cmds
+        """
+
+        if self._is_connection_open():
+            results = self._channel.send_commands(cmds)
+        else:
+            results = [(False, bytes(0))] * len(cmds)
+
+        if not all(success for success, _ in results):
+            self.invalidate_shadow_registers()
+        return results
+    #end def
+
+
+    def _modify_port(self, portnumber: int, modify) -> bool:
+        """
+        Changes some bits of a port's output value, with one write. The
+        change is made to the last value written, if it is known. Otherwise
+        the port is read, and only its output bits (per its direction) are
+        kept: PRTRD returns the state of the pins, inputs included, and
+        writing those back would drive (or pull up) the input pins. The
+        output latch of the input pins is then written as 0.
+
+        Args:
+            portnumber (int): port to change (0-5)
+            modify: function that takes the current output value and returns the new one
+
+        Returns:
+            bool: True if successful
+        """
+        protocol.check_port_number(portnumber)
+        value = self._outputs[portnumber] if self._shadow_registers else None
+        if value is None:
+            success, pins = self.read_port(portnumber)
+            if success:
+                success, dirbits = self.get_port_direction(portnumber)
+            if not success:
+                return False
+            value = pins & dirbits
         #end if
 
+        return self.write_port(portnumber, modify(value))
+    #end def
+
+
+    def _set_read_staleness(self, cmd, max_age):
+        if self._read_cache is None:
+            self._read_cache = ReadCache()
+        self._read_cache.set_max_age(cmd, max_age)
+    #end def
+
+
+    def close(self):
+        """
+        Closes the connection to the PortBrain.
+        """
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+        if self._channel:
+            self._channel.close()
+    #end def
+
+
+    def check_for_device(self) -> bool:
+        # device may have been reset or replaced
+        self.invalidate_shadow_registers()
+
+        result, version = parse_version(*self._send_command(CMD_VERSION))
+
+        if version:
+            self._version = version
+
         return result
     #end def
 
 
+    def clear_bits(self, portnumber: int, mask: int) -> bool:
+        """
+        Clears output bits of a port, with one write.
+
+        Args:
+            portnumber (int): port to change (0-5)
+            mask (int): bits to clear
+
+        Returns:
+            bool: True if successful
+        """
+        return self._modify_port(portnumber, lambda value: value & ~mask)
+    #end def
+
+
     def get_port_direction(self, portnumber: int) -> (bool, int):
-        cmd = b'DIRRD' + str(portnumber).encode()
-        success, value = self._send_command(cmd)
-        return (success, int(value))
+        cmd = protocol.read_direction_command(portnumber)
+        if self._shadow_registers and self._directions[portnumber] is not None:
+            return (True, self._directions[portnumber])
+
+        success, dirbits = parse_value(*self._send_command(cmd))
+        if success and self._shadow_registers:
+            self._directions[portnumber] = dirbits
+        return (success, dirbits)
+    #end def
+
+
+    def invalidate_shadow_registers(self):
+        """
+        Forgets the cached port directions and outputs, so they are read
+        from (or written to) the device next time.
+        """
+        self._directions = [None] * PORT_COUNT
+        self._outputs = [None] * PORT_COUNT
     #end def
 
 
@@ -169,9 +501,40 @@ class PortBrainController(object):
         Returns:
             tuple: (success, value)
         """
-        cmd = b'ADC' + str(inputnumber).encode()
-        success, value = self._send_command(cmd)
-        return (success, int(value))
+        return self._cached_read(protocol.read_analog_command(inputnumber))
+    #end def
+
+
+    def read_analog_inputs(self, inputnumbers=range(ANALOG_INPUT_COUNT)) -> list:
+        """
+        Reads several analog inputs with one batch of pipelined commands.
+
+        Args:
+            inputnumbers (list): input numbers to read (0-4), defaults to all inputs
+
+        Returns:
+            list: (success, value) tuple for each input, in the same order as inputnumbers
+        """
+        return protocol.parse_values(self._send_commands(protocol.read_analog_commands(inputnumbers)))
+    #end def
+
+
+    def read_inputs(self, inputnumbers=range(ANALOG_INPUT_COUNT), portnumbers=range(PORT_COUNT)) -> (list, list):
+        """
+        Reads analog inputs and digital ports together, with one batch of pipelined commands.
+
+        Args:
+            inputnumbers (list): analog input numbers to read (0-4), defaults to all inputs
+            portnumbers (list): port numbers to read (0-5), defaults to all ports
+
+        Returns:
+            tuple: (analog input results, port results), each a list of (success, value) tuples
+        """
+        cmds = protocol.read_analog_commands(inputnumbers)
+        split = len(cmds)
+        cmds += protocol.read_port_commands(portnumbers)
+        results = protocol.parse_values(self._send_commands(cmds))
+        return (results[:split], results[split:])
     #end def
 
 
@@ -186,23 +549,126 @@ class PortBrainController(object):
         Returns:
             tuple: (success, value)
         """
-        cmd = b'PRTRD' + str(portnumber).encode()
-        success, response = self._send_command(cmd)
+        return self._cached_read(protocol.read_port_command(portnumber))
+    #end def
+
+
+    def read_ports(self, portnumbers=range(PORT_COUNT)) -> list:
+        """
+        Reads several digital ports with one batch of pipelined commands.
 
-        if success:
-            return (True, int(response))
-        else:
-            return (False, 0)
+        Args:
+            portnumbers (list): port numbers to read (0-5), defaults to all ports
+
+        Returns:
+            list: (success, value) tuple for each port, in the same order as portnumbers
+        """
+        return protocol.parse_values(self._send_commands(protocol.read_port_commands(portnumbers)))
+    #end def
+
+
+    def set_analog_input_staleness(self, inputnumber: int, max_age: float):
+        """
+        Enables caching of read_analog_input() results for an input.
+
+        Args:
+            inputnumber (int): input number (0-4)
+            max_age (float): max age (in secs) of a cached value, None to disable caching
+        """
+        self._set_read_staleness(protocol.read_analog_command(inputnumber), max_age)
+    #end def
+
+
+    def set_bits(self, portnumber: int, mask: int) -> bool:
+        """
+        Sets output bits of a port, with one write.
+
+        Args:
+            portnumber (int): port to change (0-5)
+            mask (int): bits to set
+
+        Returns:
+            bool: True if successful
+        """
+        return self._modify_port(portnumber, lambda value: value | mask)
     #end def
 
 
     def set_port_direction(self, portnumber: int, dirbits: int) -> bool:
-        cmd = b'DIRWR' + str(portnumber).encode() + str(dirbits).encode()
+        cmd = protocol.write_direction_command(portnumber, dirbits)
+        if self._shadow_registers and self._directions[portnumber] == dirbits:
+            self._elided_writes += 1
+            return True
+
         success, _ = self._send_command(cmd)
+        if success and self._shadow_registers:
+            self._directions[portnumber] = dirbits
+
+        # pins that changed direction read back differently now
+        if self._read_cache is not None:
+            self._read_cache.invalidate(protocol.READ_PORT_COMMANDS[portnumber])
+
         return success
     #end def
 
 
+    def set_port_staleness(self, portnumber: int, max_age: float):
+        """
+        Enables caching of read_port() results for a port. Concurrent reads
+        of the same port share one request whether or not it is cached.
+
+        Args:
+            portnumber (int): port number (0-5)
+            max_age (float): max age (in secs) of a cached value, None to disable caching
+        """
+        self._set_read_staleness(protocol.read_port_command(portnumber), max_age)
+    #end def
+
+
+    def toggle_bits(self, portnumber: int, mask: int) -> bool:
+        """
+        Toggles output bits of a port, with one write.
+
+        Args:
+            portnumber (int): port to change (0-5)
+            mask (int): bits to toggle
+
+        Returns:
+            bool: True if successful
+        """
+        return self._modify_port(portnumber, lambda value: value ^ mask)
+    #end def
+
+
+    def watch(self, portnumber: int, mask: int = 0xFF, latency: float = 0.05, callback=None):
+        """
+        Watches bits of a port for changes. All the watches of a controller
+        share one background poller, which reads the ports that are due
+        together (see PortWatcher). The first watch puts the channel behind
+        a ThreadedChannel, so the controller can still be used from other
+        threads while the poller runs.
+
+        Args:
+            portnumber (int): port to watch (0-5)
+            mask (int): bits to watch
+            latency (float): max time (in secs) from a change to it being seen
+            callback: function called with each EdgeEvent, on the poller's
+                thread; None to take the events from the returned watch
+                (get(), for, or async for)
+
+        Returns:
+            PortWatch: call cancel() on it to stop watching
+        """
+        if self._watcher is None:
+            if self._channel is not None and not isinstance(self._channel, ThreadedChannel):
+                self._channel = ThreadedChannel(self._channel)
+            self._watcher = PortWatcher(self)
+        #end if
+
+        return self._watcher.watch(portnumber, mask, latency, callback)
+    #end def
+
+
     def write_port(self, portnumber: int, value: int) -> bool:
         """
         Write to a port
@@ -214,12 +680,42 @@ class PortBrainController(object):
         Returns:
             bool: True if successful
         """
-        cmd = b'PRTWR' + str(portnumber).encode()
-        success, response = self._send_command(cmd)
+        cmd = protocol.write_port_command(portnumber, value)
+        if self._shadow_registers and self._outputs[portnumber] == value:
+            self._elided_writes += 1
+            return True
+
+        success, _ = self._send_command(cmd)
+        if success and self._shadow_registers:
+            self._outputs[portnumber] = value
+
+        # the port reads back differently now
+        if self._read_cache is not None:
+            self._read_cache.invalidate(protocol.READ_PORT_COMMANDS[portnumber])
+
         return success
     #end def
 
 
+    @property
+    def channel(self):
+        """
+        Device channel used to talk to the PortBrain.
+        """
+        return self._channel
+
+
+    @property
+    def channel_stats(self):
+        """
+        Per-command statistics (ChannelStats) of the channel, None if not connected.
+        """
+        if self._channel:
+            return self._channel.stats
+        return None
+    #end def
+
+
     @property
     def device_info(self):
         if self._channel:
@@ -228,6 +724,32 @@ class PortBrainController(object):
             cn = 'None'
         return {'version': self._version, 'channel name': cn}
     #end def
+
+
+    @property
+    def elided_writes(self):
+        """
+        Number of writes skipped because they wouldn't change anything.
+        """
+        return self._elided_writes
+
+
+    @property
+    def read_cache_stats(self):
+        """
+        Read cache hit, miss and coalesced counts, see ReadCache.stats.
+        """
+        if self._read_cache is None:
+            return {'hits': 0, 'misses': 0, 'coalesced': 0}
+        return self._read_cache.stats
+
+
+    @property
+    def last_error(self):
+        if self._channel:
+            return self._channel.last_error
+        return 'not connected'
+    #end def
 #end class
 
 
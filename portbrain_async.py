@@ -0,0 +1,174 @@
+# PortBrain asyncio module
+
+import portbrain_protocol as protocol
+from portbrain_protocol import ANALOG_INPUT_COUNT, PORT_COUNT, CMD_VERSION, parse_value, parse_version
+
+
+class AsyncPortBrainController(object):
+    """
+    asyncio version of PortBrainController, for use with an
+    AsyncDeviceChannel. Each call is a coroutine, so one event loop can
+    drive many boards at once.
+    """
+    def __init__(self, channel = None):
+        """
+        Args:
+            channel: async device channel object
+        """
+        self._version = ''
+        self._channel = channel
+    #end def
+
+
+    def _is_connection_open(self) -> bool:
+        result = False
+        if self._channel:
+            result = self._channel.is_open()
+        return result
+    #end def
+
+
+    async def _send_command(self, cmd) -> (bool, bytes):
+        """
+        Sends a command to the PortBrain.
+
+        Arguments:
+            cmd {bytes} -- command string
+
+        Returns:
+            tuple -- (<success (bool)>, <response (bytes)>)
+        """
+
+        if self._is_connection_open():
+            success, response = await self._channel.send_command(cmd)
+
+            if success:
+                return (True, response)
+        #end if
+
+        return (False, bytes(0))
+    #end def
+
+
+    async def _send_commands(self, cmds) -> list:
+        """
+        Sends several commands in one batch.
+
+        Arguments:
+            cmds {list} -- list of command strings (bytes)
+
+        Returns:
+            list -- list of (<success (bool)>, <response (bytes)>) tuples, in the same order as cmds
+        """
+
+        if self._is_connection_open():
+            return await self._channel.send_commands(cmds)
+
+        return [(False, bytes(0))] * len(cmds)
+    #end def
+
+
+    async def check_for_device(self) -> bool:
+        result, version = parse_version(*await self._send_command(CMD_VERSION))
+
+        if version:
+            self._version = version
+
+        return result
+    #end def
+
+
+    async def get_port_direction(self, portnumber: int) -> (bool, int):
+        return parse_value(*await self._send_command(protocol.read_direction_command(portnumber)))
+    #end def
+
+
+    async def read_analog_input(self, inputnumber: int) -> (bool, int):
+        """
+        Read from an analog input
+
+        Args:
+            inputnumber (int): input number (0-4)
+
+        Returns:
+            tuple: (success, value)
+        """
+        return parse_value(*await self._send_command(protocol.read_analog_command(inputnumber)))
+    #end def
+
+
+    async def read_analog_inputs(self, inputnumbers=range(ANALOG_INPUT_COUNT)) -> list:
+        """
+        Reads several analog inputs with one batch of pipelined commands.
+
+        Args:
+            inputnumbers (list): input numbers to read (0-4), defaults to all inputs
+
+        Returns:
+            list: (success, value) tuple for each input, in the same order as inputnumbers
+        """
+        return protocol.parse_values(await self._send_commands(protocol.read_analog_commands(inputnumbers)))
+    #end def
+
+
+    async def read_port(self, portnumber: int) -> (bool, int):
+        """
+        Reads a digital port
+
+        Args:
+            portnumber (int): portnumber to read (0-5)
+
+        Returns:
+            tuple: (success, value)
+        """
+        return parse_value(*await self._send_command(protocol.read_port_command(portnumber)))
+    #end def
+
+
+    async def read_ports(self, portnumbers=range(PORT_COUNT)) -> list:
+        """
+        Reads several digital ports with one batch of pipelined commands.
+
+        Args:
+            portnumbers (list): port numbers to read (0-5), defaults to all ports
+
+        Returns:
+            list: (success, value) tuple for each port, in the same order as portnumbers
+        """
+        return protocol.parse_values(await self._send_commands(protocol.read_port_commands(portnumbers)))
+    #end def
+
+
+    async def set_port_direction(self, portnumber: int, dirbits: int) -> bool:
+        cmd = protocol.write_direction_command(portnumber, dirbits)
+        success, _ = await self._send_command(cmd)
+        return success
+    #end def
+
+
+    async def write_port(self, portnumber: int, value: int) -> bool:
+        """
+        Write to a port
+
+        Args:
+            portnumber (int): Port to write to (0-5)
+            value (int): Port value
+
+        Returns:
+            bool: True if successful
+        """
+        cmd = protocol.write_port_command(portnumber, value)
+        success, _ = await self._send_command(cmd)
+        return success
+    #end def
+
+
+    @property
+    def device_info(self):
+        if self._channel:
+            cn = self._channel.name
+        else:
+            cn = 'None'
+        return {'version': self._version, 'channel name': cn}
+    #end def
+#end class
@@ -0,0 +1,302 @@
+# !python3
+"""
+Benchmarks for the PortBrain stack: command throughput and latency
+percentiles per PortBrainController operation, fleet-wide snapshot time,
+and enumerate_portbrains() time as the number of ports grows.
+
+Runs against simulated boards (SimulatedChannel) and pty-emulated boards
+(PortBrainEmulator, Linux only). Results are written as JSON and can be
+compared with a baseline file, flagging regressions.
+
+Usage:
+    python portbrain_bench.py --output results.json
+    python portbrain_bench.py --baseline results.json --tolerance 0.2
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+from time import perf_counter
+
+from device_channel_sim import simulated_portbrains
+import portbrain
+from portbrain_fleet import PortBrainFleet
+
+__author__ = 'Scott Pinkham, Byte Arts LLC'
+__version__ = '2019.513.0'
+
+TARGETS = ['sim', 'pty']
+
+
+def _is_failure(result):
+    """
+    Returns True if the result of an operation shows that it failed. The
+    operations return a bool, a (success, value) tuple, or a list of those
+    (read_ports()) or a tuple of such lists (read_inputs()); a list or
+    tuple fails if anything in it failed.
+    """
+    if isinstance(result, bool):
+        return not result
+    if isinstance(result, tuple) and len(result) == 2 and isinstance(result[0], bool):
+        return not result[0]
+    if isinstance(result, (list, tuple)):
+        return any(_is_failure(item) for item in result)
+    return False
+#end def
+
+
+def _percentile(sorted_values, percent):
+    """
+    Returns the value at a percentile of a sorted list (nearest rank).
+    """
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(percent / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+#end def
+
+
+def _summarize(latencies, total_time):
+    """
+    Summarizes a list of latencies (in secs).
+
+    Returns: dict with ops_per_sec and p50/p95/p99 latencies (in ms)
+    """
+    latencies = sorted(latencies)
+    return {
+        'ops_per_sec': len(latencies) / total_time if total_time > 0 else 0.0,
+        'p50_ms': _percentile(latencies, 50) * 1000.0,
+        'p95_ms': _percentile(latencies, 95) * 1000.0,
+        'p99_ms': _percentile(latencies, 99) * 1000.0,
+    }
+#end def
+
+
+def _time_calls(function, iterations, setup=None):
+    """
+    Times a number of calls of a function.
+
+    Args:
+        function: function to call, with the iteration number
+        iterations (int): number of calls
+        setup: optional function called (untimed) before each call
+
+    Returns: dict, see _summarize()
+    """
+    latencies = []
+    failures = 0
+    total_time = 0.0
+    for i in range(iterations):
+        if setup:
+            setup()
+        start = perf_counter()
+        result = function(i)
+        elapsed = perf_counter() - start
+        latencies.append(elapsed)
+        total_time += elapsed
+
+        if _is_failure(result):
+            failures += 1
+    #end for
+
+    summary = _summarize(latencies, total_time)
+    summary['failures'] = failures
+    return summary
+#end def
+
+
+def bench_operations(pb, iterations):
+    """
+    Measures each PortBrainController operation on one board.
+
+    Returns: dict of operation name -> summary
+    """
+    return {
+        'check_for_device': _time_calls(lambda i: pb.check_for_device(), iterations),
+        'read_port': _time_calls(lambda i: pb.read_port(0), iterations),
+        # alternate the values so the writes aren't skipped by the shadow registers
+        'write_port': _time_calls(lambda i: pb.write_port(0, i & 0xFF), iterations),
+        'read_analog_input': _time_calls(lambda i: pb.read_analog_input(0), iterations),
+        'get_port_direction': _time_calls(lambda i: pb.get_port_direction(0), iterations,
+            setup=pb.invalidate_shadow_registers),
+        'set_port_direction': _time_calls(lambda i: pb.set_port_direction(0, i & 0xFF), iterations),
+        'read_inputs': _time_calls(lambda i: pb.read_inputs(), iterations),
+    }
+#end def
+
+
+def bench_fleet_snapshot(portbrains, iterations):
+    """
+    Measures a snapshot of all inputs of every board in a fleet.
+
+    Returns: summary
+    """
+    fleet = PortBrainFleet(portbrains)
+    try:
+        return _time_calls(lambda i: all(result.success for result in fleet.snapshot()), iterations)
+    finally:
+        fleet.close()
+#end def
+
+
+def _check_found(portbrains, target):
+    """
+    Exits with an error if no boards were found for a target.
+    """
+    if not portbrains:
+        sys.exit('No PortBrains found for the {} target, nothing to benchmark'.format(target))
+#end def
+
+
+def _run_sim(args):
+    settings = {'latency': args.latency, 'baud': args.baud}
+    results = {}
+
+    portbrains = simulated_portbrains(max(1, args.boards), settings)
+    _check_found(portbrains, 'sim')
+    results['operations'] = bench_operations(portbrains[0], args.iterations)
+    results['fleet_snapshot'] = bench_fleet_snapshot(portbrains, max(1, args.iterations // 10))
+    return results
+#end def
+
+
+def _run_pty(args):
+    # imported here as it needs Linux ptys
+    from portbrain_emulator import PortBrainEmulator
+
+    results = {}
+    with PortBrainEmulator(count=max(1, args.boards), delay=args.latency) as emulator:
+        portbrains = portbrain.enumerate_portbrains(max(1, args.boards), portnames=emulator.portnames)
+        _check_found(portbrains, 'pty')
+        results['operations'] = bench_operations(portbrains[0], args.iterations)
+        results['fleet_snapshot'] = bench_fleet_snapshot(portbrains, max(1, args.iterations // 10))
+    #end with
+
+    # discovery time as the number of ports grows
+    discovery = {}
+    for count in args.discovery_counts:
+        with PortBrainEmulator(count=count, delay=args.latency) as emulator:
+            start = perf_counter()
+            portbrains = portbrain.enumerate_portbrains(count, portnames=emulator.portnames)
+            elapsed = perf_counter() - start
+            for pb in portbrains:
+                pb.close()
+        #end with
+        discovery[str(count)] = {'wall_secs': elapsed, 'found': len(portbrains)}
+    #end for
+    results['discovery'] = discovery
+
+    return results
+#end def
+
+
+def _flatten(results, prefix=''):
+    """
+    Flattens nested result dicts into {'a.b.c': value}.
+    """
+    flat = {}
+    for key, value in results.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name + '.'))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    #end for
+    return flat
+#end def
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    Compares results with a baseline. Throughput metrics (ops_per_sec)
+    regress when they drop, time metrics (_ms, _secs) when they rise, by
+    more than the tolerance.
+
+    Args:
+        results (dict): benchmark results
+        baseline (dict): baseline results
+        tolerance (float): allowed relative change, e.g. 0.1 for 10%
+
+    Returns: (list) of (metric, baseline value, new value) for each regression
+    """
+    current = _flatten(results['targets'])
+    previous = _flatten(baseline['targets'])
+
+    regressions = []
+    for name, old in sorted(previous.items()):
+        if name not in current or old <= 0:
+            continue
+
+        new = current[name]
+        if name.endswith('ops_per_sec'):
+            regressed = new < old * (1.0 - tolerance)
+        elif name.endswith('_ms') or name.endswith('_secs'):
+            regressed = new > old * (1.0 + tolerance)
+        else:
+            continue
+
+        if regressed:
+            regressions.append((name, old, new))
+    #end for
+
+    return regressions
+#end def
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='PortBrain benchmarks')
+    parser.add_argument('--targets', nargs='+', choices=TARGETS, default=TARGETS, help='boards to run against')
+    parser.add_argument('--iterations', type=int, default=500, help='calls per operation')
+    parser.add_argument('--boards', type=int, default=8, help='boards in the fleet')
+    parser.add_argument('--latency', type=float, default=0.0005, help='board response latency (secs)')
+    parser.add_argument('--baud', type=int, default=115200, help='simulated baud rate')
+    parser.add_argument('--discovery-counts', type=int, nargs='+', default=[1, 4, 16, 32],
+        help='port counts for the discovery benchmark')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    parser.add_argument('--baseline', help='JSON results file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative change before flagging')
+    args = parser.parse_args(argv)
+
+    results = {
+        'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'platform': platform.platform(), 'args': vars(args)},
+        'targets': {},
+    }
+
+    runners = {'sim': _run_sim, 'pty': _run_pty}
+    for target in args.targets:
+        if target == 'pty' and not sys.platform.startswith('linux'):
+            print('Skipping pty target (Linux only)')
+            continue
+        print('Running {} benchmarks..'.format(target))
+        results['targets'][target] = runners[target](args)
+    #end for
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        for name, old, new in regressions:
+            print('REGRESSION {}: {:.4g} -> {:.4g}'.format(name, old, new))
+        if regressions:
+            return 1
+        print('No regressions against {}'.format(args.baseline))
+    #end if
+
+    return 0
+#end def
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+#end if
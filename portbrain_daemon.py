@@ -0,0 +1,770 @@
+# !python3
+"""
+Module for a local daemon that keeps the PortBrains open and serves them
+to other processes over a Unix domain socket, so several tools can share
+the boards and don't have to run discovery themselves.
+
+Requests from all clients are queued onto each board's link and sent in
+pipelined batches (see ThreadedChannel). Identical read requests that are
+waiting at the same time are answered by a single read.
+
+Usage:
+    python portbrain_daemon.py --max-count 4
+
+    # in a client process
+    portbrains = daemon_portbrains()
+
+Protocol: every message starts with a header (request id, op or status,
+board index, payload length). A commands request carries the commands
+as (length byte, bytes) pairs; its response carries the channel's error
+text (length byte, bytes), then a (success byte, length, bytes) result
+per command. A list response carries each board's name, version and
+command timeout (secs) as (length byte, text) fields.
+"""
+
+import argparse
+import logging
+import os
+import queue
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import threading
+
+from device_channel import DeviceChannel
+from device_channel_threaded import ThreadedChannel
+import portbrain
+from portbrain import PortBrainController
+import portbrain_protocol as protocol
+from timeout import Timeout
+
+__author__ = 'Scott Pinkham, Byte Arts LLC'
+__version__ = '2019.513.0'
+
+logger = logging.getLogger(__name__)
+
+# request id, op (request) or status (response), board index, payload length
+HEADER = struct.Struct('<IBBH')
+RESULT = struct.Struct('<BH')
+
+OP_LIST = 1
+OP_COMMANDS = 2
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+MAX_PAYLOAD = 0xFFFF
+MAX_COMMAND_LENGTH = 0xFF
+
+# replies a client can fall behind by before it is disconnected
+MAX_QUEUED_REPLIES = 1024
+
+# extra time (in secs) a client allows for its request to wait behind other clients' requests
+QUEUE_HEADROOM = 1.0
+
+
+def default_socket_path():
+    """
+    Returns the default location of the daemon's socket.
+    """
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'portbrain.sock')
+    return os.path.join(tempfile.gettempdir(), 'portbrain-{}.sock'.format(os.getuid()))
+#end def
+
+
+def _recv_exact(sock, count):
+    """
+    Receives exactly count bytes.
+
+    Returns: (bytes) or None if the connection closed first.
+    """
+    data = bytearray()
+    while len(data) < count:
+        chunk = sock.recv(count - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    #end while
+    return bytes(data)
+#end def
+
+
+def _recv_message(sock):
+    """
+    Receives one message.
+
+    Returns: (tuple) (request_id, op, board, payload), or None if the connection closed.
+    """
+    header = _recv_exact(sock, HEADER.size)
+    if header is None:
+        return None
+
+    request_id, op, board, length = HEADER.unpack(header)
+    payload = _recv_exact(sock, length) if length else b''
+    if payload is None:
+        return None
+    return (request_id, op, board, payload)
+#end def
+
+
+def pack_commands(cmds):
+    """
+    Packs commands into a request payload.
+
+    Raises: ValueError if a command or the payload is too long for the protocol.
+    """
+    parts = []
+    for cmd in cmds:
+        if len(cmd) > MAX_COMMAND_LENGTH:
+            raise ValueError('command is {} bytes long, max is {}'.format(len(cmd), MAX_COMMAND_LENGTH))
+        parts.append(bytes([len(cmd)]))
+        parts.append(cmd)
+    #end for
+
+    payload = b''.join(parts)
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError('commands take {} bytes, max is {}'.format(len(payload), MAX_PAYLOAD))
+    return payload
+#end def
+
+
+def unpack_commands(payload):
+    cmds = []
+    view = memoryview(payload)
+    offset = 0
+    while offset < len(view):
+        length = view[offset]
+        cmds.append(bytes(view[offset + 1:offset + 1 + length]))
+        offset += 1 + length
+    #end while
+    return cmds
+#end def
+
+
+def pack_results(results, error):
+    error = error.encode('utf-8', 'replace')[:255]
+    parts = [bytes([len(error)]), error]
+    for success, response in results:
+        response = bytes(response)
+        parts.append(RESULT.pack(1 if success else 0, len(response)))
+        parts.append(response)
+    #end for
+    return b''.join(parts)
+#end def
+
+
+def unpack_results(payload):
+    """
+    Returns: (tuple) (results, error) where results is a list of (success, response).
+    """
+    view = memoryview(payload)
+    offset = 1 + view[0]
+    error = bytes(view[1:offset]).decode('utf-8', 'replace')
+
+    results = []
+    while offset < len(view):
+        success, length = RESULT.unpack_from(view, offset)
+        offset += RESULT.size
+        results.append((success == 1, bytes(view[offset:offset + length])))
+        offset += length
+    #end while
+    return (results, error)
+#end def
+
+
+class _Board(object):
+    """
+    A board served by the daemon: its shared channel and the reads that
+    are waiting to be sent.
+    """
+    def __init__(self, name, version, channel):
+        self.name = name
+        self.version = version
+        self.channel = channel
+        self.lock = threading.Lock()
+        self.pending_reads = {}
+        self.requests = 0
+        self.coalesced = 0
+    #end def
+
+
+    def _forget_read(self, key, future):
+        with self.lock:
+            if self.pending_reads.get(key) is future:
+                del self.pending_reads[key]
+    #end def
+
+
+    def submit(self, cmds):
+        """
+        Queues a client's commands.
+
+        Returns: (Future) resolving to a list of (success, response) tuples.
+        """
+        key = tuple(cmds)
+        is_read = all(protocol.is_read_command(cmd) for cmd in cmds)
+
+        with self.lock:
+            self.requests += 1
+            if not is_read:
+                # reads queued before a write mustn't answer reads made after it
+                self.pending_reads.clear()
+                return self.channel.submit_many(cmds)
+            #end if
+
+            future = self.pending_reads.get(key)
+            if future is not None and not future.running() and not future.done():
+                self.coalesced += 1
+                return future
+            #end if
+
+            future = self.channel.submit_many(cmds)
+            self.pending_reads[key] = future
+        #end with
+
+        future.add_done_callback(lambda f: self._forget_read(key, f))
+        return future
+    #end def
+#end class
+
+
+class _Client(object):
+    """
+    A connected client. Replies are queued and sent by the client's own
+    writer thread, so a slow or stalled client can't hold up the board
+    workers that complete its requests, or other clients.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self._replies = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='portbrain-daemon-writer', daemon=True)
+        self._thread.start()
+    #end def
+
+
+    def _run(self):
+        """
+        Writer loop, runs on the client's writer thread.
+        """
+        while True:
+            message = self._replies.get()
+            if message is None:
+                break
+
+            try:
+                self.conn.sendall(message)
+            except OSError:
+                # client has gone; the reader sees that too and stops
+                self.disconnect()
+                break
+            #end try..except
+        #end while
+    #end def
+
+
+    def close(self):
+        """
+        Stops the writer once the queued replies have been sent.
+        """
+        self._replies.put(None)
+        self._thread.join()
+    #end def
+
+
+    def disconnect(self):
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    #end def
+
+
+    def send(self, request_id, status, board, payload):
+        """
+        Queues a reply; never blocks.
+        """
+        if self._replies.qsize() >= MAX_QUEUED_REPLIES:
+            logger.warning('Disconnecting a client that stopped reading its replies')
+            self.disconnect()
+            return
+        #end if
+        self._replies.put(HEADER.pack(request_id, status, board, len(payload)) + payload)
+    #end def
+#end class
+
+
+class PortBrainDaemon(object):
+    """
+    Serves PortBrains to client processes over a Unix domain socket.
+
+    Args:
+        portbrains (list): connected PortBrainController objects, e.g. from
+            enumerate_portbrains(). The daemon takes over their channels.
+        socket_path (str): socket to listen on, defaults to default_socket_path().
+    """
+    def __init__(self, portbrains, socket_path=None):
+        self._socket_path = socket_path or default_socket_path()
+        self._boards = []
+        for pb in portbrains:
+            self._boards.append(_Board(pb.device_info['channel name'], pb.device_info['version'],
+                ThreadedChannel(pb.channel)))
+        #end for
+
+        self._server = None
+        self._thread = None
+        self._clients = set()
+        self._clients_lock = threading.Lock()
+    #end def
+
+
+    def __enter__(self):
+        self.start()
+        return self
+    #end def
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+    #end def
+
+
+    def _accept(self):
+        """
+        Accept loop, runs on the daemon's thread.
+        """
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                # server socket closed by stop()
+                break
+
+            client = _Client(conn)
+            with self._clients_lock:
+                self._clients.add(client)
+            threading.Thread(target=self._serve_client, args=(client,), daemon=True,
+                name='portbrain-daemon-client').start()
+        #end while
+    #end def
+
+
+    def _list_payload(self):
+        parts = []
+        for board in self._boards:
+            for text in (board.name, board.version, str(board.channel.cmd_timeout)):
+                data = text.encode('utf-8')[:255]
+                parts.append(bytes([len(data)]))
+                parts.append(data)
+        #end for
+        return b''.join(parts)
+    #end def
+
+
+    def _send_results(self, client, request_id, index, future):
+        """
+        Queues the response to a commands request; called on the board's
+        worker thread when the commands complete, so it must not block.
+        """
+        board = self._boards[index]
+        try:
+            results = future.result()
+        except Exception as e:
+            client.send(request_id, STATUS_ERROR, index, repr(e).encode()[:MAX_PAYLOAD])
+            return
+        #end try..except
+
+        error = '' if all(success for success, _ in results) else board.channel.last_error
+        payload = pack_results(results, error)
+        if len(payload) > MAX_PAYLOAD:
+            client.send(request_id, STATUS_ERROR, index, b'response too long')
+        else:
+            client.send(request_id, STATUS_OK, index, payload)
+    #end def
+
+
+    def _serve_client(self, client):
+        """
+        Reads a client's requests and queues them. Responses are sent as
+        they complete, so a client can have several requests in flight.
+        """
+        try:
+            while True:
+                message = _recv_message(client.conn)
+                if message is None:
+                    break
+
+                request_id, op, index, payload = message
+                if op == OP_LIST:
+                    client.send(request_id, STATUS_OK, 0, self._list_payload())
+                elif op == OP_COMMANDS and index < len(self._boards):
+                    future = self._boards[index].submit(unpack_commands(payload))
+                    future.add_done_callback(
+                        lambda f, request_id=request_id, index=index:
+                            self._send_results(client, request_id, index, f))
+                else:
+                    client.send(request_id, STATUS_ERROR, index, b'bad request')
+            #end while
+        except OSError:
+            pass
+        finally:
+            with self._clients_lock:
+                self._clients.discard(client)
+            client.close()
+            client.conn.close()
+        #end try..finally
+    #end def
+
+
+    def start(self):
+        """
+        Starts listening for clients.
+        """
+        if self._server is not None:
+            return
+
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self._socket_path)
+        self._server.listen(16)
+        self._thread = threading.Thread(target=self._accept, name='portbrain-daemon', daemon=True)
+        self._thread.start()
+        logger.info('Serving {} PortBrain(s) on {}'.format(len(self._boards), self._socket_path))
+    #end def
+
+
+    def stop(self):
+        """
+        Stops serving, disconnects the clients and closes the boards.
+        """
+        if self._server is None:
+            return
+
+        self._server.shutdown(socket.SHUT_RDWR)
+        self._server.close()
+        self._server = None
+        self._thread.join()
+        self._thread = None
+
+        with self._clients_lock:
+            for client in self._clients:
+                client.disconnect()
+        #end with
+
+        for board in self._boards:
+            board.channel.close()
+
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+    #end def
+
+
+    @property
+    def socket_path(self):
+        return self._socket_path
+
+
+    @property
+    def stats(self):
+        """
+        Returns dict of board name -> dict with the number of requests
+        served and how many of them shared another request's read.
+        """
+        return {board.name: {'requests': board.requests, 'coalesced': board.coalesced} for board in self._boards}
+#end class
+
+
+class DaemonChannel(DeviceChannel):
+    """
+    Channel to a PortBrain served by a PortBrainDaemon. Each channel has
+    its own connection to the daemon.
+    """
+    def __init__(self):
+        self._socket = None
+        self._board_index = 0
+        self._board_name = ''
+        self._board_timeout = None
+        self._next_request_id = 0
+        self._rx_buffer = bytearray()
+        super(DaemonChannel, self).__init__()
+    #end def
+
+
+    def _list_boards(self):
+        """
+        Returns: (list) of (name, version, cmd timeout) tuples, in board index order.
+        """
+        status, payload = self._request(OP_LIST, timeout=QUEUE_HEADROOM)
+        if status != STATUS_OK:
+            return []
+
+        fields = []
+        view = memoryview(payload)
+        offset = 0
+        while offset < len(view):
+            length = view[offset]
+            fields.append(bytes(view[offset + 1:offset + 1 + length]).decode('utf-8', 'replace'))
+            offset += 1 + length
+        #end while
+        return [(name, version, float(timeout)) for name, version, timeout
+            in zip(fields[0::3], fields[1::3], fields[2::3])]
+    #end def
+
+
+    def _next_message(self):
+        """
+        Takes the next complete message out of the receive buffer.
+
+        Returns: (tuple) (request_id, status, board, payload), or None if
+            no complete message has been received yet.
+        """
+        if len(self._rx_buffer) < HEADER.size:
+            return None
+
+        request_id, status, board, length = HEADER.unpack_from(self._rx_buffer)
+        end = HEADER.size + length
+        if len(self._rx_buffer) < end:
+            return None
+
+        payload = bytes(self._rx_buffer[HEADER.size:end])
+        del self._rx_buffer[:end]
+        return (request_id, status, board, payload)
+    #end def
+
+
+    def _request(self, op, payload=b'', timeout=None):
+        """
+        Sends a request and waits for its response. A response that comes
+        after its request timed out is dropped while waiting for a later one.
+
+        Returns: (tuple) (status, payload), status None if the daemon didn't answer.
+        """
+        self._next_request_id = (self._next_request_id + 1) & 0xFFFFFFFF
+        request_id = self._next_request_id
+        deadline = Timeout(timeout)
+        try:
+            self._socket.settimeout(timeout)
+            self._socket.sendall(HEADER.pack(request_id, op, self._board_index, len(payload)) + payload)
+
+            while True:
+                message = self._next_message()
+                if message is not None:
+                    if message[0] == request_id:
+                        return (message[1], message[3])
+                    continue
+                #end if
+
+                if deadline.is_expired():
+                    return (None, b'')
+                self._socket.settimeout(deadline.remaining())
+                try:
+                    data = self._socket.recv(65536)
+                except socket.timeout:
+                    return (None, b'')
+                if not data:
+                    break
+                self._rx_buffer += data
+            #end while
+        except OSError:
+            pass
+
+        # the daemon is gone, or a request was only partly sent
+        self.close()
+        return (None, b'')
+    #end def
+
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        self._rx_buffer.clear()
+        super(DaemonChannel, self).close()
+    #end def
+
+
+    def list_boards(self):
+        """
+        Gets the boards served by the daemon.
+
+        Returns: (list) of (name, version) tuples, in board index order.
+        """
+        return [(name, version) for name, version, _ in self._list_boards()]
+    #end def
+
+
+    def open(self, settings):
+        """
+        Connects to the daemon.
+
+        Args:
+            settings = {socket_path: <daemon socket, default_socket_path() if not given>,
+                board: <name or index of the board (default 0)>}
+            plus the DeviceChannel settings.
+
+        Returns: bool
+        """
+        super(DaemonChannel, self).open(settings)
+        self.close()
+
+        try:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(settings.get('socket_path') or default_socket_path())
+        except OSError:
+            self._socket = None
+            return False
+        #end try..except
+        self._channel_handle = DeviceChannel.VALID_HANDLE
+
+        board = settings.get('board', 0)
+        boards = self._list_boards()
+        names = [name for name, _, _ in boards]
+        if isinstance(board, int) and 0 <= board < len(boards):
+            self._board_index = board
+        elif board in names:
+            self._board_index = names.index(board)
+        else:
+            self.close()
+            return False
+        #end if
+
+        self._board_name = names[self._board_index]
+        self._board_timeout = boards[self._board_index][2]
+        return True
+    #end def
+
+
+    def read(self):
+        return (False, bytes(0))
+    #end def
+
+
+    def send_command(self, cmd):
+        return self.send_commands([cmd])[0]
+    #end def
+
+
+    def send_commands(self, cmds):
+        """
+        Sends commands to the board through the daemon.
+
+        Returns: (list): list of (success, response) tuples, in the same
+            order as cmds.
+        """
+        if not cmds:
+            return []
+
+        self._last_error = ''
+        results = [(False, bytes(0))] * len(cmds)
+        if not self.is_open():
+            self._last_error = 'not connected'
+            return results
+
+        try:
+            payload = pack_commands(cmds)
+        except ValueError as e:
+            self._last_error = str(e)
+            return results
+        #end try..except
+
+        # the board's own timeout, plus time for other clients' commands queued ahead
+        status, payload = self._request(OP_COMMANDS, payload,
+            timeout=self._board_timeout * (len(cmds) + 1) + QUEUE_HEADROOM)
+        if status == STATUS_OK:
+            results, self._last_error = unpack_results(payload)
+        elif status is None:
+            self._last_error = 'daemon'
+        else:
+            self._last_error = payload.decode('utf-8', 'replace')
+
+        return results
+    #end def
+
+
+    def write(self, data):
+        return False
+    #end def
+
+
+    @property
+    def name(self):
+        return self._board_name
+#end class
+
+
+def daemon_portbrains(socket_path=None):
+    """
+    Connects to every board served by a PortBrainDaemon.
+
+    Args:
+        socket_path (str): daemon socket, default_socket_path() if None.
+
+    Returns:
+        (list) -- list of PortBrainController objects, already connected.
+    """
+    channel = DaemonChannel()
+    if not channel.open({'socket_path': socket_path}):
+        return []
+
+    portbrains = []
+    for index in range(len(channel.list_boards())):
+        if index > 0:
+            channel = DaemonChannel()
+            if not channel.open({'socket_path': socket_path, 'board': index}):
+                continue
+
+        # other clients can write the same board, so a local shadow would go stale
+        pb = PortBrainController(channel, shadow_registers=False)
+        if pb.check_for_device():
+            portbrains.append(pb)
+        else:
+            pb.close()
+    #end for
+
+    return portbrains
+#end def
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='PortBrain daemon')
+    parser.add_argument('--socket', help='socket path (default {})'.format(default_socket_path()))
+    parser.add_argument('--max-count', type=int, default=8, help='max number of boards to serve')
+    parser.add_argument('--deadline', type=float, default=portbrain.DISCOVERY_DEADLINE,
+        help='max time (in secs) to spend on discovery (default %(default)s)')
+    parser.add_argument('--cache', action='store_true', help='use the discovery cache')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    cache = None
+    if args.cache:
+        from discovery_cache import DiscoveryCache
+        cache = DiscoveryCache()
+
+    portbrains = portbrain.enumerate_portbrains(args.max_count, deadline=args.deadline, cache=cache)
+    if not portbrains:
+        logger.error('No PortBrains found')
+        return 1
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    with PortBrainDaemon(portbrains, args.socket):
+        try:
+            while not stopped.wait(1.0):
+                pass
+        except KeyboardInterrupt:
+            pass
+    #end with
+
+    return 0
+#end def
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+#end if
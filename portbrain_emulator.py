@@ -0,0 +1,200 @@
+# !python3
+"""
+Module that emulates PortBrain boards on Linux pseudo-terminals, so the
+real serial path (pyserial, termios, fd I/O, discovery) can be run and
+benchmarked without hardware.
+
+Usage:
+    with PortBrainEmulator(count=4, delay=0.002) as emulator:
+        portbrains = enumerate_portbrains(4, portnames=emulator.portnames)
+"""
+
+import heapq
+import os
+import random
+import selectors
+import threading
+import tty
+from time import perf_counter
+
+from portbrain_firmware import PortBrainFirmware
+
+__author__ = 'Scott Pinkham, Byte Arts LLC'
+__version__ = '2019.513.0'
+
+
+class _EmulatedBoard(object):
+    """
+    State of one emulated board: its pty and firmware model.
+    """
+    def __init__(self, firmware):
+        self.firmware = firmware
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        os.set_blocking(self.master_fd, False)
+        self.portname = os.ttyname(self.slave_fd)
+        self.rx_buffer = bytearray()
+        self.busy_until = 0.0
+    #end def
+
+
+    def close(self):
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+    #end def
+#end class
+
+
+class PortBrainEmulator(object):
+    """
+    Runs emulated PortBrain firmware on the master side of pseudo-terminals.
+    The slave side of each pty (e.g. /dev/pts/3) behaves like a PortBrain's
+    serial port. All boards are served by one thread.
+
+    Args:
+        count (int): number of boards to emulate.
+        delay (float): time (in secs) each board takes to answer a command.
+        jitter (float): max random extra delay (in secs).
+        version (str): firmware version reported by the boards.
+        terminator (bytes): command and response terminator.
+    """
+    def __init__(self, count=1, delay=0.0, jitter=0.0, version='1.0', terminator=b'\r'):
+        self._count = count
+        self._delay = delay
+        self._jitter = jitter
+        self._version = version
+        self._terminator = terminator
+        self._boards = []
+        self._selector = None
+        self._thread = None
+        self._wake_r = None
+        self._wake_w = None
+        self._running = False
+    #end def
+
+
+    def __enter__(self):
+        self.start()
+        return self
+    #end def
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+    #end def
+
+
+    def _on_readable(self, board, pending):
+        """
+        Reads commands from a board's pty and queues the responses.
+        """
+        try:
+            data = os.read(board.master_fd, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            # no client has the port open
+            return
+
+        board.rx_buffer += data
+        while True:
+            cmd, found, remainder = board.rx_buffer.partition(self._terminator)
+            if not found:
+                break
+            board.rx_buffer = remainder
+
+            # boards answer their commands in turn
+            due = max(perf_counter(), board.busy_until) + self._delay
+            if self._jitter > 0:
+                due += random.uniform(0.0, self._jitter)
+            board.busy_until = due
+
+            response = board.firmware.execute(bytes(cmd)) + self._terminator
+            heapq.heappush(pending, (due, id(board), board, response))
+        #end while
+    #end def
+
+
+    def _run(self):
+        """
+        Emulator loop, runs on the emulator thread.
+        """
+        pending = []
+        while self._running:
+            timeout = None
+            if pending:
+                timeout = max(0.0, pending[0][0] - perf_counter())
+
+            for key, _ in self._selector.select(timeout):
+                if key.data is None:
+                    os.read(self._wake_r, 4096)
+                else:
+                    self._on_readable(key.data, pending)
+            #end for
+
+            # send the responses that are due
+            now = perf_counter()
+            while pending and pending[0][0] <= now:
+                _, _, board, response = heapq.heappop(pending)
+                try:
+                    os.write(board.master_fd, response)
+                except OSError:
+                    pass
+            #end while
+        #end while
+    #end def
+
+
+    def firmware(self, index):
+        """
+        Returns the PortBrainFirmware model of a board, e.g. to set its inputs.
+        """
+        return self._boards[index].firmware
+    #end def
+
+
+    def start(self):
+        """
+        Creates the ptys and starts serving them.
+        """
+        if self._running:
+            return
+
+        self._boards = [_EmulatedBoard(PortBrainFirmware(self._version)) for _ in range(self._count)]
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = os.pipe()
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        for board in self._boards:
+            self._selector.register(board.master_fd, selectors.EVENT_READ, board)
+
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='portbrain-emulator', daemon=True)
+        self._thread.start()
+    #end def
+
+
+    def stop(self):
+        """
+        Stops serving and closes the ptys.
+        """
+        if not self._running:
+            return
+
+        self._running = False
+        os.write(self._wake_w, b'x')
+        self._thread.join()
+        self._thread = None
+
+        self._selector.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        for board in self._boards:
+            board.close()
+        self._boards = []
+    #end def
+
+
+    @property
+    def portnames(self):
+        return [board.portname for board in self._boards]
+#end class
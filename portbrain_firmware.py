@@ -0,0 +1,125 @@
+# !python3
+"""
+Module that models the PortBrain firmware's command set, for simulated
+and emulated devices.
+"""
+
+__author__ = 'Scott Pinkham, Byte Arts LLC'
+__version__ = '2019.513.0'
+
+
+class PortBrainFirmware(object):
+    """
+    Model of a PortBrain's firmware state and command handling. Commands
+    and responses don't include the terminators.
+
+    Direction bits set to 1 are outputs: reading a port returns the output
+    value for output bits and the external input value for input bits.
+
+    Args:
+        version (str): version reported by VER.
+        analog_inputs (list): initial analog input values.
+    """
+    PORT_COUNT = 6
+    ANALOG_INPUT_COUNT = 5
+
+    def __init__(self, version='1.0', analog_inputs=None):
+        self.version = version
+        self.directions = [0] * PortBrainFirmware.PORT_COUNT
+        self.outputs = [0] * PortBrainFirmware.PORT_COUNT
+        self.inputs = [0] * PortBrainFirmware.PORT_COUNT
+        self.analog_inputs = list(analog_inputs or [0] * PortBrainFirmware.ANALOG_INPUT_COUNT)
+        self._handlers = [
+            (b'VER', self._version),
+            (b'PRTRD', self._read_port),
+            (b'PRTWR', self._write_port),
+            (b'DIRRD', self._read_direction),
+            (b'DIRWR', self._write_direction),
+            (b'ADC', self._read_analog),
+        ]
+    #end def
+
+
+    @staticmethod
+    def _split_args(args, count):
+        """
+        Splits the arguments of a port/input command into the (single digit)
+        number and the optional value.
+
+        Returns: (tuple) (number, value) where value is None if there wasn't one.
+        """
+        if len(args) < 1 or not args[:1].isdigit():
+            raise ValueError()
+
+        number = int(args[:1])
+        if number >= count:
+            raise ValueError()
+
+        value = int(args[1:]) if len(args) > 1 else None
+        return (number, value)
+    #end def
+
+
+    def _read_analog(self, args):
+        number, _ = self._split_args(args, PortBrainFirmware.ANALOG_INPUT_COUNT)
+        return str(self.analog_inputs[number]).encode()
+    #end def
+
+
+    def _read_direction(self, args):
+        number, _ = self._split_args(args, PortBrainFirmware.PORT_COUNT)
+        return str(self.directions[number]).encode()
+    #end def
+
+
+    def _read_port(self, args):
+        number, _ = self._split_args(args, PortBrainFirmware.PORT_COUNT)
+        dirbits = self.directions[number]
+        value = (self.outputs[number] & dirbits) | (self.inputs[number] & ~dirbits & 0xFF)
+        return str(value).encode()
+    #end def
+
+
+    def _version(self, args):
+        return self.version.encode()
+    #end def
+
+
+    def _write_direction(self, args):
+        number, value = self._split_args(args, PortBrainFirmware.PORT_COUNT)
+        if value is None:
+            raise ValueError()
+        self.directions[number] = value & 0xFF
+        return b'OK'
+    #end def
+
+
+    def _write_port(self, args):
+        number, value = self._split_args(args, PortBrainFirmware.PORT_COUNT)
+        if value is None:
+            raise ValueError()
+        self.outputs[number] = value & 0xFF
+        return b'OK'
+    #end def
+
+
+    def execute(self, cmd):
+        """
+        Runs a command.
+
+        Args:
+            cmd (bytes): command, without the terminator.
+
+        Returns: (bytes) response, without the terminator.
+        """
+        for name, handler in self._handlers:
+            if cmd.startswith(name):
+                try:
+                    return handler(cmd[len(name):])
+                except ValueError:
+                    break
+        #end for
+
+        return b'ERR'
+    #end def
+#end class
@@ -0,0 +1,209 @@
+# PortBrain fleet module
+
+from collections import namedtuple, OrderedDict
+import concurrent.futures
+import os
+
+# result of an operation on one board
+BoardResult = namedtuple('BoardResult', ['name', 'success', 'value', 'error'])
+
+
+def _snapshot(portbrain):
+    """
+    Reads all digital ports and analog inputs of a board.
+
+    Returns:
+        tuple: (success, {'ports': [values], 'analog inputs': [values]})
+    """
+    analog_inputs, ports = portbrain.read_inputs()
+    success = all(result[0] for result in ports + analog_inputs)
+    return (success, {'ports': [value for _, value in ports], 'analog inputs': [value for _, value in analog_inputs]})
+#end def
+
+
+class PortBrainFleet(object):
+    """
+    Drives several PortBrains at once, with one worker thread per board so
+    operations on different boards run concurrently while operations on
+    the same board stay in order.
+
+    Args:
+        portbrains (list): connected PortBrainController objects, e.g. from enumerate_portbrains().
+    """
+    def __init__(self, portbrains):
+        self._portbrains = OrderedDict()
+        self._workers = {}
+        self._closed = False
+
+        for portbrain in portbrains:
+            name = portbrain.device_info['channel name']
+            self._portbrains[name] = portbrain
+            self._workers[name] = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                thread_name_prefix='portbrain-' + os.path.basename(name))
+        #end for
+    #end def
+
+
+    def __contains__(self, name):
+        return name in self._portbrains
+    #end def
+
+
+    def __enter__(self):
+        return self
+    #end def
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    #end def
+
+
+    def __getitem__(self, name):
+        return self._portbrains[name]
+    #end def
+
+
+    def __len__(self):
+        return len(self._portbrains)
+    #end def
+
+
+    @staticmethod
+    def _make_result(name, result, last_error):
+        """
+        Converts the return value of an operation into a BoardResult. A
+        (success, value) tuple or a bool gives the success, anything else
+        counts as success with that value.
+        """
+        if isinstance(result, bool):
+            success, value = result, None
+        elif isinstance(result, tuple) and len(result) == 2 and isinstance(result[0], bool):
+            success, value = result
+        else:
+            success, value = True, result
+        #end if
+
+        error = None
+        if not success:
+            error = last_error or 'failed'
+
+        return BoardResult(name, success, value, error)
+    #end def
+
+
+    @staticmethod
+    def _run_operation(name, portbrain, function, args, kwargs):
+        """
+        Runs an operation on the board's worker thread. The controller's
+        last_error is taken there, right after the operation, before another
+        operation on the board can change it.
+
+        Returns:
+            BoardResult
+        """
+        result = function(*args, **kwargs)
+        return PortBrainFleet._make_result(name, result, portbrain.last_error)
+    #end def
+
+
+    def close(self):
+        """
+        Stops the workers and closes the connection to every board.
+        """
+        self._closed = True
+        for worker in self._workers.values():
+            worker.shutdown(wait=True)
+        self._workers.clear()
+
+        for portbrain in self._portbrains.values():
+            portbrain.close()
+    #end def
+
+
+    def run(self, operation, *args, boards=None, timeout=None, **kwargs):
+        """
+        Runs an operation on several boards concurrently and waits for the results.
+
+        Args:
+            operation: name of a PortBrainController method (e.g. 'read_port'), or a
+                function that takes the controller as its first argument
+            args: arguments for the operation
+            boards (list): names of the boards to run on, None for all boards
+            timeout (float): max time (in secs) to wait for all boards, None for no limit
+            kwargs: keyword arguments for the operation
+
+        Returns:
+            list: BoardResult for each board, in fleet order
+        """
+        futures = self.submit(operation, *args, boards=boards, **kwargs)
+        concurrent.futures.wait(futures.values(), timeout=timeout)
+
+        results = []
+        for name, future in futures.items():
+            if not future.done():
+                future.cancel()
+                results.append(BoardResult(name, False, None, 'timeout'))
+            elif future.exception() is not None:
+                results.append(BoardResult(name, False, None, repr(future.exception())))
+            else:
+                results.append(future.result())
+        #end for
+
+        return results
+    #end def
+
+
+    def snapshot(self, boards=None, timeout=None):
+        """
+        Reads all digital ports and analog inputs of several boards concurrently.
+
+        Args:
+            boards (list): names of the boards to read, None for all boards
+            timeout (float): max time (in secs) to wait for all boards, None for no limit
+
+        Returns:
+            list: BoardResult for each board, where value is a dict with
+                'ports' and 'analog inputs' lists
+        """
+        return self.run(_snapshot, boards=boards, timeout=timeout)
+    #end def
+
+
+    def submit(self, operation, *args, boards=None, **kwargs):
+        """
+        Queues an operation on several boards without waiting for it.
+
+        Args: see run()
+
+        Returns:
+            dict: board name -> concurrent.futures.Future resolving to a
+                BoardResult, in fleet order
+
+        Raises: RuntimeError if the fleet has been closed.
+        """
+        if self._closed:
+            raise RuntimeError('PortBrainFleet has been closed')
+
+        if boards is None:
+            boards = list(self._portbrains)
+
+        futures = OrderedDict()
+        for name in boards:
+            portbrain = self._portbrains[name]
+            if callable(operation):
+                function, function_args = operation, (portbrain,) + args
+            else:
+                function, function_args = getattr(portbrain, operation), args
+            futures[name] = self._workers[name].submit(self._run_operation, name, portbrain, function,
+                function_args, kwargs)
+        #end for
+
+        return futures
+    #end def
+
+
+    @property
+    def names(self):
+        return list(self._portbrains)
+#end class
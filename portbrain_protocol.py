@@ -0,0 +1,189 @@
+# !python3
+"""
+Module that encodes PortBrain commands and decodes their responses.
+
+Every command for every port and input number is built once, when the
+module is loaded, so sending a command is a table lookup. Numbers and
+values are checked against the board's ranges before a command is built,
+and bad ones raise ValueError, so they never reach the device.
+
+Responses are decoded by looking them up in a table of the decimal
+strings the board sends, which works on bytes and read-only memoryviews
+alike without copying them.
+"""
+
+__author__ = 'Scott Pinkham, Byte Arts LLC'
+__version__ = '2019.513.0'
+
+PORT_COUNT = 6
+ANALOG_INPUT_COUNT = 5
+
+# largest value of a port/direction register, and of an analog input reading
+MAX_PORT_VALUE = 0xFF
+MAX_ANALOG_VALUE = 0xFFF
+
+# command names
+CMD_VERSION = b'VER'
+CMD_READ_PORT = b'PRTRD'
+CMD_WRITE_PORT = b'PRTWR'
+CMD_READ_DIRECTION = b'DIRRD'
+CMD_WRITE_DIRECTION = b'DIRWR'
+CMD_READ_ANALOG = b'ADC'
+
+# decimal strings of register values, indexed by value
+_VALUE_BYTES = tuple(str(value).encode() for value in range(MAX_PORT_VALUE + 1))
+
+# response string -> value, for every value the board can send
+_RESPONSE_VALUES = {str(value).encode(): value for value in range(MAX_ANALOG_VALUE + 1)}
+
+
+def _build_table(name, count):
+    return tuple(name + str(number).encode() for number in range(count))
+#end def
+
+
+READ_PORT_COMMANDS = _build_table(CMD_READ_PORT, PORT_COUNT)
+WRITE_PORT_COMMANDS = _build_table(CMD_WRITE_PORT, PORT_COUNT)
+READ_DIRECTION_COMMANDS = _build_table(CMD_READ_DIRECTION, PORT_COUNT)
+WRITE_DIRECTION_COMMANDS = _build_table(CMD_WRITE_DIRECTION, PORT_COUNT)
+READ_ANALOG_COMMANDS = _build_table(CMD_READ_ANALOG, ANALOG_INPUT_COUNT)
+
+# commands that don't change the state of the board
+READ_COMMAND_NAMES = (CMD_VERSION, CMD_READ_PORT, CMD_READ_DIRECTION, CMD_READ_ANALOG)
+
+
+def check_analog_input_number(inputnumber):
+    """
+    Raises ValueError if inputnumber isn't a valid analog input number (0-4).
+    """
+    if not (isinstance(inputnumber, int) and 0 <= inputnumber < ANALOG_INPUT_COUNT):
+        raise ValueError('analog input number must be 0-{}, not {!r}'.format(ANALOG_INPUT_COUNT - 1, inputnumber))
+#end def
+
+
+def check_port_number(portnumber):
+    """
+    Raises ValueError if portnumber isn't a valid port number (0-5).
+    """
+    if not (isinstance(portnumber, int) and 0 <= portnumber < PORT_COUNT):
+        raise ValueError('port number must be 0-{}, not {!r}'.format(PORT_COUNT - 1, portnumber))
+#end def
+
+
+def check_port_value(value):
+    """
+    Raises ValueError if value doesn't fit in a port register (0-255).
+    """
+    if not (isinstance(value, int) and 0 <= value <= MAX_PORT_VALUE):
+        raise ValueError('port value must be 0-{}, not {!r}'.format(MAX_PORT_VALUE, value))
+#end def
+
+
+def read_analog_command(inputnumber) -> bytes:
+    check_analog_input_number(inputnumber)
+    return READ_ANALOG_COMMANDS[inputnumber]
+#end def
+
+
+def read_analog_commands(inputnumbers) -> list:
+    return [read_analog_command(inputnumber) for inputnumber in inputnumbers]
+#end def
+
+
+def read_direction_command(portnumber) -> bytes:
+    check_port_number(portnumber)
+    return READ_DIRECTION_COMMANDS[portnumber]
+#end def
+
+
+def read_port_command(portnumber) -> bytes:
+    check_port_number(portnumber)
+    return READ_PORT_COMMANDS[portnumber]
+#end def
+
+
+def read_port_commands(portnumbers) -> list:
+    return [read_port_command(portnumber) for portnumber in portnumbers]
+#end def
+
+
+def write_direction_command(portnumber, dirbits) -> bytes:
+    check_port_number(portnumber)
+    check_port_value(dirbits)
+    return WRITE_DIRECTION_COMMANDS[portnumber] + _VALUE_BYTES[dirbits]
+#end def
+
+
+def write_port_command(portnumber, value) -> bytes:
+    check_port_number(portnumber)
+    check_port_value(value)
+    return WRITE_PORT_COMMANDS[portnumber] + _VALUE_BYTES[value]
+#end def
+
+
+def is_read_command(cmd) -> bool:
+    """
+    Returns True if cmd doesn't change the state of the board.
+    """
+    return cmd.startswith(READ_COMMAND_NAMES)
+#end def
+
+
+def parse_value(success, response) -> (bool, int):
+    """
+    Converts a command response into an integer value.
+
+    Args:
+        success (bool): whether the command succeeded.
+        response (bytes or memoryview): response without its terminator.
+
+    Returns:
+        tuple -- (<success (bool)>, <value (int)>)
+    """
+    if success:
+        try:
+            value = _RESPONSE_VALUES.get(response)
+        except ValueError:
+            # writable memoryviews can't be hashed
+            value = _RESPONSE_VALUES.get(bytes(response))
+
+        if value is not None:
+            return (True, value)
+
+        # not a value the board normally sends, e.g. '007'
+        try:
+            return (True, int(bytes(response)))
+        except ValueError:
+            pass
+    #end if
+
+    return (False, 0)
+#end def
+
+
+def parse_values(results) -> list:
+    """
+    Converts a list of (success, response) tuples into (success, value) tuples.
+    """
+    return [parse_value(success, response) for success, response in results]
+#end def
+
+
+def parse_version(success, response) -> (bool, str):
+    """
+    Converts a VER response into a version string.
+
+    Returns:
+        tuple -- (<success (bool)>, <version (str)>), success is False if the
+        response isn't in the form <major>.<minor>
+    """
+    if success:
+        try:
+            version = bytes(response).decode()
+            return (version.count('.') == 1, version)
+        except UnicodeDecodeError:
+            pass
+    #end if
+
+    return (False, '')
+#end def
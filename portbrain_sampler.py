@@ -0,0 +1,363 @@
+# PortBrain sampler module
+
+from array import array
+import threading
+from time import perf_counter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class SampleBatch(object):
+    """
+    A run of consecutive samples in a SampleRingBuffer. The timestamps and
+    values are memoryviews into the ring buffer, not copies, so they are
+    only valid until the sampler wraps around and overwrites them.
+
+    Attributes:
+        index (int): sequence number of the first sample
+        timestamps (memoryview): perf_counter() time of each sample, in secs
+        values (memoryview): channel values, channel_count per sample
+        channel_count (int): number of values per sample
+    """
+    __slots__ = ('index', 'timestamps', 'values', 'channel_count')
+
+    def __init__(self, index, timestamps, values, channel_count):
+        self.index = index
+        self.timestamps = timestamps
+        self.values = values
+        self.channel_count = channel_count
+    #end def
+
+
+    def __iter__(self):
+        """
+        Yields (timestamp, values) for each sample, values is a tuple.
+        """
+        count = self.channel_count
+        values = self.values
+        for i, timestamp in enumerate(self.timestamps):
+            yield (timestamp, tuple(values[i * count:(i + 1) * count]))
+    #end def
+
+
+    def __len__(self):
+        return len(self.timestamps)
+    #end def
+
+
+    def to_numpy(self):
+        """
+        Gets the batch as NumPy arrays that share the ring buffer's memory.
+
+        Returns:
+            tuple: (timestamps (n,), values (n, channel_count))
+        """
+        if numpy is None:
+            raise RuntimeError('NumPy is not installed')
+
+        timestamps = numpy.frombuffer(self.timestamps, dtype=numpy.float64)
+        values = numpy.frombuffer(self.values, dtype=numpy.intc).reshape(-1, self.channel_count)
+        return (timestamps, values)
+    #end def
+#end class
+
+
+class SampleRingBuffer(object):
+    """
+    Preallocated ring buffer of timestamped samples, written by one producer
+    and read by one consumer. If the consumer falls behind by more than
+    the capacity, the oldest samples are overwritten and counted as dropped.
+
+    Args:
+        capacity (int): max number of samples held.
+        channel_count (int): number of values per sample.
+    """
+    def __init__(self, capacity, channel_count):
+        self._capacity = int(capacity)
+        self._channel_count = int(channel_count)
+        self._timestamps = array('d', bytes(8 * self._capacity))
+        self._values = array('i', [0]) * (self._capacity * self._channel_count)
+        self._timestamps_view = memoryview(self._timestamps)
+        self._values_view = memoryview(self._values)
+        self._write_index = 0
+        self._read_index = 0
+        self._dropped = 0
+        self._condition = threading.Condition()
+    #end def
+
+
+    def __len__(self):
+        """
+        Returns the number of unread samples.
+        """
+        with self._condition:
+            return self._write_index - self._read_index
+    #end def
+
+
+    def append(self, timestamp, values):
+        """
+        Adds a sample.
+
+        Args:
+            timestamp (float): time of the sample
+            values (list): channel_count values
+        """
+        slot = self._write_index % self._capacity
+        self._timestamps[slot] = timestamp
+        offset = slot * self._channel_count
+        for value in values:
+            self._values[offset] = value
+            offset += 1
+
+        with self._condition:
+            self._write_index += 1
+            self._condition.notify_all()
+    #end def
+
+
+    def read(self, max_count=None):
+        """
+        Takes the unread samples out of the buffer, without copying them.
+
+        Args:
+            max_count (int): max number of samples to take, None for all.
+
+        Returns:
+            list: SampleBatch objects (two if the samples wrap around the
+                end of the buffer, none if there are no unread samples)
+        """
+        with self._condition:
+            # skip anything that has been overwritten
+            oldest = self._write_index - self._capacity
+            if self._read_index < oldest:
+                self._dropped += oldest - self._read_index
+                self._read_index = oldest
+            #end if
+
+            count = self._write_index - self._read_index
+            if max_count is not None:
+                count = min(count, max_count)
+            index = self._read_index
+            self._read_index += count
+        #end with
+
+        batches = []
+        while count > 0:
+            slot = index % self._capacity
+            run = min(count, self._capacity - slot)
+            batches.append(SampleBatch(index,
+                self._timestamps_view[slot:slot + run],
+                self._values_view[slot * self._channel_count:(slot + run) * self._channel_count],
+                self._channel_count))
+            index += run
+            count -= run
+        #end while
+
+        return batches
+    #end def
+
+
+    def interrupt(self):
+        """
+        Wakes up any consumer blocked in wait().
+        """
+        with self._condition:
+            self._condition.notify_all()
+    #end def
+
+
+    def wait(self, timeout=None):
+        """
+        Waits until there are unread samples, or interrupt() is called.
+
+        Returns: (bool) True if there are unread samples.
+        """
+        with self._condition:
+            if self._write_index == self._read_index:
+                self._condition.wait(timeout)
+            return self._write_index > self._read_index
+    #end def
+
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+
+    @property
+    def channel_count(self):
+        return self._channel_count
+
+
+    @property
+    def dropped(self):
+        return self._dropped
+#end class
+
+
+class PortBrainSampler(object):
+    """
+    Samples analog inputs and digital ports of a PortBrain at a fixed rate,
+    on a background thread, into a SampleRingBuffer. Each sample holds the
+    analog input values followed by the port values, and is read with one
+    batch of pipelined commands.
+
+    Args:
+        portbrain (PortBrainController): connected controller
+        analog_inputs (list): analog inputs to sample (0-4)
+        ports (list): digital ports to sample (0-5)
+        rate (float): target sample rate (in samples/sec)
+        capacity (int): number of samples held by the ring buffer
+    """
+    def __init__(self, portbrain, analog_inputs=(), ports=(), rate=100.0, capacity=10000):
+        self._portbrain = portbrain
+        self._analog_inputs = list(analog_inputs)
+        self._ports = list(ports)
+        self._period = 1.0 / rate
+        self._buffer = SampleRingBuffer(capacity, len(self._analog_inputs) + len(self._ports))
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._sample_count = 0
+        self._overruns = 0
+        self._errors = 0
+        self._start_time = 0.0
+        self._last_time = 0.0
+    #end def
+
+
+    def __enter__(self):
+        self.start()
+        return self
+    #end def
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+    #end def
+
+
+    def _run(self):
+        """
+        Sampling loop, runs on the sampler thread.
+        """
+        next_time = perf_counter()
+        self._start_time = next_time
+
+        while not self._stop_event.is_set():
+            timestamp = perf_counter()
+            analog_results, port_results = self._portbrain.read_inputs(self._analog_inputs, self._ports)
+            results = analog_results + port_results
+
+            if all(success for success, _ in results):
+                self._buffer.append(timestamp, [value for _, value in results])
+                self._sample_count += 1
+                self._last_time = timestamp
+            else:
+                self._errors += 1
+            #end if
+
+            # schedule from the target times, not from when the read finished,
+            # so the rate doesn't drift; skip the ticks that were missed
+            next_time += self._period
+            now = perf_counter()
+            if now > next_time:
+                missed = int((now - next_time) / self._period) + 1
+                self._overruns += missed
+                next_time += missed * self._period
+            #end if
+
+            self._stop_event.wait(next_time - now)
+        #end while
+    #end def
+
+
+    def read(self, max_count=None):
+        """
+        Takes the samples collected since the last read, without copying.
+        See SampleRingBuffer.read().
+        """
+        return self._buffer.read(max_count)
+    #end def
+
+
+    def samples(self, timeout=None):
+        """
+        Generator that yields (timestamp, values) for each sample as it is
+        collected. Stops when the sampler stops, or no sample arrives
+        within timeout secs.
+        """
+        while True:
+            batches = self._buffer.read()
+            if not batches:
+                if not self.is_running() or not self._buffer.wait(timeout):
+                    if len(self._buffer) == 0:
+                        return
+                continue
+            #end if
+
+            for batch in batches:
+                for sample in batch:
+                    yield sample
+        #end while
+    #end def
+
+
+    def start(self):
+        """
+        Starts sampling.
+        """
+        if self.is_running():
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='portbrain-sampler', daemon=True)
+        self._thread.start()
+    #end def
+
+
+    def stop(self):
+        """
+        Stops sampling, and waits for the sampler thread to finish.
+        """
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self._buffer.interrupt()
+    #end def
+
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+    #end def
+
+
+    @property
+    def achieved_rate(self):
+        """
+        Average sample rate so far (in samples/sec).
+        """
+        if self._sample_count < 2:
+            return 0.0
+        return (self._sample_count - 1) / (self._last_time - self._start_time)
+
+
+    @property
+    def buffer(self):
+        return self._buffer
+
+
+    @property
+    def stats(self):
+        """
+        Returns dict with sample count, achieved rate, overruns (ticks missed
+        because a read took too long), errors (failed reads) and dropped
+        (samples overwritten before they were read).
+        """
+        return {'samples': self._sample_count, 'rate': self.achieved_rate, 'overruns': self._overruns,
+            'errors': self._errors, 'dropped': self._buffer.dropped}
+#end class
@@ -0,0 +1,315 @@
+# PortBrain watch module
+
+import asyncio
+from collections import namedtuple
+import logging
+import queue
+import threading
+from time import perf_counter
+
+from portbrain_protocol import check_port_number
+
+logger = logging.getLogger(__name__)
+
+# a change of watched bits: previous and new port values, the watched bits
+# that changed, and which of them went high (rising) or low (falling).
+# timestamp is the perf_counter() time of the read that saw the change.
+EdgeEvent = namedtuple('EdgeEvent', ['port', 'timestamp', 'previous', 'value', 'changed', 'rising', 'falling'])
+
+_CLOSED = object()
+
+# after failed reads, a watch's port is read again after its latency times
+# 2 ** <reads failed in a row>, up to this many secs
+MAX_RETRY_INTERVAL = 1.0
+
+
+class PortWatch(object):
+    """
+    A subscription to changes of some bits of a digital port. Events go to
+    the callback if one was given; otherwise they are queued, to be taken
+    with get(), by iterating, or with async for.
+
+    Created by PortWatcher.watch().
+    """
+    def __init__(self, watcher, port, mask, latency, callback):
+        self._watcher = watcher
+        self.port = port
+        self.mask = mask
+        self.latency = latency
+        self.callback = callback
+        self.next_due = 0.0
+        self.value = None
+        self.failures = 0
+        self._events = queue.Queue()
+        self._loop = None
+        self._async_events = None
+        self._closed = False
+    #end def
+
+
+    def __aiter__(self):
+        return self
+    #end def
+
+
+    async def __anext__(self):
+        if self._async_events is None:
+            # events queued before the first await are moved over
+            self._async_events = asyncio.Queue()
+            self._loop = asyncio.get_running_loop()
+            while True:
+                try:
+                    self._async_events.put_nowait(self._events.get_nowait())
+                except queue.Empty:
+                    break
+            #end while
+        #end if
+
+        event = await self._async_events.get()
+        if event is _CLOSED:
+            self._async_events.put_nowait(_CLOSED)
+            raise StopAsyncIteration
+        return event
+    #end def
+
+
+    def __iter__(self):
+        while True:
+            event = self.get()
+            if event is None:
+                return
+            yield event
+        #end while
+    #end def
+
+
+    def _deliver(self, event):
+        """
+        Passes an event (or _CLOSED) on; called on the watcher's thread.
+        """
+        if event is not _CLOSED and self.callback is not None:
+            # a bad callback mustn't stop the watcher, and so the other watches
+            try:
+                self.callback(event)
+            except Exception:
+                logger.exception('PortWatch callback for port %d failed', self.port)
+        elif self._loop is not None:
+            self._loop.call_soon_threadsafe(self._async_events.put_nowait, event)
+        else:
+            self._events.put(event)
+    #end def
+
+
+    def cancel(self):
+        """
+        Stops watching. Iterators end once the events already queued are taken.
+        """
+        if not self._closed:
+            self._closed = True
+            self._watcher._remove(self)
+            self._deliver(_CLOSED)
+        #end if
+    #end def
+
+
+    def get(self, timeout=None):
+        """
+        Takes the next queued event, waiting up to timeout secs (None = no limit).
+
+        Returns: (EdgeEvent) or None on timeout, or if the watch was cancelled.
+        """
+        try:
+            event = self._events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+        if event is _CLOSED:
+            self._events.put(_CLOSED)
+            return None
+        return event
+    #end def
+#end class
+
+
+class PortWatcher(object):
+    """
+    Polls digital ports of one PortBrain for its watches, on one background
+    thread. Each watch is due every `latency` secs; when one is due, the
+    ports of every watch that is due within half its own latency are read
+    together with one read_ports() call, and every watch on those ports
+    gets the result, so watches on the same port (or of similar rates)
+    share reads.
+
+    The controller is used from the watcher's thread, so it must not be
+    used from other threads at the same time unless its channel is
+    thread-safe (PortBrainController.watch() takes care of that).
+
+    Args:
+        portbrain (PortBrainController): connected controller
+    """
+    def __init__(self, portbrain):
+        self._portbrain = portbrain
+        self._watches = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._reads = 0
+        self._ports_read = 0
+        self._events = 0
+        self._errors = 0
+    #end def
+
+
+    def _poll(self, watches, now):
+        """
+        Reads the ports that are due and delivers the changes.
+        """
+        ports = sorted({watch.port for watch in watches if watch.next_due - watch.latency / 2 <= now})
+        timestamp = perf_counter()
+        try:
+            results = self._portbrain.read_ports(ports)
+        except Exception:
+            logger.exception('PortWatcher read failed')
+            results = [(False, 0)] * len(ports)
+        self._reads += 1
+        self._ports_read += len(ports)
+
+        for port, (success, value) in zip(ports, results):
+            if not success:
+                self._errors += 1
+
+            for watch in watches:
+                if watch.port != port:
+                    continue
+
+                if not success:
+                    # try again later, backing off so a dead channel isn't polled flat out
+                    watch.failures += 1
+                    watch.next_due = timestamp + min(watch.latency * 2 ** min(watch.failures, 30),
+                        max(watch.latency, MAX_RETRY_INTERVAL))
+                    continue
+                #end if
+
+                watch.failures = 0
+                watch.next_due = timestamp + watch.latency
+
+                # the first read of a watch only sets its starting value
+                previous = watch.value
+                watch.value = value
+                if previous is None:
+                    continue
+                changed = (previous ^ value) & watch.mask
+                if changed:
+                    self._events += 1
+                    watch._deliver(EdgeEvent(port, timestamp, previous, value, changed, changed & value,
+                        changed & previous))
+                #end if
+            #end for
+        #end for
+    #end def
+
+
+    def _remove(self, watch):
+        with self._condition:
+            if watch in self._watches:
+                self._watches.remove(watch)
+            self._condition.notify()
+        #end with
+    #end def
+
+
+    def _run(self):
+        """
+        Poll loop, runs on the watcher thread.
+        """
+        while True:
+            with self._condition:
+                if not self._running:
+                    break
+
+                watches = list(self._watches)
+                now = perf_counter()
+                if not watches:
+                    self._condition.wait()
+                    continue
+
+                due = min(watch.next_due for watch in watches)
+                if due > now:
+                    self._condition.wait(due - now)
+                    continue
+            #end with
+
+            self._poll(watches, now)
+        #end while
+    #end def
+
+
+    def close(self):
+        """
+        Stops polling and cancels every watch.
+        """
+        with self._condition:
+            self._running = False
+            watches = list(self._watches)
+            self._condition.notify()
+        #end with
+
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+        for watch in watches:
+            watch.cancel()
+    #end def
+
+
+    def watch(self, port, mask=0xFF, latency=0.05, callback=None):
+        """
+        Starts watching bits of a port.
+
+        Args:
+            port (int): port number (0-5)
+            mask (int): bits to watch
+            latency (float): max time (in secs) from a change to it being seen,
+                i.e. how often the port is read for this watch
+            callback: function called with each EdgeEvent, on the watcher's
+                thread; None to queue the events on the watch instead
+
+        Returns:
+            PortWatch
+        """
+        if latency <= 0:
+            raise ValueError('latency must be > 0')
+
+        # check the port number now, rather than on the watcher's thread
+        check_port_number(port)
+
+        watch = PortWatch(self, port, mask, latency, callback)
+        with self._condition:
+            self._watches.append(watch)
+            if not self._running:
+                self._running = True
+                self._thread = threading.Thread(target=self._run, name='portbrain-watcher', daemon=True)
+                self._thread.start()
+            #end if
+            self._condition.notify()
+        #end with
+
+        return watch
+    #end def
+
+
+    @property
+    def stats(self):
+        """
+        Returns dict with the number of reads, ports read, events delivered
+        and failed port reads.
+        """
+        return {'reads': self._reads, 'ports read': self._ports_read, 'events': self._events,
+            'errors': self._errors}
+
+
+    @property
+    def watch_count(self):
+        return len(self._watches)
+#end class
@@ -0,0 +1,157 @@
+# !python3
+"""
+Module that defines a cache of recent read results, with a max staleness
+per key and coalescing of concurrent reads of the same key.
+"""
+
+import threading
+from time import perf_counter
+
+__author__ = 'Scott Pinkham, Byte Arts LLC'
+__version__ = '2019.513.0'
+
+
+class _PendingRead(object):
+    """
+    A read that is in progress, shared by every caller asking for the same key.
+    generation is the cache's generation when the read started.
+    """
+    __slots__ = ('done', 'result', 'generation')
+
+    def __init__(self, generation):
+        self.done = threading.Event()
+        self.result = (False, 0)
+        self.generation = generation
+    #end def
+#end class
+
+
+class ReadCache(object):
+    """
+    Cache of read results. A result is reused while it is younger than the
+    max age set for its key; keys without a max age are never cached, but
+    concurrent reads of them are still coalesced into one.
+
+    Only successful results, (True, value) tuples, are cached.
+
+    Invalidating a key stores a new generation number for it. A read that
+    started under an older generation may have seen the value from before
+    the change, so its result goes back to its own callers only: it isn't
+    cached, and later callers don't share it.
+    """
+    def __init__(self):
+        self._max_ages = {}
+        self._results = {}
+        self._pending = {}
+        self._generation = 0
+        self._invalidated = {}
+        self._all_invalidated = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+    #end def
+
+
+    def invalidate(self, key=None):
+        """
+        Forgets a cached result.
+
+        Args:
+            key: key to forget, or None to forget all results.
+        """
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._results.clear()
+                self._pending.clear()
+                self._invalidated.clear()
+                self._all_invalidated = self._generation
+            else:
+                self._results.pop(key, None)
+                self._pending.pop(key, None)
+                self._invalidated[key] = self._generation
+            #end if
+        #end with
+    #end def
+
+
+    def read(self, key, read_function):
+        """
+        Gets the result for a key, from the cache if it is fresh enough,
+        otherwise from read_function(). If another thread is already reading
+        the same key, waits for and shares its result.
+
+        Args:
+            key: cache key (e.g. the command)
+            read_function: function that reads the value, returns (success, value)
+
+        Returns:
+            tuple: (success, value)
+        """
+        now = perf_counter()
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None and now - cached[0] <= self._max_ages.get(key, 0.0):
+                self._hits += 1
+                return cached[1]
+            #end if
+
+            pending = self._pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = _PendingRead(self._generation)
+                self._pending[key] = pending
+                self._misses += 1
+            else:
+                self._coalesced += 1
+            #end if
+        #end with
+
+        if not owner:
+            pending.done.wait()
+            return pending.result
+
+        try:
+            pending.result = read_function()
+        finally:
+            with self._lock:
+                if self._pending.get(key) is pending:
+                    del self._pending[key]
+                invalidated = max(self._invalidated.get(key, 0), self._all_invalidated)
+                if pending.result[0] and key in self._max_ages and invalidated <= pending.generation:
+                    # age is measured from when the read started
+                    self._results[key] = (now, pending.result)
+            #end with
+            pending.done.set()
+        #end try..finally
+
+        return pending.result
+    #end def
+
+
+    def set_max_age(self, key, max_age):
+        """
+        Sets how old (in secs) a cached result for a key may be, None
+        to stop caching the key.
+        """
+        with self._lock:
+            if max_age is None:
+                self._max_ages.pop(key, None)
+                self._results.pop(key, None)
+            else:
+                self._max_ages[key] = float(max_age)
+        #end with
+    #end def
+
+
+    @property
+    def stats(self):
+        """
+        Returns dict with the number of hits (answered from the cache),
+        misses (read from the device) and coalesced reads (shared another
+        caller's read).
+        """
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses, 'coalesced': self._coalesced}
+#end class
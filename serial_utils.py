@@ -9,16 +9,20 @@ __version__ = '2019.511.0'
 
 import glob
 import logging
+import os
 import sys
 from time import sleep
 from builtins import input
 
 import serial
+from serial.tools import list_ports
 
 import strutils
 
 SER_TIMEOUT=0.3
 
+SYSFS_TTY_DIR = '/sys/class/tty'
+
 def ask_for_serial_port():
     """
     Ask the user to select a serial port.
@@ -59,19 +63,31 @@ def ask_for_serial_port():
 #end def ask_for_serial_port()
 
 
-def available_serial_ports():
+def available_serial_ports(verify=True, usb_only=False, usb_ids=None):
     """ Lists serial port names
 
+        Args:
+            verify (bool): if True, each port is opened to check that it's really available
+            usb_only (bool): if True, only list USB serial ports (Linux only, other
+                platforms ignore it)
+            usb_ids (list): (vid, pid) tuples of the USB devices to list, see
+                usb_serial_ports(). Implies usb_only.
         Raises: 
             EnvironmentError: On unsupported or unknown platforms
         Returns:
             A list of the serial ports available on the system
     """
+    ports = None
     if sys.platform.startswith('win'):
         ports = ['COM%s' % (i + 1) for i in range(256)]
     elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
-        # this excludes your current terminal "/dev/tty"
-        ports = glob.glob('/dev/tty[A-Za-z]*')
+        if usb_only or usb_ids:
+            # filter on sysfs metadata, without opening anything
+            ports = usb_serial_ports(usb_ids)
+
+        if ports is None:
+            # this excludes your current terminal "/dev/tty"
+            ports = glob.glob('/dev/tty[A-Za-z]*')
     elif sys.platform.startswith('darwin'):
         ports = glob.glob('/dev/tty.*')
     else:
@@ -84,6 +100,10 @@ def available_serial_ports():
         if port.__contains__('Bluetooth'):
             continue
 
+        if not verify:
+            result.append(port)
+            continue
+
         try:
             s = serial.Serial(port)
             s.close()
@@ -103,6 +123,143 @@ def flush_port(port):
 #end def
 
 
+def _sysfs_usb_ids(device_path):
+    """
+    Finds the USB vendor and product IDs of a sysfs device, by walking up
+    from the device to the USB device that it belongs to.
+
+    Args:
+        device_path (string): real path of the device in sysfs
+
+    Returns:
+        (vid, pid) tuple of ints, or None if the device isn't on USB
+    """
+    path = device_path
+    while path.startswith('/sys/devices/'):
+        try:
+            with open(os.path.join(path, 'idVendor')) as f:
+                vid = int(f.read().strip(), 16)
+            with open(os.path.join(path, 'idProduct')) as f:
+                pid = int(f.read().strip(), 16)
+            return (vid, pid)
+        except (OSError, ValueError):
+            pass
+
+        path = os.path.dirname(path)
+    #end while
+
+    return None
+#end def
+
+
+def usb_serial_ports(usb_ids=None):
+    """
+    Lists the USB serial ports (e.g. ttyUSB, ttyACM) using the Linux sysfs
+    tty class, without opening any port. Virtual consoles, ptys and on-board
+    UARTs are skipped.
+
+    Args:
+        usb_ids (list): (vid, pid) tuples of the USB devices to list, a pid
+            of None matches any product from that vendor. None lists all
+            USB serial ports.
+
+    Returns:
+        A list of port names, or None if sysfs isn't available
+    """
+    try:
+        names = sorted(os.listdir(SYSFS_TTY_DIR))
+    except OSError:
+        return None
+
+    result = []
+    for name in names:
+        device_link = os.path.join(SYSFS_TTY_DIR, name, 'device')
+        if not os.path.exists(device_link):
+            # virtual device, e.g. console or pty
+            continue
+
+        ids = _sysfs_usb_ids(os.path.realpath(device_link))
+        if ids is None:
+            continue
+
+        if usb_ids is not None:
+            vid, pid = ids
+            if not any(vid == want_vid and (want_pid is None or pid == want_pid) for want_vid, want_pid in usb_ids):
+                continue
+        #end if
+
+        result.append('/dev/' + name)
+    #end for
+
+    return result
+#end def
+
+
+def usb_serial_numbers():
+    """
+    Gets the USB serial numbers of the serial ports that have one.
+
+    Returns:
+        dict of port name -> serial number
+    """
+    result = {}
+    try:
+        for info in list_ports.comports():
+            if info.serial_number:
+                result[info.device] = info.serial_number
+    except Exception as err:
+        logging.debug('usb_serial_numbers() failed: {}'.format(err))
+
+    return result
+#end def
+
+
+def parse_port_settings(settings):
+    """
+    Parses a port settings string.
+
+    Args:
+        settings (string): port settings in format 'baud=<baudrate>,parity=<E,O, or N>,databits=<datasize>,stopbits=<stopsize>'
+
+    Returns dict with keys 'baud', 'databits', 'parity' and 'stopbits'.
+    Raises ValueError if a number is missing or bad.
+    """
+    baud_setting = strutils.str_after('baud=', settings)
+    baud_setting = int(strutils.str_before(',', baud_setting))
+
+    data_setting = strutils.str_after('databits=', settings)
+    data_setting = int(strutils.str_before(',', data_setting))
+
+    parity_setting = strutils.str_after('parity=', settings)
+    parity_setting = strutils.str_before(',', parity_setting)
+
+    stop_setting = strutils.str_after('stopbits=', settings)
+    stop_setting = int(stop_setting)
+
+    return {'baud': baud_setting, 'databits': data_setting, 'parity': parity_setting, 'stopbits': stop_setting}
+#end def
+
+
+def byte_time(settings):
+    """
+    Calculates the time to send one byte (start bit, data bits, parity bit
+    and stop bits) with the given port settings.
+
+    Args:
+        settings (string): port settings, see parse_port_settings()
+
+    Returns time in secs. Raises ValueError if the settings are bad.
+    """
+    port_settings = parse_port_settings(settings)
+    if port_settings['baud'] <= 0:
+        raise ValueError('bad baud rate')
+
+    parity_bits = 0 if port_settings['parity'].upper() in ('', 'N') else 1
+    bits = 1 + port_settings['databits'] + parity_bits + port_settings['stopbits']
+    return bits / float(port_settings['baud'])
+#end def
+
+
 def open_serial_port(Portname, Settings, ReadTimeout=0.2, WriteTimeout=0.2):
     """
     Try to open a port with the specified baud rate.
@@ -113,20 +270,11 @@ def open_serial_port(Portname, Settings, ReadTimeout=0.2, WriteTimeout=0.2):
     Returns Serial object or None
     """    
     try:
-        baud_setting = strutils.str_after('baud=', Settings)
-        baud_setting = int(strutils.str_before(',', baud_setting))
-
-        data_setting = strutils.str_after('databits=', Settings)
-        data_setting = int(strutils.str_before(',', data_setting))
-
-        parity_setting = strutils.str_after('parity=', Settings)
-        parity_setting = strutils.str_before(',', parity_setting)
-
-        stop_setting = strutils.str_after('stopbits=', Settings)
-        stop_setting = int(stop_setting)
+        port_settings = parse_port_settings(Settings)
 
-        result = serial.Serial(Portname, baudrate=baud_setting, bytesize=data_setting, parity=parity_setting, \
-        stopbits=stop_setting, timeout=ReadTimeout, writeTimeout=WriteTimeout)
+        result = serial.Serial(Portname, baudrate=port_settings['baud'], bytesize=port_settings['databits'], \
+        parity=port_settings['parity'], stopbits=port_settings['stopbits'], timeout=ReadTimeout, \
+        writeTimeout=WriteTimeout)
         result.flush()
         
     except serial.SerialException as err:
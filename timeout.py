@@ -39,6 +39,19 @@ class Timeout(object):
         return perf_counter() >= self._endtime
     #end def
 
+    def remaining(self):
+        """
+        Gets the time left before the timer expires.
+
+        Returns:
+            float -- remaining time in secs (0 if expired).
+        """
+        remaining = self._endtime - perf_counter()
+        if remaining < 0:
+            remaining = 0.0
+        return remaining
+    #end def
+
     def reset(self, new_duration:float=None):
         """
         Resets the timeout counter.
@@ -0,0 +1,156 @@
+# !python3
+"""
+Module that defines the policies a DeviceChannel uses to wait for
+response data from a device without busy-waiting.
+"""
+
+import select
+from time import perf_counter, sleep
+
+__author__ = 'Scott Pinkham, Byte Arts LLC'
+__version__ = '2019.513.0'
+
+
+class WaitPolicy(object):
+    """
+    Abstract class that defines how a channel waits for data to arrive.
+
+    DeviceChannel.send_command() calls wait() each time it needs more data,
+    then reads from the channel using the read timeout that wait() returns.
+    """
+
+    def wait(self, channel, timeout):
+        """
+        Waits until data may be available on the channel, or the timeout
+        expires.
+
+        Args:
+            channel (DeviceChannel): channel to wait on
+            timeout (float): max time to wait (in secs)
+
+        Returns:
+            float -- read timeout (in secs) to use for the following read.
+        """
+        raise NotImplementedError()
+    #end def
+#end class
+
+
+class ReadTimeoutWaitPolicy(WaitPolicy):
+    """
+    Doesn't wait itself, instead passes the remaining time on as the read
+    timeout so the channel blocks in its own read call.
+    """
+
+    def wait(self, channel, timeout):
+        return timeout
+    #end def
+#end class
+
+
+class SelectWaitPolicy(WaitPolicy):
+    """
+    Sleeps in select() on the channel's file descriptor until it is readable
+    or the timeout expires. Falls back to the read timeout if the channel
+    doesn't have a file descriptor.
+    """
+
+    def wait(self, channel, timeout):
+        fd = channel.fileno()
+        if fd is None:
+            return timeout
+
+        if timeout > 0:
+            try:
+                select.select([fd], [], [], timeout)
+            except (OSError, ValueError):
+                # fd went away, let the read report the error
+                pass
+        #end if
+
+        return 0.0
+    #end def
+#end class
+
+
+class PollingWaitPolicy(WaitPolicy):
+    """
+    Polls the channel's pending byte count, sleeping between polls. For
+    channels that can neither block in a read nor provide a file descriptor.
+
+    Args:
+        interval (float): time to sleep between polls (in secs).
+    """
+
+    def __init__(self, interval=0.001):
+        self._interval = float(interval)
+    #end def
+
+    def wait(self, channel, timeout):
+        endtime = perf_counter() + timeout
+
+        while channel.bytes_available() <= 0:
+            remaining = endtime - perf_counter()
+            if remaining <= 0:
+                break
+            sleep(min(self._interval, remaining))
+        #end while
+
+        return 0.0
+    #end def
+#end class
+
+
+class EpollWaitPolicy(WaitPolicy):
+    """
+    Sleeps in epoll on the channel's file descriptor until it is readable
+    or the timeout expires (Linux only). The epoll object is kept between
+    waits, so each wait is a single system call. Falls back to the read
+    timeout if the channel doesn't have a file descriptor.
+
+    hangup is set if the last wait ended because the device hung up or
+    the fd is in error (EPOLLHUP/EPOLLERR); the fd then stays readable,
+    so the channel should stop waiting on it.
+    """
+
+    def __init__(self):
+        self._epoll = None
+        self._fd = None
+        self.hangup = False
+    #end def
+
+    def release(self):
+        """
+        Closes the epoll object, e.g. when the channel's fd is closed.
+        """
+        if self._epoll is not None:
+            self._epoll.close()
+            self._epoll = None
+        self._fd = None
+    #end def
+
+    def wait(self, channel, timeout):
+        fd = channel.fileno()
+        if fd is None:
+            return timeout
+
+        if fd != self._fd:
+            self.release()
+            self._epoll = select.epoll()
+            self._epoll.register(fd, select.EPOLLIN)
+            self._fd = fd
+        #end if
+
+        self.hangup = False
+        if timeout > 0:
+            try:
+                events = self._epoll.poll(timeout)
+                self.hangup = any(mask & (select.EPOLLHUP | select.EPOLLERR) for _, mask in events)
+            except (OSError, ValueError):
+                # fd went away, let the read report the error
+                pass
+        #end if
+
+        return 0.0
+    #end def
+#end class